@@ -1,21 +1,59 @@
+import io
 import os
+import re
 import json
+import math
+import zlib
 import shutil
+import tempfile
+import hashlib
+import time
 import random
 import asyncio
+import functools
+import threading
 import streamlit as st
-from pathlib import Path
-from docx import Document
-from PyPDF2 import PdfReader
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
-from pydantic import SecretStr
 from langchain_core.prompts import PromptTemplate
-import streamlit.components.v1 as components
-from langchain_community.vectorstores import FAISS
-from streamlit_float import float_init, float_css_helper
-from langchain_classic.chains.question_answering.chain import load_qa_chain
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from langchain_core.documents import Document as TextDocument
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from providers import (DEFAULT_LOCAL_PROVIDER_URL, LOCAL_TFIDF_DIMENSIONS, LOCAL_TFIDF_FEATURES, LocalEmbeddings,
+                       create_chat_model, create_embeddings)
+from telemetry import cache_request, count, span, traced
+from cache import create_cache, hash_key
+from backend import (
+    create_index_version_dir,
+    gc_index_versions,
+    gc_embedding_models,
+    get_chapter_embedding,
+    get_embedding_model_path,
+    get_current_index_version,
+    get_index_dir,
+    publish_index_version,
+    get_llm_task_stats,
+    record_llm_call,
+    get_chapter_mindmap,
+    get_chunk_citation,
+    get_chunk_duplicates,
+    get_chunk_topic,
+    get_cluster_chunks,
+    get_topic_chunks,
+    get_summary_nodes,
+    read_summary_tree,
+    write_summary_tree,
+    schedule_mindmap_prerender,
+    read_chunk_table,
+    build_chunk_table,
+    write_chunk_table,
+    read_index_manifest,
+    update_index_manifest,
+    save_chapter_mindmap,
+    get_extracted_pages,
+    save_extracted_pages,
+    add_chapter,
+    delete_chapter,
+)
 
 try:
     asyncio.get_running_loop()
@@ -24,121 +62,1444 @@ except RuntimeError:
 
 # 1. Loading environment variables
 load_dotenv()
-GOOGLE_API_KEY = st.secrets["GOOGLE_API_KEY"]
 FAISS_INDEX_PATH = "faiss_index"
 EMBEDDING_MODEL = "models/embedding-001"
 LLM_MODEL = "gemini-2.5-flash"
 
+# A model profile is one provider/model with its generation limits. "provider" defaults
+# to AI_PROVIDER, so a single profile can be moved to e.g. the local stand-in on its own.
+MODEL_PROFILES = {
+    "light": {"model": "gemini-2.5-flash-lite", "temperature": 0.0, "max_tokens": 1024, "timeout": 30},
+    "balanced": {"model": LLM_MODEL, "temperature": 0.2, "max_tokens": 4096, "timeout": 60},
+    "generation": {"model": LLM_MODEL, "temperature": 0.4, "max_tokens": 16384, "timeout": 120},
+}
+# Each task routes to a profile. Once a task has ROUTING_MIN_CALLS recorded calls, it moves
+# to its fallback while its profile is slower than max_mean_seconds or fails more often
+# than max_error_rate (both smoothed over recent calls). Failed calls also retry there.
+TASK_ROUTES = {
+    "chat": {"profile": "balanced"},
+    "general_chat": {"profile": "balanced"},
+    "summary": {"profile": "light", "fallback": "balanced", "max_error_rate": 0.2, "cache_ttl": 7 * 86400},
+    "grading": {"profile": "light", "fallback": "balanced", "max_error_rate": 0.2, "cache_ttl": 7 * 86400},
+    "quiz": {"profile": "generation", "fallback": "balanced", "max_mean_seconds": 60},
+    "flashcards": {"profile": "generation", "fallback": "balanced", "max_mean_seconds": 60},
+    "mindmap": {"profile": "generation", "fallback": "balanced", "max_mean_seconds": 60},
+    "exam": {"profile": "generation", "fallback": "balanced", "max_mean_seconds": 90},
+}
+DEFAULT_MODEL_PROFILE = "balanced"
+ROUTING_MIN_CALLS = 20
+ROUTING_PROBE_RATE = 0.05   # share of calls still sent to a demoted profile so it can recover
+ROUTING_STATS_TTL = 60      # seconds between reloads of the usage statistics
+# USD per million prompt / output tokens, for the cost column of the usage statistics
+MODEL_PRICES = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+}
+
+
+# Chunk sizes are in characters. Overlap only needs to carry a sentence or two
+# across a boundary, since sections never span headings or pages anyway.
+CHUNKING_PROFILES = {
+    "pdf": {"chunk_size": 2000, "chunk_overlap": 200},
+    "docx": {"chunk_size": 2000, "chunk_overlap": 200},
+    "txt": {"chunk_size": 1500, "chunk_overlap": 150},
+}
+HEADING_PATTERN = re.compile(
+    r"^(?:#{1,6}\s+\S.{0,120}"                                # markdown / docx heading styles
+    r"|(?i:chapter|section|part)\s+(?:\d+|[IVXLC]+)\b.{0,100}"  # "Chapter 3: ...", "Section IV"
+    r"|\d+(?:\.\d+){0,3}\.?\s+[A-Z][^.!?]{0,100}"               # "2.1 Cell Structure"
+    r"|[A-Z][A-Z0-9 ,:&()/\-]{3,80})$"                           # "INTRODUCTION"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count used for budgets and reports (about 4 characters per token)."""
+    return (len(text) + 3) // 4
+
+
+_cache_miss = threading.local()
+
+def _note_cache_miss():
+    """Called at the top of a Streamlit-cached function; only runs when the cache missed."""
+    _cache_miss.flag = True
+
+def _call_cached(cache_name, func, *args):
+    """Calls a Streamlit-cached function and counts whether its cache hit."""
+    _cache_miss.flag = False
+    result = func(*args)
+    cache_request(cache_name, hit=not _cache_miss.flag)
+    return result
+
+
+def _file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def get_pdf_pages(pdf_file):
+    """Extracts the text of every page of a PDF file."""
+    from PyPDF2 import PdfReader
+    pdf = PdfReader(pdf_file)
+    return [page.extract_text() or "" for page in pdf.pages]
 
-@st.cache_data(show_spinner=False)
-def get_pdf_text(pdf_files):
-    """Extracts text from a list of uploaded PDF files."""
-    full_text = ""
-    for pdf_file in pdf_files:
-        pdf = PdfReader(pdf_file)
-        for page in pdf.pages:
-            page_text = page.extract_text()
-            if page_text:
-                full_text += page_text
-    return full_text
-
-@st.cache_data(show_spinner=False)
 def get_text_contents(file_path):
     """Reads and returns the text content from a given file path."""
     with open(file_path, "r", encoding="utf-8") as f:
         return f.read()
     
-@st.cache_data(show_spinner=False)
 def get_word_contents(file_path):
+    """Returns the text of a Word document, with heading paragraphs marked up as '#' headings."""
+    from docx import Document
     doc = Document(file_path)
     full_text = []
     for para in doc.paragraphs:
-        full_text.append(para.text)
+        style_name = para.style.name if para.style is not None else ""
+        if para.text.strip() and (style_name.startswith("Heading") or style_name == "Title"):
+            level = style_name.rsplit(" ", 1)[-1]
+            full_text.append("#" * (int(level) if level.isdigit() else 1) + " " + para.text.strip())
+        else:
+            full_text.append(para.text)
     return "\n".join(full_text)
 
+# Extractors whose output is kept in the extracted text store: (library, output version).
+# Bump the version when an extractor's output changes; upgrading the library re-extracts too.
+TEXT_EXTRACTORS = {
+    ".pdf": ("pdf", "PyPDF2", 1, get_pdf_pages),
+    ".docx": ("docx", "python-docx", 1, lambda path: [get_word_contents(path)]),
+}
+
+@functools.lru_cache(maxsize=None)
+def get_extractor_version(extension):
+    """Store key of an extractor, e.g. "pdf-PyPDF2-3.0.1-v1"."""
+    from importlib.metadata import PackageNotFoundError, version
+    doc_type, library, output_version, _ = TEXT_EXTRACTORS[extension]
+    try:
+        library_version = version(library)
+    except PackageNotFoundError:
+        library_version = "unknown"
+    return f"{doc_type}-{library}-{library_version}-v{output_version}"
+
+def extract_pages(file_path, content_sha256=None):
+    """
+    Returns (doc_type, pages) for a supported material file, or (None, []) otherwise.
+    PDF and Word pages come from the extracted text store when the same content was
+    parsed before; content_sha256 saves hashing the file again when the caller has it.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    with span("extract", doc_type=extension.lstrip(".")) as extract_span:
+        if extension == ".txt":
+            # Form feeds are the only page marker plain text files have
+            return "txt", get_text_contents(file_path).split("\f")
+        if extension not in TEXT_EXTRACTORS:
+            return None, []
+        doc_type, _, _, extract = TEXT_EXTRACTORS[extension]
+        extractor = get_extractor_version(extension)
+        content_sha256 = content_sha256 or _file_sha256(file_path)
+        pages = get_extracted_pages(content_sha256, extractor)
+        cache_request("extracted_text", hit=pages is not None)
+        if pages is None:
+            # Another replica may have parsed the same content
+            pages = get_shared_cache().get("extracted_pages", f"{content_sha256}:{extractor}")
+            if pages is not None:
+                save_extracted_pages(content_sha256, extractor, pages)
+        extract_span.set(stored=pages is not None)
+        if pages is None:
+            pages = extract(file_path)
+            save_extracted_pages(content_sha256, extractor, pages)
+            get_shared_cache().set("extracted_pages", f"{content_sha256}:{extractor}", pages)
+        return doc_type, pages
+
+def extract_uploaded_pages(file_name, data):
+    """Returns (doc_type, pages) of an uploaded file from its bytes, without writing it to disk."""
+    extension = os.path.splitext(file_name)[1].lower()
+    with span("extract", doc_type=extension.lstrip("."), stored=False):
+        if extension == ".txt":
+            return "txt", data.decode("utf-8").split("\f")
+        if extension not in TEXT_EXTRACTORS:
+            return None, []
+        doc_type, _, _, extract = TEXT_EXTRACTORS[extension]
+        return doc_type, extract(io.BytesIO(data))
+
+def split_into_sections(page_text: str):
+    """Splits a page at heading lines. Yields (heading, start_offset, section_text)."""
+    heading, section_start, offset = None, 0, 0
+    for line in page_text.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped and offset > section_start and HEADING_PATTERN.match(stripped):
+            yield heading, section_start, page_text[section_start:offset]
+            section_start = offset
+        if stripped and offset == section_start and HEADING_PATTERN.match(stripped):
+            heading = stripped.lstrip("#").strip()
+        offset += len(line)
+    if offset > section_start:
+        yield heading, section_start, page_text[section_start:offset]
+
+def chunk_document(pages, source: str, doc_type: str, chunk_size=None, chunk_overlap=None):
+    """
+    Splits the pages of one document into chunks that follow its structure.
+    Consecutive small sections of a page are packed together, long sections are
+    split recursively, and no chunk crosses a page. Each chunk is returned as a
+    dict with its text and citation metadata (source, page, offsets, heading).
+    """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    profile = CHUNKING_PROFILES.get(doc_type, CHUNKING_PROFILES["txt"])
+    chunk_size = chunk_size or profile["chunk_size"]
+    chunk_overlap = profile["chunk_overlap"] if chunk_overlap is None else chunk_overlap
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+
+    chunks = []
+    def add_chunk(text, page_number, start_offset, heading):
+        if text.strip():
+            chunks.append({
+                "text": text.strip(),
+                "metadata": {
+                    "source": source,
+                    "doc_type": doc_type,
+                    "page": page_number,
+                    "start_offset": start_offset,
+                    "end_offset": start_offset + len(text),
+                    "heading": heading,
+                },
+            })
+
+    current_heading = None
+    for page_number, page_text in enumerate(pages, start=1):
+        buffer, buffer_start, buffer_heading = "", 0, current_heading
+        for heading, section_start, section_text in split_into_sections(page_text):
+            # A page that starts mid-section inherits the heading of the previous page
+            section_heading = heading or current_heading
+            current_heading = section_heading
+            if buffer and len(buffer) + len(section_text) > chunk_size:
+                add_chunk(buffer, page_number, buffer_start, buffer_heading)
+                buffer = ""
+            if len(section_text) > chunk_size:
+                for piece in splitter.create_documents([section_text]):
+                    add_chunk(piece.page_content, page_number,
+                              section_start + piece.metadata["start_index"], section_heading)
+                continue
+            if not buffer:
+                buffer_start, buffer_heading = section_start, section_heading
+            buffer += section_text
+        add_chunk(buffer, page_number, buffer_start, buffer_heading)
+    return chunks
+
 @st.cache_data(show_spinner=False)
-def get_text_chunks(text):
-    splitter = RecursiveCharacterTextSplitter(chunk_size=8000, chunk_overlap=2000)
-    return splitter.split_text(text)
+def get_text_chunks(pages, source, doc_type):
+    _note_cache_miss()
+    return chunk_document(pages, source, doc_type)
+
+def get_file_chunks(sha1_of_username, subject, chapter, content_sha256, pages, source, doc_type):
+    """
+    Returns the chunks of one material file from the shared cache of its chapter, or
+    chunks it (through this process's cache) and shares the result with the other replicas.
+    """
+    key = hash_key(content_sha256, source, doc_type, CHUNKING_PROFILES, HEADING_PATTERN.pattern)
+    namespace = f"{chapter_cache_namespace(sha1_of_username, subject, chapter)}/chunks"
+    return get_shared_cache().get_or_compute(
+        namespace, key, lambda: _call_cached("text_chunks", get_text_chunks, pages, source, doc_type))
+
+TOPIC_STOPWORDS = frozenset("""
+    about above after again against also among because been before being below between both could does doing
+    during each either every first from further have having here however into itself just many more most much
+    must other over same should since some such than that their them then there these they this those through
+    under until upon very were what when where which while will with within without would your
+""".split())
+TOPIC_NUMBERING = re.compile(r"^(?:(?i:chapter|section|part)\s+)?(?:\d+(?:\.\d+)*|[IVXLC]+)[.:)]?\s+")
+TOPIC_MAX_CHARS = 60
+
+def label_chunk_topics(chunks):
+    """
+    Labels every chunk with a topic, without any model call: its section heading
+    (numbering removed) or, for chunks without one, its most characteristic keyword.
+    Keywords are limited to words found in several chunks, so labels repeat across
+    chunks and per-topic quiz statistics accumulate.
+    """
+    words_per_chunk = [[word for word in re.findall(r"[a-z][a-z-]{3,}", chunk["text"].lower())
+                        if word not in TOPIC_STOPWORDS] for chunk in chunks]
+    document_frequency = {}
+    for words in words_per_chunk:
+        for word in set(words):
+            document_frequency[word] = document_frequency.get(word, 0) + 1
+    max_frequency = max(2, len(chunks) // 2)
+
+    labels = []
+    for chunk, words in zip(chunks, words_per_chunk):
+        heading = chunk["metadata"].get("heading")
+        if heading:
+            labels.append(TOPIC_NUMBERING.sub("", heading).strip(" #:-")[:TOPIC_MAX_CHARS] or heading[:TOPIC_MAX_CHARS])
+            continue
+        term_frequency = {}
+        for word in words:
+            if 2 <= document_frequency[word] <= max_frequency:
+                term_frequency[word] = term_frequency.get(word, 0) + 1
+        if term_frequency:
+            keyword = max(term_frequency, key=lambda w: (term_frequency[w] / document_frequency[w], w))
+            labels.append(keyword.capitalize())
+        else:
+            labels.append(None)
+    return labels
+
+# Near-duplicate chunks (the same passage in several editions or slide decks) are found
+# with MinHash signatures of word shingles and LSH banding: 16 bands of 8 rows make
+# chunks with a Jaccard similarity of 0.8 candidates 95% of the time.
+DEDUP_SHINGLE_WORDS = 3
+DEDUP_BANDS = 16
+DEDUP_ROWS = 8
+DEDUP_THRESHOLD = 0.8
+_MINHASH_PRIME = (1 << 31) - 1
+
+def minhash_signatures(texts, seed=0):
+    """Returns the MinHash signatures of texts (word shingles) as a (texts, DEDUP_BANDS * DEDUP_ROWS) array."""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    num_hashes = DEDUP_BANDS * DEDUP_ROWS
+    # (a * x + b) mod p stays below 2**64 for 32-bit shingle hashes x and a, b < p < 2**31
+    a = rng.integers(1, _MINHASH_PRIME, size=num_hashes, dtype=np.uint64)
+    b = rng.integers(0, _MINHASH_PRIME, size=num_hashes, dtype=np.uint64)
+    signatures = np.empty((len(texts), num_hashes), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        words = re.findall(r"\w+", text.lower())
+        shingles = {" ".join(words[j:j + DEDUP_SHINGLE_WORDS])
+                    for j in range(max(1, len(words) - DEDUP_SHINGLE_WORDS + 1))}
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        signatures[i] = ((hashes[:, None] * a + b) % _MINHASH_PRIME).min(axis=0)
+    return signatures
+
+def find_near_duplicates(texts, threshold=DEDUP_THRESHOLD):
+    """
+    Returns, for every text, the index of the text it is collapsed into (its own index when
+    it is kept). Texts sharing an LSH band bucket are compared by their estimated Jaccard
+    similarity; each group of near-duplicates keeps its longest text.
+    """
+    signatures = minhash_signatures(texts)
+    parent = list(range(len(texts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(DEDUP_BANDS):
+        buckets = {}
+        for i, row in enumerate(signatures[:, band * DEDUP_ROWS:(band + 1) * DEDUP_ROWS]):
+            buckets.setdefault(row.tobytes(), []).append(i)
+        for members in buckets.values():
+            for position, i in enumerate(members[1:], start=1):
+                for j in members[:position]:
+                    root_i, root_j = find(i), find(j)
+                    if root_i == root_j or (signatures[i] == signatures[j]).mean() < threshold:
+                        continue
+                    keep, drop = sorted((root_i, root_j), key=lambda k: (-len(texts[k]), k))
+                    parent[drop] = keep
+                    break
+    return [find(i) for i in range(len(texts))]
+
+def collapse_near_duplicates(chunks):
+    """
+    Drops near-duplicate chunks before they are embedded. The metadata of each kept chunk
+    lists the locations of the chunks collapsed into it under "duplicates".
+    Returns (kept chunks in their original order, number of chunks dropped).
+    """
+    if len(chunks) < 2:
+        return chunks, 0
+    kept_as = find_near_duplicates([chunk["text"] for chunk in chunks])
+    duplicates = {}
+    for i, keep in enumerate(kept_as):
+        if keep != i:
+            duplicates.setdefault(keep, []).append(chunks[i]["metadata"])
+    kept = [{**chunk, "metadata": {**chunk["metadata"], "duplicates": duplicates[i]}} if i in duplicates else chunk
+            for i, chunk in enumerate(chunks) if kept_as[i] == i]
+    return kept, len(chunks) - len(kept)
+
+# Chunk clusters per index: about sqrt(chunks / 2), so each cluster holds a few sections
+CHUNK_CLUSTERS_MAX = 32
+KMEANS_ITERATIONS = 25
+
+def cluster_chunk_vectors(vector_store, seed=0):
+    """
+    Groups the chunk vectors of a FAISS store with k-means (k-means++ seeding, Lloyd
+    iterations vectorized with NumPy). Returns the cluster of every chunk in index order.
+    """
+    import numpy as np
+    num_vectors = vector_store.index.ntotal
+    if num_vectors == 0:
+        return []
+    vectors = np.asarray(vector_store.index.reconstruct_n(0, num_vectors), dtype=np.float32)
+    num_clusters = max(1, min(num_vectors, CHUNK_CLUSTERS_MAX, round(math.sqrt(num_vectors / 2))))
+
+    rng = np.random.default_rng(seed)
+    centroid_ids = [int(rng.integers(num_vectors))]
+    closest = ((vectors - vectors[centroid_ids[0]]) ** 2).sum(axis=1)
+    while len(centroid_ids) < num_clusters and closest.sum() > 0:
+        # Far away vectors are more likely to seed the next cluster
+        centroid_ids.append(int(rng.choice(num_vectors, p=closest / closest.sum())))
+        closest = np.minimum(closest, ((vectors - vectors[centroid_ids[-1]]) ** 2).sum(axis=1))
+    centroids = vectors[centroid_ids]
+
+    squared_norms = (vectors ** 2).sum(axis=1)
+    for _ in range(KMEANS_ITERATIONS):
+        distances = squared_norms[:, None] - 2 * vectors @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+        labels = distances.argmin(axis=1)
+        members = np.zeros((len(centroids), num_vectors), dtype=np.float32)
+        members[labels, np.arange(num_vectors)] = 1.0
+        sizes = members.sum(axis=1)
+        # Clusters that lost all their vectors keep their centroid
+        updated = np.where(sizes[:, None] > 0, (members @ vectors) / np.maximum(sizes, 1)[:, None], centroids)
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+    return labels.tolist()
+
+def get_setting(name, default=None):
+    """Reads a setting from the environment (or .env), falling back to Streamlit secrets."""
+    value = os.getenv(name)
+    if value is not None:
+        return value
+    try:
+        return st.secrets.get(name, default)
+    except Exception:
+        # No secrets.toml, e.g. when running benchmarks outside Streamlit
+        return default
+
+def get_provider():
+    """Returns the configured AI provider: "google" (default), "fake" or "local"."""
+    return str(get_setting("AI_PROVIDER", "google")).lower()
+
+@st.cache_resource
+def get_shared_cache():
+    """Returns the cache shared by the app replicas, configured by CACHE_BACKEND (see cache.py)."""
+    return create_cache(get_setting("CACHE_BACKEND", "memory"), url=get_setting("CACHE_URL"), path=get_setting("CACHE_PATH"))
+
+def chapter_cache_namespace(sha1_of_username, subject, chapter):
+    """Shared cache namespace of a chapter; invalidating the user or the subject drops it too."""
+    return f"{sha1_of_username}/{subject}/{chapter}"
 
 @st.cache_resource
 def get_embeddings():
-    """Returns a cached instance of the Google Generative AI Embeddings."""
-    if not GOOGLE_API_KEY:
-        raise ValueError("GOOGLE_API_KEY environment variable not set.")
-    return GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL, google_api_key=SecretStr(GOOGLE_API_KEY))
+    """Returns a cached instance of the embeddings of the configured provider."""
+    return create_embeddings(
+        get_provider(),
+        EMBEDDING_MODEL,
+        google_api_key=get_setting("GOOGLE_API_KEY"),
+        local_url=get_setting("LOCAL_PROVIDER_URL", DEFAULT_LOCAL_PROVIDER_URL),
+        fake_latency=float(get_setting("FAKE_EMBEDDING_LATENCY", 0.0)),
+    )
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_local_embeddings(kind, model_path=None, dimensions=None):
+    """Returns cached local CPU embeddings: "hashing", or a fitted "tfidf" model read from model_path."""
+    if model_path is None:
+        return LocalEmbeddings(kind, features=dimensions)
+    return LocalEmbeddings.load(model_path)
+
+def fit_subject_embeddings(sha1_of_username, subject):
+    """
+    Returns the name of the TF-IDF + SVD model of a subject, fitting it on the chunks of
+    all the subject's materials unless a model of exactly these files is stored already.
+    """
+    subject_dir = os.path.join(sha1_of_username, "materials", subject)
+    files = []
+    for chapter in sorted(os.listdir(subject_dir)):
+        chapter_dir = os.path.join(subject_dir, chapter)
+        if os.path.isdir(chapter_dir):
+            files.extend(os.path.join(chapter_dir, name) for name in sorted(os.listdir(chapter_dir)))
+    content_hashes = [_file_sha256(path) for path in files]
+    settings = f"{LOCAL_TFIDF_FEATURES}:{LOCAL_TFIDF_DIMENSIONS}:{json.dumps(CHUNKING_PROFILES, sort_keys=True)}"
+    model = "tfidf-" + hashlib.sha256("\n".join(sorted(content_hashes) + [settings]).encode("utf-8")).hexdigest()[:16]
+    model_path = get_embedding_model_path(sha1_of_username, subject, model)
+    if os.path.exists(model_path):
+        return model
+
+    texts = []
+    for path, content_sha256 in zip(files, content_hashes):
+        doc_type, pages = extract_pages(path, content_sha256)
+        if doc_type is not None:
+            chapter = os.path.basename(os.path.dirname(path))
+            texts.extend(chunk["text"] for chunk in get_file_chunks(
+                sha1_of_username, subject, chapter, content_sha256, pages, os.path.basename(path), doc_type))
+    with span("fit_embeddings", chunks=len(texts)):
+        embeddings = LocalEmbeddings("tfidf").fit(texts)
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    tmp_path = f"{model_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    embeddings.save(tmp_path)
+    os.replace(tmp_path, model_path)
+    return model
+
+def get_chapter_embeddings(sha1_of_username, subject, chapter):
+    """
+    Returns (embeddings, manifest entry) to index a chapter with, following its embedding
+    setting. The entry is stored in the index manifest so queries use the same embeddings.
+    """
+    kind = get_chapter_embedding(sha1_of_username, subject, chapter)
+    if kind == "hashing":
+        embeddings = get_local_embeddings("hashing")
+        return embeddings, {"kind": "hashing", "dimensions": embeddings.dimensions}
+    if kind == "tfidf":
+        model = fit_subject_embeddings(sha1_of_username, subject)
+        return get_local_embeddings("tfidf", get_embedding_model_path(sha1_of_username, subject, model)), \
+            {"kind": "tfidf", "model": model}
+    return get_embeddings(), get_default_embedding_entry()
+
+def get_default_embedding_entry():
+    """Manifest entry of the embeddings of the configured AI provider."""
+    return {"kind": "default", "provider": get_provider(), "model": EMBEDDING_MODEL}
+
+def get_index_embeddings(sha1_of_username, subject, manifest):
+    """Returns the embeddings an index version was built with, from its manifest (the default for legacy ones)."""
+    embedding = (manifest or {}).get("embedding") or {"kind": "default"}
+    if embedding["kind"] == "hashing":
+        return get_local_embeddings("hashing", dimensions=embedding.get("dimensions"))
+    if embedding["kind"] == "tfidf":
+        return get_local_embeddings("tfidf", get_embedding_model_path(sha1_of_username, subject, embedding["model"]))
+    return get_embeddings()
+
+def get_model_routing():
+    """
+    Returns (profiles, routes): MODEL_PROFILES and TASK_ROUTES, updated from the JSON
+    file named by the MODEL_ROUTES_FILE setting, e.g.
+    {"profiles": {"light": {"provider": "local"}}, "routes": {"grading": {"profile": "balanced"}}}
+    The file is read again when its modification time changes.
+    """
+    routes_file = get_setting("MODEL_ROUTES_FILE")
+    try:
+        mtime = os.stat(routes_file).st_mtime_ns if routes_file else None
+    except OSError:
+        mtime = None
+    return _read_model_routing(routes_file, mtime)
+
+@functools.lru_cache(maxsize=4)
+def _read_model_routing(routes_file, mtime):
+    profiles = {name: dict(profile) for name, profile in MODEL_PROFILES.items()}
+    routes = {task: dict(route) for task, route in TASK_ROUTES.items()}
+    if routes_file:
+        with open(routes_file, "r", encoding="utf-8") as f:
+            overrides = json.load(f)
+        for name, profile in overrides.get("profiles", {}).items():
+            profiles.setdefault(name, {}).update(profile)
+        for task, route in overrides.get("routes", {}).items():
+            routes.setdefault(task, {}).update(route)
+    return profiles, routes
+
+def get_model_profile(profile_name):
+    """Returns a model profile with its provider and limits filled in."""
+    profiles, _ = get_model_routing()
+    profile = {"provider": get_provider(), "model": LLM_MODEL, "temperature": 0.2, "max_tokens": None, "timeout": None}
+    profile.update(profiles[profile_name])
+    return profile
+
+def get_llm(profile_name=DEFAULT_MODEL_PROFILE):
+    """Returns the cached chat model of a model profile."""
+    profile = get_model_profile(profile_name)
+    return _get_chat_model(profile["provider"], profile["model"], profile["temperature"],
+                           profile["max_tokens"], profile["timeout"])
 
 @st.cache_resource
-def get_llm():
-    """Returns a cached instance of the ChatGoogleGenerativeAI model."""
-    return ChatGoogleGenerativeAI(model=LLM_MODEL, temperature=0.2, google_api_key=SecretStr(GOOGLE_API_KEY or ""))
+def _get_chat_model(provider, model, temperature, max_tokens, timeout):
+    return create_chat_model(
+        provider,
+        model,
+        temperature=temperature,
+        google_api_key=get_setting("GOOGLE_API_KEY"),
+        local_url=get_setting("LOCAL_PROVIDER_URL", DEFAULT_LOCAL_PROVIDER_URL),
+        fake_latency=float(get_setting("FAKE_LLM_LATENCY", 0.0)),
+        fake_token_latency=float(get_setting("FAKE_LLM_TOKEN_LATENCY", 0.0)),
+        max_tokens=max_tokens,
+        timeout=timeout,
+    )
 
 
 # ============== Vector Store Functionality =================
-def create_and_save_vector_store(sha1_of_username, subject, chapter):
+def build_vector_store(sha1_of_username, subject, chapter):
+    """
+    Builds a new index version from the chapter materials and publishes it.
+    The previously published version keeps serving until the new one is complete.
+    Returns the new version, or None if there was nothing to index.
+    """
     materials_dir = f"{sha1_of_username}/materials/{subject}/{chapter}"
-    FAISS_INDEX_PATH = f"{sha1_of_username}/data/{subject}/{chapter}"
-    if os.path.exists(FAISS_INDEX_PATH):
-        shutil.rmtree(FAISS_INDEX_PATH)
-        st.session_state.vector_store_exists = False
-        st.rerun()
-    if not os.path.exists(materials_dir) or not os.listdir(materials_dir):
-        st.error(f"No materials found for {subject} - {chapter} to create vector store. Please upload files first.")
-        st.rerun()
-        return None
-    all_text = ""
-    for file_name in os.listdir(materials_dir):
+    text_chunks = []
+    manifest_files = []
+    for file_name in sorted(os.listdir(materials_dir)):
         file_path = os.path.join(materials_dir, file_name)
-        if file_name.lower().endswith(".pdf"):
-            with open(file_path, "rb") as pdf_file:
-                all_text += get_pdf_text([pdf_file]) + "\n"
-        elif file_name.lower().endswith(".txt"):
-            with open(file_path, "r", encoding="utf-8") as text_file:
-                all_text += get_text_contents(file_path) + "\n"
-        elif file_name.lower().endswith(".docx"):
-            with open(file_path, "rb") as word_file:
-                all_text += get_word_contents(word_file) + "\n"
-        else:
+        content_sha256 = _file_sha256(file_path)
+        doc_type, pages = extract_pages(file_path, content_sha256)
+        if doc_type is None:
             st.warning(f"Unsupported file format: {file_name}. Skipping.")
-    text_chunks = get_text_chunks(all_text)
-
-    # Ensure the target data directory exists (do not delete it)
-    os.makedirs(FAISS_INDEX_PATH, exist_ok=True)
+            continue
+        with span("chunk", source=file_name) as chunk_span:
+            file_chunks = get_file_chunks(sha1_of_username, subject, chapter, content_sha256, pages, file_name, doc_type)
+            chunk_span.set(chunks=len(file_chunks))
+        text_chunks.extend(file_chunks)
+        manifest_files.append({
+            "name": file_name,
+            "size": os.path.getsize(file_path),
+            "sha256": content_sha256,
+        })
+    if not text_chunks:
+        st.error(f"No text could be extracted from the materials of {subject} - {chapter}.")
+        return None
 
-    # Only remove previous FAISS index files, do NOT remove the subject/chapter directory
-    _index_file = os.path.join(FAISS_INDEX_PATH, "faiss.index")
-    _pkl_file = os.path.join(FAISS_INDEX_PATH, "faiss.pkl")
+    with span("dedup_chunks", chunks=len(text_chunks)) as dedup_span:
+        text_chunks, duplicate_chunks = collapse_near_duplicates(text_chunks)
+        dedup_span.set(duplicates=duplicate_chunks)
+    count("duplicate_chunks", duplicate_chunks)
 
-    for _file in (_index_file, _pkl_file):
-        if os.path.isfile(_file):
+    from langchain_community.vectorstores import FAISS
+    embeddings, embedding = get_chapter_embeddings(sha1_of_username, subject, chapter)
+    version, version_dir = create_index_version_dir(sha1_of_username, subject, chapter)
+    try:
+        embedding_tokens = sum(estimate_tokens(chunk["text"]) for chunk in text_chunks)
+        count("embedding_tokens", embedding_tokens)
+        with span("embed", chunks=len(text_chunks), tokens=embedding_tokens, embedding=embedding["kind"]):
+            # Citation metadata lives in the chunk table; the docstore only keeps the row id
+            # and the file name, which per-file retrieval filters on
+            vector_store = FAISS.from_texts(
+                [chunk["text"] for chunk in text_chunks],
+                embedding=embeddings,
+                metadatas=[{"chunk_id": i, "source": chunk["metadata"]["source"]} for i, chunk in enumerate(text_chunks)],
+            )
+        vector_store.save_local(version_dir)
+        with span("label_topics", chunks=len(text_chunks)):
+            topics = label_chunk_topics(text_chunks)
+        with span("cluster_chunks", chunks=len(text_chunks)):
+            clusters = cluster_chunk_vectors(vector_store)
+        write_chunk_table(version_dir, [{**chunk["metadata"], "topic": topic, "cluster": cluster}
+                                        for chunk, topic, cluster in zip(text_chunks, topics, clusters)])
+        summaries = "off"
+        if CHAPTER_SUMMARIES_ENABLED:
+            current = get_current_index_version(sha1_of_username, subject, chapter)
+            previous = read_summary_tree(sha1_of_username, subject, chapter, current) if current else None
             try:
-                os.remove(_file)
-                st.info(f"Removed previous FAISS file: {os.path.basename(_file)}")
+                with span("summarize_chapter", chunks=len(text_chunks)) as summary_span:
+                    tree, reused = build_summary_tree(text_chunks, chapter, previous)
+                    summary_span.set(nodes=len(tree["nodes"]), reused=reused)
+                write_summary_tree(version_dir, tree)
+                summaries = "built"
             except Exception as e:
-                st.warning(f"Could not remove {os.path.basename(_file)}: {e}")
+                # The index is still usable; generation falls back to raw chunks and
+                # fill_summary_tree() retries the tree later
+                print(f"Chapter summaries of {subject} - {chapter} failed: {e}")
+                count("summary_failures")
+                st.warning(f"The chapter summaries could not be built: {e}")
+                summaries = "missing"
+    except Exception:
+        # Never leave a half-written version behind; the current one stays published
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    publish_index_version(sha1_of_username, subject, chapter, version,
+                          get_index_manifest(manifest_files, len(text_chunks), embedding, duplicate_chunks, summaries))
+    gc_index_versions(sha1_of_username, subject, chapter)
+    gc_embedding_models(sha1_of_username, subject)
+    return version
+
+def get_index_manifest(manifest_files, num_chunks, embedding, duplicate_chunks=0, summaries="off"):
+    """
+    Manifest of an index version: its files ({"name", "size", "sha256"}), its chunk counts,
+    the embeddings it was built with (an entry from get_chapter_embeddings()) and the
+    chunking settings. dedup_ratio is the share of chunks collapsed as near-duplicates.
+    summaries is "built", "off", or "missing" when building the summary tree failed.
+    """
+    return {
+        "files": manifest_files,
+        "num_chunks": num_chunks,
+        "duplicate_chunks": duplicate_chunks,
+        "dedup_ratio": round(duplicate_chunks / max(num_chunks + duplicate_chunks, 1), 4),
+        "embedding": embedding,
+        "chunking": CHUNKING_PROFILES,
+        "summaries": summaries,
+    }
+
+def fill_summary_tree(sha1_of_username, subject, chapter):
+    """
+    Builds the summary tree of the published version when its build failed (manifest
+    "summaries": "missing"), from the chunks already in the index.
+    Returns True if a tree was written.
+    """
+    version = get_current_index_version(sha1_of_username, subject, chapter)
+    manifest = read_index_manifest(sha1_of_username, subject, chapter, version) if version else None
+    if not manifest or manifest.get("summaries") != "missing":
+        return False
+    vector_store = read_vector_store_version(sha1_of_username, subject, chapter, version)
+    chunk_table = vector_store.chunk_table if vector_store is not None else None
+    if chunk_table is None:
+        return False
+    docs = sorted(vector_store.docstore._dict.values(), key=lambda doc: doc.metadata["chunk_id"])
+    chunks = [{"text": doc.page_content, "metadata": get_chunk_citation(chunk_table, doc.metadata["chunk_id"])}
+              for doc in docs]
+    with span("summarize_chapter", chunks=len(chunks)) as summary_span:
+        tree, _ = build_summary_tree(chunks, chapter)
+        summary_span.set(nodes=len(tree["nodes"]), reused=0)
+    write_summary_tree(get_index_dir(sha1_of_username, subject, chapter, version), tree)
+    # Loaded copies of the version pick the tree up in load_vector_store()
+    update_index_manifest(sha1_of_username, subject, chapter, version, summaries="built")
+    return True
+
+def create_and_save_vector_store(sha1_of_username, subject, chapter):
+    materials_dir = f"{sha1_of_username}/materials/{subject}/{chapter}"
+    if not os.path.exists(materials_dir) or not os.listdir(materials_dir):
+        st.error(f"No materials found for {subject} - {chapter} to create vector store. Please upload files first.")
+        st.rerun()
+        return None
 
-    vector_store = FAISS.from_texts(text_chunks, embedding=get_embeddings())
-    vector_store.save_local(FAISS_INDEX_PATH)
-    st.session_state.vector_store_exists = True
+    version = build_vector_store(sha1_of_username, subject, chapter)
+    st.session_state.vector_store_exists = get_current_index_version(sha1_of_username, subject, chapter) is not None
     st.rerun()
+    return version
 
-@st.cache_resource
 def load_vector_store(sha1_of_username, subject, chapter):
-    """Loads the FAISS vector store from the local path."""
-    data_dir = f"{sha1_of_username}/data/{subject}/{chapter}"
+    """
+    Loads the currently published FAISS vector store of a chapter: a proxy to the shared
+    retrieval service when RETRIEVAL_SERVICE is set and reachable, else the index itself.
+    """
+    version = get_current_index_version(sha1_of_username, subject, chapter)
+    if version is None:
+        return None
+    with span("load_vector_store", version=version):
+        def load_in_process():
+            vector_store = _call_cached("vector_store", _load_vector_store_version, sha1_of_username, subject, chapter, version)
+            if vector_store is not None:
+                # The cached copy may predate a summary tree filled in since, by this or another process
+                vector_store.summary_tree = read_summary_tree(sha1_of_username, subject, chapter, version)
+            return vector_store
+        client = get_retrieval_client()
+        if client is None or not client.available():
+            return load_in_process()
+        from retrieval_service import RemoteVectorStore, RetrievalServiceError
+        key = (sha1_of_username, subject, chapter, version)
+        try:
+            opened = client.call("open", key=key)
+        except (OSError, RetrievalServiceError) as e:
+            print(f"Retrieval service unavailable, loading the index in-process: {e}")
+            count("retrieval_service_fallbacks")
+            return load_in_process()
+        if not opened["found"]:
+            return None
+        vector_store = RemoteVectorStore(client, key, opened["ntotal"], load_in_process)
+        vector_store.index_version = version
+        vector_store.chunk_table = read_chunk_table(sha1_of_username, subject, chapter, version)
+        vector_store.summary_tree = read_summary_tree(sha1_of_username, subject, chapter, version)
+        return vector_store
+
+@st.cache_resource
+def get_retrieval_client():
+    """Returns the client of the retrieval service named by the RETRIEVAL_SERVICE setting, or None."""
+    address = get_setting("RETRIEVAL_SERVICE")
+    if not address:
+        return None
+    from retrieval_service import RetrievalClient
+    return RetrievalClient(address)
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def _load_vector_store_version(sha1_of_username, subject, chapter, version):
+    """Loads one index version. Versions are immutable, so they are cached by name."""
+    _note_cache_miss()
+    return read_vector_store_version(sha1_of_username, subject, chapter, version)
+
+def read_vector_store_version(sha1_of_username, subject, chapter, version):
+    """Reads one index version from disk, or returns None if it has no index (uncached; the retrieval service caches it)."""
+    from langchain_community.vectorstores import FAISS
+    data_dir = get_index_dir(sha1_of_username, subject, chapter, version)
     if not os.path.exists(os.path.join(data_dir, "index.faiss")):
         return None
 
-    return FAISS.load_local(
+    vector_store = FAISS.load_local(
         data_dir, 
-        embeddings=get_embeddings(),
+        embeddings=get_index_embeddings(sha1_of_username, subject,
+                                        read_index_manifest(sha1_of_username, subject, chapter, version)),
         allow_dangerous_deserialization=True
     )
+    # Kept on the store so retrieved documents can be cited without another lookup
+    vector_store.index_version = version
+    vector_store.chunk_table = read_chunk_table(sha1_of_username, subject, chapter, version)
+    vector_store.summary_tree = read_summary_tree(sha1_of_username, subject, chapter, version)
+    return vector_store
+
+def get_citations(docs, vector_db):
+    """
+    Returns the citations of retrieved documents, one per (file, page), in retrieval order:
+    {"chunk_id", "source", "page", "start_offset", "end_offset", "heading", "label", "also_in"}.
+    "also_in" labels the other places the passage appeared in, when near-duplicates of it were
+    collapsed at index time. Documents indexed without citation metadata (legacy indexes) are skipped.
+    """
+    chunk_table = getattr(vector_db, "chunk_table", None)
+    citations, seen = [], set()
+    for doc in docs:
+        if chunk_table is None or "chunk_id" not in doc.metadata:
+            continue
+        citation = {"chunk_id": doc.metadata["chunk_id"], **get_chunk_citation(chunk_table, doc.metadata["chunk_id"])}
+        if (citation["source"], citation["page"]) in seen:
+            continue
+        seen.add((citation["source"], citation["page"]))
+        citation["label"] = f"{citation['source']}, p. {citation['page']}" + (
+            f" · {citation['heading']}" if citation["heading"] else "")
+        duplicates = get_chunk_duplicates(chunk_table, citation["chunk_id"])
+        citation["also_in"] = list(dict.fromkeys(f"{d['source']}, p. {d['page']}" for d in duplicates))
+        citations.append(citation)
+    return citations
+
+def get_source_passage(sha1_of_username, subject, chapter, citation):
+    """Reads the cited passage from the material file itself, or returns None if it is gone."""
+    file_path = os.path.join(sha1_of_username, "materials", subject, chapter, citation["source"])
+    if not os.path.exists(file_path):
+        return None
+    _, pages = extract_pages(file_path)
+    if not 0 < citation["page"] <= len(pages):
+        return None
+    return pages[citation["page"] - 1][citation["start_offset"]:citation["end_offset"]].strip() or None
+
+
+
+# ============== Temporary Chat Index =================
+# A temporary chat is indexed in memory only, per browser session. Each upload is
+# extracted from its bytes and only its own chunks are embedded and appended to the
+# session's FAISS index. Nothing touches the disk unless the chat is promoted to a
+# chapter; indexes idle for TEMP_INDEX_IDLE_SECONDS are dropped, and the least recently
+# used ones go first when all of them together exceed TEMP_INDEX_TOTAL_MAX_BYTES.
+TEMP_INDEX_MAX_BYTES = int(os.getenv("TEMP_INDEX_MAX_MB", "64")) * 2**20
+TEMP_INDEX_TOTAL_MAX_BYTES = int(os.getenv("TEMP_INDEX_TOTAL_MAX_MB", "512")) * 2**20
+TEMP_INDEX_IDLE_SECONDS = int(os.getenv("TEMP_INDEX_IDLE_MINUTES", "30")) * 60
+# Vector size assumed for the memory estimate until the first file is embedded
+TEMP_INDEX_DEFAULT_DIMENSIONS = 768
+
+_temp_indexes = {}
+_temp_indexes_lock = threading.Lock()
+
+def _estimate_temp_bytes(data, pages, chunks, dimensions):
+    # Raw upload (kept for promotion), page texts (for source passages), chunk texts and vectors
+    return (len(data) + sum(len(page) for page in pages) + sum(len(chunk["text"]) for chunk in chunks)
+            + len(chunks) * dimensions * 4)
+
+def sweep_temp_indexes(now=None):
+    """Drops idle temporary indexes, then the least recently used ones while over the total cap."""
+    now = time.monotonic() if now is None else now
+    with _temp_indexes_lock:
+        for session_id, entry in list(_temp_indexes.items()):
+            if now - entry["last_used"] > TEMP_INDEX_IDLE_SECONDS:
+                del _temp_indexes[session_id]
+        total = sum(entry["bytes"] for entry in _temp_indexes.values())
+        for session_id, entry in sorted(_temp_indexes.items(), key=lambda item: item[1]["last_used"]):
+            if total <= TEMP_INDEX_TOTAL_MAX_BYTES:
+                break
+            del _temp_indexes[session_id]
+            total -= entry["bytes"]
+
+def get_temp_index(session_id):
+    """Returns the temporary index of a session, or None, and marks it as used."""
+    sweep_temp_indexes()
+    with _temp_indexes_lock:
+        entry = _temp_indexes.get(session_id)
+        if entry is not None:
+            entry["last_used"] = time.monotonic()
+    return entry
+
+def drop_temp_index(session_id):
+    with _temp_indexes_lock:
+        _temp_indexes.pop(session_id, None)
+
+def add_temp_material(session_id, file_name, data):
+    """
+    Appends an uploaded file to the temporary index of a session, embedding only its chunks.
+    Returns "success", "duplicate" or ("error", message), like upload_material().
+    """
+    entry = get_temp_index(session_id) or {"vector_store": None, "files": {}, "chunks": [], "bytes": 0,
+                                           "last_used": time.monotonic()}
+    if file_name in entry["files"]:
+        return "duplicate"
+    try:
+        doc_type, pages = extract_uploaded_pages(file_name, data)
+        if doc_type is None:
+            return ("error", f"Unsupported file format: {file_name}")
+        with span("chunk", source=file_name):
+            file_chunks = chunk_document(pages, file_name, doc_type)
+        if not file_chunks:
+            return ("error", f"No text could be extracted from {file_name}")
+
+        vector_store = entry["vector_store"]
+        dimensions = vector_store.index.d if vector_store is not None else TEMP_INDEX_DEFAULT_DIMENSIONS
+        file_bytes = _estimate_temp_bytes(data, pages, file_chunks, dimensions)
+        if entry["bytes"] + file_bytes > TEMP_INDEX_MAX_BYTES:
+            return ("error", f"Temporary chat is limited to {TEMP_INDEX_MAX_BYTES // 2**20} MB of material; "
+                             "save it as a chapter to add more.")
+
+        texts = [chunk["text"] for chunk in file_chunks]
+        metadatas = [{"chunk_id": len(entry["chunks"]) + i, "source": file_name} for i in range(len(file_chunks))]
+        count("embedding_tokens", sum(estimate_tokens(text) for text in texts))
+        with span("embed", chunks=len(texts), temporary=True):
+            if vector_store is None:
+                from langchain_community.vectorstores import FAISS
+                vector_store = FAISS.from_texts(texts, embedding=get_embeddings(), metadatas=metadatas)
+            else:
+                vector_store.add_texts(texts, metadatas=metadatas)
+    except Exception as e:
+        return ("error", str(e))
+
+    entry["chunks"].extend(file_chunks)
+    entry["files"][file_name] = {"data": data, "pages": pages, "sha256": hashlib.sha256(data).hexdigest()}
+    entry["bytes"] += _estimate_temp_bytes(data, pages, file_chunks, vector_store.index.d)
+    vector_store.chunk_table = build_chunk_table([chunk["metadata"] for chunk in entry["chunks"]])
+    entry["vector_store"] = vector_store
+    entry["last_used"] = time.monotonic()
+    with _temp_indexes_lock:
+        _temp_indexes[session_id] = entry
+    return "success"
+
+def get_temp_source_passage(session_id, citation):
+    """Reads a cited passage from the pages kept in a temporary index, or returns None."""
+    entry = get_temp_index(session_id)
+    file = entry["files"].get(citation["source"]) if entry else None
+    if file is None or not 0 < citation["page"] <= len(file["pages"]):
+        return None
+    return file["pages"][citation["page"] - 1][citation["start_offset"]:citation["end_offset"]].strip() or None
+
+def promote_temp_chat(session_id, sha1_of_username, subject, chapter):
+    """
+    Saves a temporary chat as a new chapter: its files become the chapter materials and
+    its in-memory index is published as the first index version, without re-embedding.
+    Returns "success", "exists" or ("error", message).
+    """
+    entry = get_temp_index(session_id)
+    if entry is None or entry["vector_store"] is None:
+        return ("error", "There is no material in this temporary chat to save.")
+
+    # The index is written to a staging directory before the chapter exists, so a failure
+    # here leaves nothing behind that would make a retry answer "exists"
+    data_root = os.path.join(sha1_of_username, "data")
+    os.makedirs(data_root, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=".promote-", dir=data_root)
+    try:
+        entry["vector_store"].save_local(staging_dir)
+        topics = label_chunk_topics(entry["chunks"])
+        clusters = cluster_chunk_vectors(entry["vector_store"])
+        write_chunk_table(staging_dir, [{**chunk["metadata"], "topic": topic, "cluster": cluster}
+                                        for chunk, topic, cluster in zip(entry["chunks"], topics, clusters)])
+    except Exception as e:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return ("error", str(e))
+
+    status = add_chapter(sha1_of_username, subject, chapter)
+    if status != "success":
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return status if status == "exists" else ("error", status)
+    try:
+        materials_dir = os.path.join(sha1_of_username, "materials", subject, chapter)
+        os.makedirs(materials_dir, exist_ok=True)
+        manifest_files = []
+        for file_name, file in entry["files"].items():
+            with open(os.path.join(materials_dir, file_name), "wb") as f:
+                f.write(file["data"])
+            extension = os.path.splitext(file_name)[1].lower()
+            if extension in TEXT_EXTRACTORS:
+                # The pages are already extracted, so rebuilding the chapter later will not parse the file
+                save_extracted_pages(file["sha256"], get_extractor_version(extension), file["pages"])
+            manifest_files.append({"name": file_name, "size": len(file["data"]), "sha256": file["sha256"]})
+
+        version, version_dir = create_index_version_dir(sha1_of_username, subject, chapter)
+        for file_name in os.listdir(staging_dir):
+            os.replace(os.path.join(staging_dir, file_name), os.path.join(version_dir, file_name))
+        publish_index_version(sha1_of_username, subject, chapter, version,
+                              get_index_manifest(sorted(manifest_files, key=lambda f: f["name"]), len(entry["chunks"]),
+                                                 get_default_embedding_entry()))
+    except Exception as e:
+        # Never leave a chapter without a published index
+        delete_chapter(sha1_of_username, subject, chapter)
+        return ("error", str(e))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    drop_temp_index(session_id)
+    return "success"
+
+
+# ============== Context Packing =================
+# Token budgets for the retrieved context placed in a prompt (not counting instructions)
+CHAT_CONTEXT_TOKEN_BUDGET = 3000
+GENERATION_CONTEXT_TOKEN_BUDGET = 8000
+CHAT_RETRIEVAL_K = 8
+GENERATION_RETRIEVAL_K = 20
+# Chunks drawn across the clusters for one generation prompt
+GENERATION_STRATIFIED_K = 12
+MMR_LAMBDA = 0.7
+
+def _trim_overlap(selected_text, candidate_text, probe_chars=120):
+    """Removes text that candidate_text shares with selected_text at either end."""
+    if candidate_text in selected_text:
+        return ""
+    # The tail of the selected chunk repeated at the head of the candidate
+    position = selected_text.find(candidate_text[:probe_chars])
+    if position >= 0 and candidate_text.startswith(selected_text[position:]):
+        return candidate_text[len(selected_text) - position:].lstrip()
+    # The head of the selected chunk repeated at the tail of the candidate
+    position = candidate_text.find(selected_text[:probe_chars])
+    if position >= 0 and selected_text.startswith(candidate_text[position:]):
+        return candidate_text[:position].rstrip()
+    return candidate_text
+
+def _truncate_to_tokens(text, max_tokens):
+    """Cuts text to roughly max_tokens, preferring to end on a sentence."""
+    limit = max_tokens * 4
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    sentence_end = max(cut.rfind(". "), cut.rfind(".\n"), cut.rfind("? "), cut.rfind("! "))
+    return cut[:sentence_end + 1] if sentence_end > limit // 2 else cut
+
+def pack_context(scored_docs, token_budget, mmr_lambda=MMR_LAMBDA, min_tail_tokens=100):
+    """
+    Selects documents for a prompt within token_budget.
+    scored_docs is a list of (Document, relevance) with higher relevance being better.
+    Documents are picked by maximal marginal relevance (word-set Jaccard as the
+    redundancy measure), text overlapping an already picked chunk is trimmed away,
+    and the last document is cut to fit the remaining budget.
+    """
+    candidates = []
+    for doc, relevance in scored_docs:
+        if doc.page_content.strip():
+            candidates.append((doc, float(relevance), set(re.findall(r"\w+", doc.page_content.lower()))))
+
+    packed, packed_words, used_tokens = [], [], 0
+    while candidates and used_tokens < token_budget:
+        def marginal_relevance(candidate):
+            redundancy = max((len(candidate[2] & words) / max(len(candidate[2] | words), 1) for words in packed_words), default=0.0)
+            return mmr_lambda * candidate[1] - (1 - mmr_lambda) * redundancy
+        best = max(candidates, key=marginal_relevance)
+        candidates.remove(best)
+        doc, _, words = best
+
+        text = doc.page_content
+        for packed_doc in packed:
+            text = _trim_overlap(packed_doc.page_content, text)
+            if not text:
+                break
+        if estimate_tokens(text) < 10:
+            continue
+
+        remaining = token_budget - used_tokens
+        if estimate_tokens(text) > remaining:
+            if remaining < min_tail_tokens:
+                break
+            text = _truncate_to_tokens(text, remaining)
+        packed.append(TextDocument(page_content=text, metadata=doc.metadata))
+        packed_words.append(words)
+        used_tokens += estimate_tokens(text)
+    return packed
+
+def scored_search(vector_db, query, k, source=None):
+    """
+    Similarity search returning (Document, relevance) pairs, relevance in (0, 1] with higher
+    being better. source restricts the search to the chunks of one material file.
+    """
+    # FAISS returns distances; the built-in relevance normalisation can go negative for unnormalised vectors
+    with span("similarity_search", k=k):
+        if source is None:
+            results = vector_db.similarity_search_with_score(query, k=k)
+        else:
+            # The flat index scores every vector anyway, so filtering all of them costs no extra search
+            results = vector_db.similarity_search_with_score(query, k=k, filter={"source": source},
+                                                             fetch_k=vector_db.index.ntotal)
+        return [(doc, 1.0 / (1.0 + float(distance))) for doc, distance in results]
+
+def retrieve_stratified_docs(vector_db, token_budget=GENERATION_CONTEXT_TOKEN_BUDGET, source=None, rng=None):
+    """
+    Picks generation context across the whole chapter without a similarity search: the
+    chunk clusters computed at index time are visited in random order, one random chunk
+    of a cluster per turn, so each prompt samples every part of the chapter. rng (a
+    random.Random) makes the draw repeatable. Returns None when the index has no clusters.
+    """
+    rng = rng or random
+    chunk_table = getattr(vector_db, "chunk_table", None)
+    cluster_chunks = get_cluster_chunks(chunk_table, source) if chunk_table else {}
+    if not cluster_chunks:
+        return None
+    queue = [rng.sample(chunk_ids, len(chunk_ids)) for chunk_ids in cluster_chunks.values()]
+    rng.shuffle(queue)
+    drawn = []
+    with span("stratified_retrieval", clusters=len(queue)):
+        while queue and len(drawn) < GENERATION_STRATIFIED_K:
+            chunk_ids = queue.pop(0)
+            drawn.append(chunk_ids.pop())
+            if chunk_ids:
+                queue.append(chunk_ids)
+        docs = get_chunk_docs(vector_db, drawn)
+    # Earlier draws rank higher, so every cluster keeps a chunk when space runs out
+    return pack_context([(doc, 1.0 / (1 + rank)) for rank, doc in enumerate(docs)], token_budget)
+
+def get_chunk_docs(vector_db, chunk_ids):
+    """Looks up documents by chunk id, in one round trip when the store is remote."""
+    if hasattr(vector_db, "get_documents"):
+        return vector_db.get_documents(chunk_ids)
+    return [vector_db.docstore.search(vector_db.index_to_docstore_id[chunk_id]) for chunk_id in chunk_ids]
+
+def get_draw_rng(vector_db, attempt, *request):
+    """
+    Returns the random.Random of a generation draw, seeded by the index version, the request
+    and attempt, the number of the request among the session's generation requests (kept in
+    session_state by the frontend). A repeated request draws other chunks, while the same
+    request with the same attempt draws the same ones.
+    """
+    return random.Random(hash_key(getattr(vector_db, "index_version", None), request, attempt))
+
+def retrieve_generation_docs(vector_db, retrieval_queries, token_budget=GENERATION_CONTEXT_TOKEN_BUDGET, source=None,
+                             attempt=0):
+    """
+    Picks generation context by stratified sampling over the chunk clusters, packed within
+    token_budget. Indexes built without clusters retrieve for one of the random generation queries.
+    The draw is seeded by get_draw_rng(), so each new attempt samples other clusters.
+    """
+    rng = get_draw_rng(vector_db, attempt, source, retrieval_queries, token_budget)
+    docs = retrieve_stratified_docs(vector_db, token_budget, source, rng)
+    if docs is not None:
+        return docs
+    random_query = rng.choice(retrieval_queries)
+    scored_docs = scored_search(vector_db, random_query, GENERATION_RETRIEVAL_K, source)
+    return pack_context(scored_docs, token_budget)
+
+def retrieve_generation_context(vector_db, retrieval_queries, token_budget=GENERATION_CONTEXT_TOKEN_BUDGET, source=None,
+                                attempt=0):
+    """Returns the context of retrieve_generation_docs() as one string."""
+    docs_for_context = retrieve_generation_docs(vector_db, retrieval_queries, token_budget, source, attempt)
+    return "\n\n".join(doc.page_content for doc in docs_for_context)
+
+# Topic weights of adaptive quizzes: a topic is drawn in proportion to how often it is
+# answered wrongly, topics never asked get a fixed weight so they get covered too
+ADAPTIVE_UNSEEN_TOPIC_WEIGHT = 0.6
+ADAPTIVE_MIN_TOPIC_WEIGHT = 0.05
+
+def get_topic_weights(topic_chunks, topic_stats):
+    """Returns {topic: weight} for the topics of an index from the stored per-topic progress."""
+    accuracy = {row["topic"]: row["recent_accuracy"] for row in topic_stats}
+    return {topic: (ADAPTIVE_MIN_TOPIC_WEIGHT + 1.0 - accuracy[topic]) if topic in accuracy else ADAPTIVE_UNSEEN_TOPIC_WEIGHT
+            for topic in topic_chunks}
+
+def retrieve_adaptive_docs(vector_db, topic_stats, token_budget=GENERATION_CONTEXT_TOKEN_BUDGET, rng=None, attempt=0):
+    """
+    Picks quiz context by topic instead of by similarity search: topics are drawn by
+    get_topic_weights() and a random chunk of each drawn topic is looked up by id.
+    Unless rng (a random.Random) is given, the draw is seeded by get_draw_rng() with attempt,
+    the topic accuracies and the budget, so a retaken quiz draws other chunks.
+    Returns None when the index has no topic labels.
+    """
+    chunk_table = getattr(vector_db, "chunk_table", None)
+    topic_chunks = get_topic_chunks(chunk_table) if chunk_table else {}
+    if not topic_chunks:
+        return None
+    rng = rng or get_draw_rng(vector_db, attempt, [(row["topic"], row["recent_accuracy"]) for row in topic_stats], token_budget)
+    weights = get_topic_weights(topic_chunks, topic_stats)
+    remaining = {topic: rng.sample(chunk_ids, len(chunk_ids)) for topic, chunk_ids in topic_chunks.items()}
+    drawn = []
+    with span("adaptive_retrieval", topics=len(topic_chunks)):
+        while remaining and len(drawn) < GENERATION_RETRIEVAL_K:
+            topic = rng.choices(list(remaining), weights=[weights[t] for t in remaining])[0]
+            drawn.append(remaining[topic].pop())
+            if not remaining[topic]:
+                del remaining[topic]
+        docs = get_chunk_docs(vector_db, drawn)
+    # Earlier draws rank higher, so the packer keeps the most wanted topics when space runs out
+    return pack_context([(doc, 1.0 / (1 + rank)) for rank, doc in enumerate(docs)], token_budget)
+
+def get_doc_topics(docs, vector_db):
+    """Returns the distinct topic labels of documents, in order."""
+    chunk_table = getattr(vector_db, "chunk_table", None)
+    if not chunk_table:
+        return []
+    topics = [get_chunk_topic(chunk_table, doc.metadata["chunk_id"]) for doc in docs if "chunk_id" in doc.metadata]
+    return list(dict.fromkeys(topic for topic in topics if topic))
+
+def get_topic_instruction(topics):
+    """Prompt line asking the model to label questions with the index-time topics when there are some."""
+    if not topics:
+        return 'Label each question with the topic it tests (2-4 words) in "topic".'
+    return f'Label each question with the topic it tests in "topic", using exactly one of: {"; ".join(topics)}.'
+
+
+
+# ============== Chapter Summaries =================
+# Built with the index: consecutive chunks of a file are summarized in sections of up to
+# SUMMARY_SECTION_TOKENS, the sections of each file are merged SUMMARY_GROUP_SIZE at a time
+# into one summary per file, and those into one for the chapter. The nodes of a level are
+# summarized in parallel; nodes whose input is unchanged since the previous version are
+# copied from it instead. Every summarized node is an LLM call at index time;
+# CHAPTER_SUMMARIES=0 turns the tree off and generation uses raw chunks.
+CHAPTER_SUMMARIES_ENABLED = os.getenv("CHAPTER_SUMMARIES", "1") == "1"
+SUMMARY_SECTION_TOKENS = 2000
+SUMMARY_SECTION_WORDS = 80
+SUMMARY_MERGED_WORDS = 150
+SUMMARY_GROUP_SIZE = 8
+SUMMARY_WORKERS = 8
+
+def get_section_summary_prompt():
+    return PromptTemplate(
+        input_variables=["title", "text", "max_words"],
+        template="""
+        Summarize this part of a student's study material ({title}) in at most {max_words} words.
+        Keep the key concepts, definitions, facts and how they relate. Return only the summary.
+
+        Text:
+        {text}
+        """
+    )
+
+def get_merged_summary_prompt():
+    return PromptTemplate(
+        input_variables=["title", "summaries", "max_words"],
+        template="""
+        Combine these summaries of consecutive parts of "{title}" into one overview of at most {max_words} words.
+        Cover every part, keep the main topics and how they connect. Return only the overview.
+
+        Summaries:
+        {summaries}
+        """
+    )
+
+def build_summary_tree(chunks, chapter, previous=None):
+    """
+    Builds the summary tree (see backend.write_summary_tree) of the chunks of an index version.
+    previous is the tree of the version being replaced; its unchanged nodes are reused.
+    Returns (tree, number of nodes reused).
+    """
+    reusable = {node["sha256"]: node["summary"] for node in (previous or {}).get("nodes", [])}
+    nodes = []
+
+    def add_nodes(specs):
+        """Adds nodes for specs ({"level", "title", "source", "input", "job", ...}), summarizing the new ones in parallel."""
+        created, pending = [], []
+        for spec in specs:
+            digest = hashlib.sha256(f"{spec['level']}\n{spec['title']}\n{spec['input']}".encode("utf-8")).hexdigest()
+            node = {"id": len(nodes), "level": spec["level"], "title": spec["title"], "source": spec["source"],
+                    "sha256": digest, "summary": reusable.get(digest),
+                    "children": spec.get("children", []), "chunk_ids": spec.get("chunk_ids", [])}
+            nodes.append(node)
+            created.append(node)
+            if node["summary"] is None:
+                pending.append(node)
+        if pending:
+            jobs = {node["id"]: spec["job"] for node, spec in zip(created, specs) if node["summary"] is None}
+            with request_executor(SUMMARY_WORKERS) as executor:
+                summaries = executor.map(lambda node: invoke_llm("summary", *jobs[node["id"]]).strip(), pending)
+                for node, summary in zip(pending, summaries):
+                    node["summary"] = summary
+        return created
+
+    def merge_spec(level, source, title, child_ids):
+        summaries = "\n\n".join(f"{nodes[i]['title']}: {nodes[i]['summary']}" for i in child_ids)
+        return {"level": level, "title": title, "source": source, "input": summaries, "children": list(child_ids),
+                "job": (get_merged_summary_prompt(), {"title": title, "summaries": summaries, "max_words": SUMMARY_MERGED_WORDS})}
+
+    def merge_rounds(frontiers, top_level, titles):
+        """Merges each frontier (key -> node ids) in groups until one top_level node per key is left."""
+        tops = {}
+        while len(tops) < len(frontiers):
+            keyed_specs = []
+            for key, ids in frontiers.items():
+                if key in tops:
+                    continue
+                if len(ids) <= SUMMARY_GROUP_SIZE:
+                    keyed_specs.append((key, merge_spec(top_level, key, titles[key], ids)))
+                else:
+                    for part, start in enumerate(range(0, len(ids), SUMMARY_GROUP_SIZE), start=1):
+                        keyed_specs.append((key, merge_spec("group", key, f"{titles[key]}, part {part}",
+                                                            ids[start:start + SUMMARY_GROUP_SIZE])))
+            merged = {}
+            for (key, _), node in zip(keyed_specs, add_nodes([spec for _, spec in keyed_specs])):
+                if node["level"] == top_level:
+                    tops[key] = node["id"]
+                else:
+                    merged.setdefault(key, []).append(node["id"])
+            frontiers = {**frontiers, **merged}
+        return tops
+
+    sections = []
+    for chunk_id, chunk in enumerate(chunks):
+        source, tokens = chunk["metadata"]["source"], estimate_tokens(chunk["text"])
+        if not sections or sections[-1]["source"] != source or sections[-1]["tokens"] + tokens > SUMMARY_SECTION_TOKENS:
+            sections.append({"source": source, "headings": [], "chunk_ids": [], "texts": [], "tokens": 0})
+        section = sections[-1]
+        heading = chunk["metadata"].get("heading")
+        if heading and heading not in section["headings"]:
+            section["headings"].append(heading)
+        section["chunk_ids"].append(chunk_id)
+        section["texts"].append(chunk["text"])
+        section["tokens"] += tokens
+
+    section_specs = []
+    for section in sections:
+        headings = section["headings"]
+        title = (headings[0] if len(headings) == 1 else f"{headings[0]} – {headings[-1]}" if headings
+                 else f"{section['source']}, part {len([s for s in section_specs if s['source'] == section['source']]) + 1}")
+        text = "\n\n".join(section["texts"])
+        section_specs.append({"level": "section", "title": title, "source": section["source"], "input": text,
+                              "chunk_ids": section["chunk_ids"],
+                              "job": (get_section_summary_prompt(), {"title": title, "text": text, "max_words": SUMMARY_SECTION_WORDS})})
+    file_frontiers = {}
+    for node in add_nodes(section_specs):
+        file_frontiers.setdefault(node["source"], []).append(node["id"])
+    file_nodes = merge_rounds(file_frontiers, "file", {source: source for source in file_frontiers})
+    root = merge_rounds({None: [file_nodes[source] for source in file_frontiers]}, "chapter", {None: chapter})[None]
+    reused = sum(1 for node in nodes if reusable.get(node["sha256"]) is not None)
+    return {"root": root, "nodes": nodes}, reused
+
+def get_summary_context(vector_db, source=None, token_budget=GENERATION_CONTEXT_TOKEN_BUDGET):
+    """
+    Returns a compact outline of the chapter, or of one of its material files, from its
+    summary tree: the chapter or file summary, the file summaries, then the section
+    summaries (every n-th one when they do not all fit token_budget).
+    Returns None when the index has no summary tree.
+    """
+    tree = getattr(vector_db, "summary_tree", None)
+    if not tree:
+        return None
+    if source is None:
+        top = [tree["nodes"][tree["root"]]] + get_summary_nodes(tree, "file")
+    else:
+        top = get_summary_nodes(tree, "file", source)
+        if not top:
+            return None
+    parts = [f"{node['title']}: {node['summary']}" for node in top]
+    sections = [f"- {node['title']}: {node['summary']}" for node in get_summary_nodes(tree, "section", source)]
+    remaining = token_budget - sum(estimate_tokens(part) for part in parts)
+    section_tokens = sum(estimate_tokens(section) for section in sections)
+    if sections and section_tokens > remaining > 0:
+        sections = sections[::math.ceil(section_tokens / remaining)]
+    elif remaining <= 0:
+        sections = []
+    return "\n\n".join(parts + ["\n".join(sections)] if sections else parts)
+
+
+
+# ================ LLM Invocation =================
+_routing_stats = {"loaded_at": None, "stats": {}}
+
+def _get_routing_stats():
+    """Usage statistics keyed by (task, profile, provider, model), reloaded every ROUTING_STATS_TTL seconds."""
+    now = time.monotonic()
+    if _routing_stats["loaded_at"] is None or now - _routing_stats["loaded_at"] > ROUTING_STATS_TTL:
+        _routing_stats["stats"] = {(row["task"], row["profile"], row["provider"], row["model"]): row
+                                   for row in get_llm_task_stats()}
+        _routing_stats["loaded_at"] = now
+    return _routing_stats["stats"]
+
+def route_task(task):
+    """Returns (profile name, fallback profile name or None) for a task, using the usage statistics."""
+    _, routes = get_model_routing()
+    route = routes.get(task, {"profile": DEFAULT_MODEL_PROFILE})
+    profile_name, fallback = route["profile"], route.get("fallback")
+    if not fallback or random.random() < ROUTING_PROBE_RATE:
+        return profile_name, fallback
+
+    profile = get_model_profile(profile_name)
+    stats = _get_routing_stats().get((task, profile_name, profile["provider"], profile["model"]))
+    if stats and stats["calls"] >= ROUTING_MIN_CALLS and (
+            stats["recent_seconds"] > route.get("max_mean_seconds", float("inf"))
+            or stats["recent_error_rate"] > route.get("max_error_rate", 1.0)):
+        return fallback, None
+    return profile_name, fallback
+
+def estimate_llm_cost(model, prompt_tokens, output_tokens):
+    """Estimated USD cost of one call; 0 for models without a price (local, fake)."""
+    prompt_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + output_tokens * output_price) / 1_000_000
+
+def _invoke_profile(task, profile_name, prompt_text):
+    profile = get_model_profile(profile_name)
+    prompt_tokens = estimate_tokens(prompt_text)
+    start = time.perf_counter()
+    with span(f"llm.{task}", profile=profile_name) as llm_span:
+        try:
+            response = get_llm(profile_name).invoke(prompt_text)
+        except Exception:
+            record_llm_call(task, profile_name, profile["provider"], profile["model"],
+                            time.perf_counter() - start, prompt_tokens, error=True)
+            count("llm_errors", task=task, profile=profile_name)
+            raise
+        text = response.content if isinstance(response.content, str) else str(response.content)
+        output_tokens = estimate_tokens(text)
+        llm_span.set(prompt_tokens=prompt_tokens, output_tokens=output_tokens)
+    record_llm_call(task, profile_name, profile["provider"], profile["model"], time.perf_counter() - start,
+                    prompt_tokens, output_tokens, estimate_llm_cost(profile["model"], prompt_tokens, output_tokens))
+    count("llm_calls", task=task, profile=profile_name)
+    count("llm_prompt_tokens", prompt_tokens, task=task)
+    count("llm_output_tokens", output_tokens, task=task)
+    return text
+
+# Calls in flight, keyed by (task, prompt). Streamlit runs every session on a thread of
+# the same process, so sessions asking the same thing at once share one model call.
+_inflight_calls = {}
+_inflight_lock = threading.Lock()
+
+def single_flight(key, func):
+    """
+    Runs func() once for all concurrent callers with the same key: the first caller
+    runs it, later ones wait and get the same result (or exception).
+    """
+    with _inflight_lock:
+        future = _inflight_calls.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight_calls[key] = Future()
+    if not leader:
+        count("llm_coalesced", task=key[0])
+        with span("llm.wait_in_flight"):
+            return future.result()
+
+    try:
+        result = func()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            del _inflight_calls[key]
+
+def invoke_llm(task, prompt, inputs=None):
+    """
+    Sends one prompt to the model routed for task ("chat", "quiz", "grading", ...) and
+    returns the response text. prompt is a PromptTemplate filled from inputs, or a ready
+    string. Identical prompts already in flight are not sent again, see single_flight(), and
+    tasks whose route has a "cache_ttl" (seconds) answer repeated prompts from the shared cache.
+    """
+    prompt_text = prompt.format(**inputs) if inputs is not None else prompt
+    return single_flight((task, prompt_text), lambda: _invoke_cached(task, prompt_text))
+
+_NOT_CACHED = object()
+
+def _invoke_cached(task, prompt_text):
+    _, routes = get_model_routing()
+    route = routes.get(task, {"profile": DEFAULT_MODEL_PROFILE})
+    if not route.get("cache_ttl"):
+        return _invoke_routed(task, prompt_text)[0]
+    profile = get_model_profile(route["profile"])
+    cache, namespace = get_shared_cache(), f"llm/{task}"
+    key = hash_key(profile["model"], profile["temperature"], prompt_text)
+    response = cache.get(namespace, key, _NOT_CACHED)
+    if response is _NOT_CACHED:
+        response, served_by = _invoke_routed(task, prompt_text)
+        # Only answers of the route's own profile are stored under its key
+        if served_by == route["profile"]:
+            cache.set(namespace, key, response, route["cache_ttl"])
+    return response
+
+def _invoke_routed(task, prompt_text):
+    """
+    Calls the profile routed for task, retrying once on its fallback profile.
+    Returns (response, name of the profile that answered).
+    """
+    profile_name, fallback = route_task(task)
+    try:
+        return _invoke_profile(task, profile_name, prompt_text), profile_name
+    except Exception:
+        if not fallback:
+            raise
+        return _invoke_profile(task, fallback, prompt_text), fallback
 
 
 
 # ================ AI Chat Functionality =================
-def get_conversation_chain():
+def get_conversation_prompt():
     prompt = """You are an advanced Retrieval-Augmented Generation (RAG) assistant. Your role is to answer user questions naturally by combining retrieved context with your own reasoning and knowledge. Follow these guidelines:
                     ### 🔹 1. Using Context
                     - Never make up information.  
@@ -177,6 +1538,9 @@ def get_conversation_chain():
                     **Context (if any):**  
                     {context}  
 
+                    **Conversation so far (if any):**  
+                    {history}  
+
                     **Question:**  
                     {question}  
 
@@ -184,32 +1548,110 @@ def get_conversation_chain():
 
     """
 
-    model = get_llm()
-    prompt = PromptTemplate(template=prompt, input_variables=['context', 'question'])
+    return PromptTemplate(template=prompt, input_variables=['context', 'history', 'question'])
+
+def get_chat_response(user_input, vector_db, memory=None):
+    """
+    Answers a question from the retrieved context and returns (answer, citations).
+    memory is the conversation memory from update_chat_memory(); it is added to the
+    prompt and used to resolve follow-ups. citations come from get_citations().
+    """
+    memory = memory or {"summary": "", "turns": []}
+    docs = []
+    if vector_db:
+        # Follow-ups like "explain that again" only retrieve well together with the previous question
+        previous_questions = [turn["content"] for turn in memory["turns"] if turn["role"] == "user"][-1:]
+        retrieval_query = "\n".join(previous_questions + [user_input])
+        scored_docs = scored_search(vector_db, retrieval_query, CHAT_RETRIEVAL_K)
+        docs = pack_context(scored_docs, CHAT_CONTEXT_TOKEN_BUDGET)
+
+    response = invoke_llm("chat", get_conversation_prompt(), {
+        "context": "\n\n".join(doc.page_content for doc in docs),
+        "history": format_chat_memory(memory),
+        "question": user_input,
+    })
+    if not response:
+        return "Sorry, I couldn't find an answer.", []
+    return response, get_citations(docs, vector_db)
+
+
+# ---------------- Conversation memory ----------------
+# The memory sent with each question is a rolling summary of older turns plus the
+# most recent turns verbatim. Turns that fall out of the window are folded into the
+# summary with one small LLM call, so the full transcript is never resent.
+CHAT_MEMORY_TOKEN_BUDGET = 1500
+CHAT_MEMORY_MAX_TURNS = 6
+CHAT_MEMORY_TURN_TOKENS = 300
+CHAT_MEMORY_SUMMARY_TOKENS = 400
+# Evicted turns kept for the next update when summarizing them fails
+CHAT_MEMORY_MAX_PENDING_TURNS = 20
+
+def format_chat_memory(memory):
+    """Renders conversation memory as plain text for a prompt."""
+    parts = []
+    if memory.get("summary"):
+        parts.append(f"Summary of earlier conversation: {memory['summary']}")
+    for turn in memory.get("turns", []):
+        speaker = "Student" if turn["role"] == "user" else "Assistant"
+        parts.append(f"{speaker}: {turn['content']}")
+    return "\n".join(parts)
+
+def summarize_chat_turns(summary, turns):
+    """Folds turns into the running summary and returns the new summary."""
+    summary_prompt = PromptTemplate(
+        input_variables=["summary", "turns", "max_words"],
+        template="""
+        You maintain a running summary of a tutoring conversation between a student and an assistant.
+        Update the summary with the new turns. Keep the topics discussed, facts the student was told,
+        and anything the student struggled with. Use at most {max_words} words and return only the summary.
+
+        Current summary:
+        {summary}
 
-    chain = load_qa_chain(model, prompt=prompt, chain_type="stuff")
+        New turns:
+        {turns}
+        """
+    )
+    response = invoke_llm("summary", summary_prompt, {
+        "summary": summary or "(empty)",
+        "turns": format_chat_memory({"turns": turns}),
+        "max_words": CHAT_MEMORY_SUMMARY_TOKENS * 3 // 4,
+    })
+    return _truncate_to_tokens(response.strip(), CHAT_MEMORY_SUMMARY_TOKENS)
 
-    return chain
+def update_chat_memory(memory, user_input, response):
+    """
+    Adds a question/answer pair to the memory and summarizes turns that no longer fit.
+    If the summary call fails, the evicted turns stay in memory["pending"] and are
+    summarized with the next update.
+    """
+    memory = memory or {"summary": "", "turns": []}
+    turns = memory["turns"] + [
+        {"role": "user", "content": _truncate_to_tokens(user_input, CHAT_MEMORY_TURN_TOKENS)},
+        {"role": "assistant", "content": _truncate_to_tokens(response, CHAT_MEMORY_TURN_TOKENS)},
+    ]
 
-def get_chat_response(user_input, vector_db):
-    if not GOOGLE_API_KEY:
-        raise ValueError("GOOGLE_API_KEY environment variable is missing.")
+    def memory_tokens():
+        return estimate_tokens(memory["summary"]) + sum(estimate_tokens(turn["content"]) for turn in turns)
 
-    chain = get_conversation_chain()
-    docs = vector_db.similarity_search(user_input) if vector_db else []
+    evicted = []
+    while len(turns) > 2 and (len(turns) > CHAT_MEMORY_MAX_TURNS or memory_tokens() > CHAT_MEMORY_TOKEN_BUDGET):
+        evicted.extend(turns[:2])
+        turns = turns[2:]
 
-    if docs:
-        response = chain(
-            {"input_documents": docs, "question": user_input},
-            return_only_outputs=True
-        )
-        return response.get("output_text", "Sorry, I couldn't find an answer.")
-    else:
-        response = chain(
-            {"input_documents": [], "question": user_input},
-            return_only_outputs=True
-        )
-        return response.get("output_text", "Sorry, I couldn't find an answer.")
+    evicted = memory.get("pending", []) + evicted
+    summary, pending = memory["summary"], []
+    if evicted:
+        try:
+            summary = summarize_chat_turns(summary, evicted)
+        except Exception as e:
+            # The answer was already given; keep the turns and fold them in next time
+            print(f"Chat memory summary failed, {len(evicted)} turns kept for the next update: {e}")
+            count("chat_memory_summary_failures")
+            pending = evicted[-CHAT_MEMORY_MAX_PENDING_TURNS:]
+            if len(pending) < len(evicted):
+                count("chat_memory_dropped_turns", len(evicted) - len(pending))
+    return {"summary": summary, "turns": turns, "pending": pending}
 
 
 
@@ -244,7 +1686,12 @@ def create_question(question_data: dict, idx: int):
 
     return score_increment, question_increment, quiz_end
 
-def generate_quiz_from_faiss(vector_db, num_questions: int = 5):
+def generate_quiz_from_faiss(vector_db, num_questions: int = 5, topic_stats=None, attempt=0):
+    """
+    Generates multiple-choice questions. With topic_stats (rows of get_topic_progress())
+    the context is drawn by topic, favouring the topics answered worst so far. attempt
+    seeds the context draw, see get_draw_rng().
+    """
     if vector_db is None:
         st.error("Vector database not found. Please upload a PDF first.")
         return []
@@ -256,19 +1703,13 @@ def generate_quiz_from_faiss(vector_db, num_questions: int = 5):
         "What are some potential multiple-choice questions from this text?",
         "Generate a quiz that covers the essential information from the document."
     ]
-    retriever = vector_db.as_retriever(search_type="similarity", search_kwargs={"k": 20})
-    random_query = random.choice(retrieval_queries)
-    retrieved_docs = retriever.invoke(random_query)
-
-    if len(retrieved_docs) > 15:
-        docs_for_context = random.sample(retrieved_docs, 15)
-    else:
-        docs_for_context = retrieved_docs
-
-    context = " ".join([doc.page_content for doc in docs_for_context])
+    docs = retrieve_adaptive_docs(vector_db, topic_stats, attempt=attempt) if topic_stats is not None else None
+    if docs is None:
+        docs = retrieve_generation_docs(vector_db, retrieval_queries, attempt=attempt)
+    context = "\n\n".join(doc.page_content for doc in docs)
 
     quiz_prompt = PromptTemplate(
-        input_variables=["context", "num_questions"],
+        input_variables=["context", "num_questions", "topic_instruction"],
         template="""
         You are an expert quiz generator. Using the provided context, generate {num_questions} multiple-choice questions.
         Introduce variety and randomness in the phrasing of your questions to ensure they are not repetitive.
@@ -282,13 +1723,15 @@ def generate_quiz_from_faiss(vector_db, num_questions: int = 5):
         - Clearly specify the correct option.
         - Return ONLY valid JSON (no markdown, no extra text).
         - DO NOT indicate option number like 1,2,3,4. Just return the option text.
+        - {topic_instruction}
 
         Example output format:
         [
           {{
             "question": "Sample question?",
             "options": ["Option A", "Option B", "Option C", "Option D"],
-            "correct_option": "Option A"
+            "correct_option": "Option A",
+            "topic": "Sample topic"
           }}
         ]
 
@@ -297,13 +1740,15 @@ def generate_quiz_from_faiss(vector_db, num_questions: int = 5):
         """
     )
 
-    llm = get_llm()
-    chain = quiz_prompt | llm
-    response = chain.invoke({"context": context, "num_questions": num_questions})
+    response = invoke_llm("quiz", quiz_prompt, {
+        "context": context, "num_questions": num_questions,
+        "topic_instruction": get_topic_instruction(get_doc_topics(docs, vector_db)),
+    })
 
     try:
-        cleaned_response = response.content.strip().replace("```json", "").replace("```", "")  # type: ignore
-        quiz_data = json.loads(cleaned_response)
+        with span("parse_json.quiz"):
+            cleaned_response = response.strip().replace("```json", "").replace("```", "")
+            quiz_data = json.loads(cleaned_response)
 
         if isinstance(quiz_data, list):
             random.shuffle(quiz_data)
@@ -321,7 +1766,7 @@ def generate_quiz_from_faiss(vector_db, num_questions: int = 5):
 
 
 # ================= Flashcards Functionality =================
-def generate_flashcards_from_faiss(vector_db, num_flashcards: int = 5):
+def generate_flashcards_from_faiss(vector_db, num_flashcards: int = 5, attempt=0):
     if vector_db is None:
         st.error("Vector database not found. Please upload a PDF first.")
         return []
@@ -333,16 +1778,7 @@ def generate_flashcards_from_faiss(vector_db, num_flashcards: int = 5):
         "What are some potential flashcards from this text?",
         "Generate flashcards that cover the essential information from the document."
     ]
-    retriever = vector_db.as_retriever(search_type="similarity", search_kwargs={"k": 20})
-    random_query = random.choice(retrieval_queries)
-    retrieved_docs = retriever.invoke(random_query)
-
-    if len(retrieved_docs) > 15:
-        docs_for_context = random.sample(retrieved_docs, 15)
-    else:
-        docs_for_context = retrieved_docs
-
-    context = " ".join([doc.page_content for doc in docs_for_context])
+    context = retrieve_generation_context(vector_db, retrieval_queries, attempt=attempt)
 
     flashcard_prompt = PromptTemplate(
         input_variables=["context", "num_flashcards"],
@@ -368,13 +1804,12 @@ def generate_flashcards_from_faiss(vector_db, num_flashcards: int = 5):
         """
     )
 
-    llm = get_llm()
-    chain = flashcard_prompt | llm
-    response = chain.invoke({"context": context, "num_flashcards": num_flashcards})
+    response = invoke_llm("flashcards", flashcard_prompt, {"context": context, "num_flashcards": num_flashcards})
 
     try:
-        cleaned_response = response.content.strip().replace("```json", "").replace("```", "") # type: ignore
-        flashcard_data = json.loads(cleaned_response)
+        with span("parse_json.flashcards"):
+            cleaned_response = response.strip().replace("```json", "").replace("```", "")
+            flashcard_data = json.loads(cleaned_response)
 
         if isinstance(flashcard_data, list):
             random.shuffle(flashcard_data)
@@ -389,9 +1824,135 @@ def generate_flashcards_from_faiss(vector_db, num_flashcards: int = 5):
 
 
 # ================= Mind Map Functionality =================
-def generate_mindmap_from_faiss(vector_db):
+MINDMAP_SHAPES = (("((", "))"), ("))", "(("), ("{{", "}}"), ("(", ")"), ("[", "]"), (")", "("))
+MINDMAP_NODE_PATTERN = re.compile(r"^[\w-]*\s*(\(\(|\)\)|\{\{|\(|\[|\))(.*?)(\)\)|\(\(|\}\}|\)|\]|\()$")
+MINDMAP_UNSAFE_CHARS = re.compile(r"[()\[\]{}\"`]")
+# Each changed file's branch gets at least this much context, whatever the number of files
+MINDMAP_BRANCH_TOKEN_BUDGET = 3000
+MINDMAP_BRANCH_WORKERS = 8
+
+def request_executor(max_workers):
+    """Thread pool whose workers run under the caller's script context, like the request thread."""
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(max_workers=max_workers,
+                              initializer=(lambda: add_script_run_ctx(ctx=ctx)) if ctx else None)
+
+def parse_mindmap(mermaid_syntax):
+    """
+    Parses Mermaid mindmap syntax into a {"text", "shape", "children"} tree, repairing what
+    the model commonly gets wrong (code fences, tabs, brackets inside node text, several
+    roots, missing header). Raises ValueError when there is no node at all.
+    """
+    nodes = []   # (indent, node)
+    for line in mermaid_syntax.replace("\t", "    ").splitlines():
+        content = line.strip()
+        if not content or content.startswith(("```", "%%", "::icon", ":::")) or content == "mindmap":
+            continue
+        shape = ("(", ")")
+        match = MINDMAP_NODE_PATTERN.match(content)
+        if match and (match.group(1), match.group(3)) in MINDMAP_SHAPES:
+            shape, content = (match.group(1), match.group(3)), match.group(2)
+        text = " ".join(MINDMAP_UNSAFE_CHARS.sub(" ", content).split())
+        if text:
+            nodes.append((len(line) - len(line.lstrip()), {"text": text, "shape": shape, "children": []}))
+    if not nodes:
+        raise ValueError("The mind map has no nodes.")
+
+    root_indent, root = nodes[0]
+    stack = [(root_indent, root)]
+    for indent, node in nodes[1:]:
+        # Anything not indented below the root becomes a top-level branch rather than a second root
+        indent = max(indent, root_indent + 1)
+        while stack[-1][0] >= indent:
+            stack.pop()
+        stack[-1][1]["children"].append(node)
+        stack.append((indent, node))
+    return root
+
+def render_mindmap(root):
+    """Serialises a mind map tree to Mermaid syntax with consistent two-space indentation."""
+    lines = ["mindmap", f"  root(({root['text']}))"]
+
+    def add(node, depth):
+        lines.append(f"{'  ' * depth}{node['shape'][0]}{node['text']}{node['shape'][1]}")
+        for child in node["children"]:
+            add(child, depth + 1)
+
+    for child in root["children"]:
+        add(child, 2)
+    return "\n".join(lines)
+
+def clean_mindmap(mermaid_syntax):
+    """Validates and normalises model output locally. Raises ValueError if it cannot be used."""
+    return render_mindmap(parse_mindmap(mermaid_syntax))
+
+def merge_mindmap_branches(title, branches):
+    """Merges per-file mind maps under one root; a single branch is used as the whole map."""
+    trees = [parse_mindmap(branch) for branch in branches]
+    if len(trees) == 1:
+        return render_mindmap(trees[0])
+    for tree in trees:
+        tree["shape"] = ("(", ")")
+    return render_mindmap({"text": " ".join(MINDMAP_UNSAFE_CHARS.sub(" ", title).split()) or "Chapter",
+                           "shape": ("((", "))"), "children": trees})
+
+def build_chapter_mindmap(sha1_of_username, subject, chapter, vector_db, regenerate=False, attempt=0):
+    """
+    Returns the mind map of the chapter's current index version. A map stored for that
+    version is served from the DB; otherwise only the branches of material files that are
+    new or changed since the last stored map are generated, in parallel, then merged and stored.
+    regenerate=True generates every branch again; attempt seeds the context draws, see
+    get_draw_rng(). Returns None if generation failed; the
+    branches that were generated are stored anyway, so a retry only generates the rest.
     """
-    Generates a mind map in Mermaid syntax based on the content of a FAISS vector store.
+    version = get_current_index_version(sha1_of_username, subject, chapter)
+    stored = get_chapter_mindmap(sha1_of_username, subject, chapter, version)
+    if stored and stored["mermaid"] and not regenerate:
+        return stored["mermaid"]
+
+    files = (read_index_manifest(sha1_of_username, subject, chapter, version) or {}).get("files")
+    if not files:
+        # Legacy indexes have no manifest to tell files apart, so the map is one piece
+        mermaid_syntax = generate_mindmap_from_faiss(vector_db, attempt=attempt)
+        if mermaid_syntax:
+            save_chapter_mindmap(sha1_of_username, subject, chapter, version, mermaid_syntax, {})
+            schedule_mindmap_prerender(mermaid_syntax)
+        return mermaid_syntax
+
+    previous = {} if regenerate else (get_chapter_mindmap(sha1_of_username, subject, chapter) or {}).get("branches", {})
+    token_budget = max(GENERATION_CONTEXT_TOKEN_BUDGET // len(files), MINDMAP_BRANCH_TOKEN_BUDGET)
+    branches, missing = {}, []
+    for file in files:
+        branch = previous.get(file["name"])
+        if branch and branch["sha256"] == file["sha256"]:
+            branches[file["name"]] = branch
+        else:
+            missing.append(file)
+    with span("mindmap_branches", files=len(files), reused=len(branches)):
+        if missing:
+            with request_executor(MINDMAP_BRANCH_WORKERS) as executor:
+                generated = executor.map(
+                    lambda file: generate_mindmap_from_faiss(vector_db, source=file["name"], token_budget=token_budget,
+                                                             attempt=attempt),
+                    missing)
+                for file, mermaid_syntax in zip(missing, generated):
+                    if mermaid_syntax is not None:
+                        branches[file["name"]] = {"sha256": file["sha256"], "mermaid": mermaid_syntax}
+    count("mindmap_branches_reused", len(files) - len(missing))
+    if len(branches) < len(files):
+        # Keep what succeeded as an incomplete map of this version for the retry
+        save_chapter_mindmap(sha1_of_username, subject, chapter, version, None, branches)
+        return None
+
+    mermaid_syntax = merge_mindmap_branches(chapter, [branches[file["name"]]["mermaid"] for file in files])
+    save_chapter_mindmap(sha1_of_username, subject, chapter, version, mermaid_syntax, branches)
+    schedule_mindmap_prerender(mermaid_syntax)
+    return mermaid_syntax
+
+def generate_mindmap_from_faiss(vector_db, source=None, token_budget=GENERATION_CONTEXT_TOKEN_BUDGET, attempt=0):
+    """
+    Generates a mind map in Mermaid syntax based on the content of a FAISS vector store,
+    or of one material file of it when source is given.
     """
     if vector_db is None:
         st.error("Vector database not found. Please upload and process your materials first.")
@@ -406,14 +1967,9 @@ def generate_mindmap_from_faiss(vector_db):
         "Create a high-level overview of the material, focusing on structure and key terms."
     ]
     
-    # Retrieve relevant documents from the vector store
-    retriever = vector_db.as_retriever(search_type="similarity", search_kwargs={"k": 20})
-    random_query = random.choice(retrieval_queries)
-    retrieved_docs = retriever.invoke(random_query)
-
-    # Use a sample of the retrieved docs to form the context
-    docs_for_context = random.sample(retrieved_docs, min(len(retrieved_docs), 15))
-    context = " ".join([doc.page_content for doc in docs_for_context])
+    # The precomputed summaries outline the whole material; older indexes pack raw chunks instead
+    context = get_summary_context(vector_db, source, token_budget) or \
+        retrieve_generation_context(vector_db, retrieval_queries, token_budget, source, attempt)
 
     # Create a prompt template that instructs the LLM to generate Mermaid syntax
     mindmap_prompt = PromptTemplate(
@@ -479,30 +2035,29 @@ def generate_mindmap_from_faiss(vector_db):
         # """
     )
 
-    # Get the LLM and create the chain
-    llm = get_llm()
-    chain = mindmap_prompt | llm
-    
     try:
-        # Invoke the chain and get the response
-        response = chain.invoke({"context": context})
-        
-        # Clean the response content to ensure it's just the Mermaid syntax
-        mermaid_syntax = response.content.strip() # type: ignore
+        # Invoke the model and get the response
+        response = invoke_llm("mindmap", mindmap_prompt, {"context": context})
         
-        if mermaid_syntax.lstrip().startswith("mindmap"):
-            return mermaid_syntax
-        else:
+        # Validate and repair the Mermaid syntax locally instead of asking the model again
+        try:
+            with span("validate_mindmap"):
+                return clean_mindmap(response)
+        except ValueError:
             st.error("The model returned an invalid format for the mind map. Please try regenerating.")
             return None
-            
+
     except Exception as e:
         st.error(f"An error occurred while generating the mind map: {e}")
         return None
 
 
 # ===================== Exam Funcationality =====================
-def generate_exam_from_faiss(vector_db, total_score: int, num_questions: int = 5):
+# Context split of exams on indexes with a summary tree
+EXAM_OUTLINE_TOKEN_BUDGET = 1500
+EXAM_DETAIL_TOKEN_BUDGET = 3000
+
+def generate_exam_from_faiss(vector_db, total_score: int, num_questions: int = 5, attempt=0):
     if vector_db is None:
         st.error("Vector database not found. Please upload a PDF first.")
         return []
@@ -514,19 +2069,17 @@ def generate_exam_from_faiss(vector_db, total_score: int, num_questions: int = 5
         "Generate an exam that covers the essential information from the document.",
         "What are some potential exam questions from this text?"
     ]
-    retriever = vector_db.as_retriever(search_type="similarity", search_kwargs={"k": 20})
-    random_query = random.choice(retrieval_queries)
-    retrieved_docs = retriever.invoke(random_query)
-
-    if len(retrieved_docs) > 15:
-        docs_for_context = random.sample(retrieved_docs, 15)
+    outline = get_summary_context(vector_db, token_budget=EXAM_OUTLINE_TOKEN_BUDGET)
+    if outline:
+        # Broad questions come from the chapter outline, answers from a smaller sample of chunks
+        docs = retrieve_generation_docs(vector_db, retrieval_queries, EXAM_DETAIL_TOKEN_BUDGET, attempt=attempt)
+        context = f"Chapter outline:\n{outline}\n\nDetails:\n" + "\n\n".join(doc.page_content for doc in docs)
     else:
-        docs_for_context = retrieved_docs
-
-    context = " ".join([doc.page_content for doc in docs_for_context])
+        docs = retrieve_generation_docs(vector_db, retrieval_queries, attempt=attempt)
+        context = "\n\n".join(doc.page_content for doc in docs)
 
     exam_prompt = PromptTemplate(
-        input_variables=["context", "num_questions", "total_score"],
+        input_variables=["context", "num_questions", "total_score", "topic_instruction"],
         template="""
         You are an expert exam generator. Using the provided context, generate {num_questions} subjective questions with total marks of {total_score}.
         Introduce variety and randomness in the phrasing of your questions to ensure they are not repetitive.
@@ -540,13 +2093,15 @@ def generate_exam_from_faiss(vector_db, total_score: int, num_questions: int = 5
         - Vary the style, structure, and order of your questions so they are not repetitive.
         - Randomize phrasing and avoid predictable patterns.
         - Return ONLY valid JSON (no markdown, no extra text).
+        - {topic_instruction}
 
         Example output format:
         [
           {{
             "question": "Sample question?",
-            "answer": "Answer text here."
-            "score": 1.5
+            "answer": "Answer text here.",
+            "score": 1.5,
+            "topic": "Sample topic"
           }}
         ]
 
@@ -555,13 +2110,15 @@ def generate_exam_from_faiss(vector_db, total_score: int, num_questions: int = 5
         """
     )
 
-    llm = get_llm()
-    chain = exam_prompt | llm
-    response = chain.invoke({"context": context, "num_questions": num_questions, "total_score": total_score})
+    response = invoke_llm("exam", exam_prompt, {
+        "context": context, "num_questions": num_questions, "total_score": total_score,
+        "topic_instruction": get_topic_instruction(get_doc_topics(docs, vector_db)),
+    })
 
     try:
-        cleaned_response = response.content.strip().replace("```json", "").replace("```", "") # type: ignore
-        exam_data = json.loads(cleaned_response)
+        with span("parse_json.exam"):
+            cleaned_response = response.strip().replace("```json", "").replace("```", "")
+            exam_data = json.loads(cleaned_response)
 
         if isinstance(exam_data, list):
             random.shuffle(exam_data)
@@ -595,8 +2152,8 @@ def create_exam_question(question:str, idx: int):
                 
     return question_increment, exam_end
 
+@traced("evaluate_exam")
 def evaluate_exam(exam_answer, user_answer, marks):
-    llm = get_llm()
     prompt = PromptTemplate(
         input_variables=["exam_answer", "user_answer", "marks"],
         template="""
@@ -648,8 +2205,7 @@ def evaluate_exam(exam_answer, user_answer, marks):
         """
     )
 
-    chain = prompt | llm
-    response = chain.invoke({
+    response = invoke_llm("grading", prompt, {
         "exam_answer": exam_answer,
         "user_answer": user_answer,
         "marks": marks
@@ -657,7 +2213,7 @@ def evaluate_exam(exam_answer, user_answer, marks):
 
     # print(response)
     try:
-        score = float(response.content.strip()) # type: ignore
+        score = float(response.strip())
         return score
     except Exception:
         st.error("Failed to evaluate the exam answers. Please try again.")
@@ -667,10 +2223,5 @@ def evaluate_exam(exam_answer, user_answer, marks):
 
 # ================= Chat with AI (general) Functionality =================
 def get_chat_response_general(user_input):
-    if not GOOGLE_API_KEY:
-        raise ValueError("GOOGLE_API_KEY environment variable is missing.")
-
-    model = get_llm()
-    response = model.predict(user_input)
-    return response
+    return invoke_llm("general_chat", user_input)
 
@@ -1,5 +1,7 @@
 from frontend import *
 
+telemetry.configure()
+
 if "first_run" not in st.session_state:
     st.session_state.first_run = True
     setting_defaults()
@@ -13,8 +15,9 @@ st.set_page_config(
 )
 st.title("📘 AI Study Assistant")
 
-if not os.path.exists(DB_FILE):
-    init_db()
+ensure_db()
+start_maintenance_scheduler()
+start_telemetry_trace()
 
 login_or_signup_alert = st.empty()
 
@@ -53,4 +56,7 @@ else:
     with st.sidebar:
         st.markdown("---")
         logout(setting_defaults)
+        telemetry_debug_panel()
+
+telemetry.write_prometheus_file()
 
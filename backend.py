@@ -1,9 +1,18 @@
 import os
+import re
+import gzip
+import html
+import atexit
+import json
 import time
 import shutil
 import hashlib
 import sqlite3
 import datetime
+import threading
+import functools
+import itertools
+from telemetry import is_enabled as telemetry_enabled, span, count
 
 
 def get_elapsed_time(start_time):
@@ -13,12 +22,152 @@ def get_elapsed_time(start_time):
     minutes, seconds = divmod(remainder, 60)
     return f"{hours:02}:{minutes:02}:{seconds:02}"
 
+# --- Mind Map Rendering ---
+# The pinned mermaid build is vendored in ./static and checked against its sha256 whenever
+# it is downloaded again; pan and zoom come from ./static/mindmap-pan-zoom.js (our own code)
+MERMAID_VERSION = "11.12.0"
+# Streamlit serves ./static as app/static/ (server.enableStaticServing) with cache headers,
+# so the browser downloads each asset once instead of on every render
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+MINDMAP_ASSETS = {
+    "mermaid.min.js": {
+        "url": f"https://cdn.jsdelivr.net/npm/mermaid@{MERMAID_VERSION}/dist/mermaid.min.js",
+        "sha256": "07e37dfa97b337ccc85365d57eddf99b9706f09db3b59b260d0333b23b343c4b",
+    },
+}
+MINDMAP_PAN_ZOOM_SCRIPT = "mindmap-pan-zoom.js"
+# MINDMAP_CDN_FALLBACK=1 loads a missing vendored asset from the CDN, pinned by its
+# Subresource Integrity hash; off by default so mind maps never depend on the network
+MINDMAP_CDN_FALLBACK = os.getenv("MINDMAP_CDN_FALLBACK", "0") == "1"
+# Maps with more nodes than this are rendered to SVG on the server when mermaid-cli is installed
+MINDMAP_PRERENDER_NODES = 80
+MINDMAP_SVG_CACHE_DIR = os.path.join(".cache", "mindmap_svg")
+MERMAID_CLI = os.getenv("MERMAID_CLI", "mmdc")
+# mermaid-cli starts a headless browser; a render that takes longer than this is given up
+MINDMAP_PRERENDER_TIMEOUT = float(os.getenv("MINDMAP_PRERENDER_TIMEOUT", "10"))
+_prerender_executor = None
+_prerender_pending = set()
+_prerender_lock = threading.Lock()
+
+def download_mindmap_assets(target_dir=STATIC_DIR):
+    """
+    Downloads the pinned third-party builds into ./static, refusing any file whose sha256
+    differs from the pinned one. Returns the files written.
+    """
+    import urllib.request
+    os.makedirs(target_dir, exist_ok=True)
+    written = []
+    for file_name, asset in MINDMAP_ASSETS.items():
+        with urllib.request.urlopen(asset["url"], timeout=60) as response:
+            content = response.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if digest != asset["sha256"]:
+            raise ValueError(f"{asset['url']} has sha256 {digest}, expected {asset['sha256']}")
+        tmp_path = os.path.join(target_dir, f"{file_name}.tmp-{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, os.path.join(target_dir, file_name))
+        written.append(file_name)
+    return written
+
+def get_mindmap_script_tag(file_name):
+    """
+    <script> tag of a rendering asset: the vendored copy when present, the pinned CDN build
+    with its integrity hash when MINDMAP_CDN_FALLBACK is on, None otherwise.
+    """
+    if os.path.exists(os.path.join(STATIC_DIR, file_name)):
+        return f'<script src="app/static/{file_name}"></script>'
+    asset = MINDMAP_ASSETS.get(file_name)
+    if asset is None or not MINDMAP_CDN_FALLBACK:
+        return None
+    import base64
+    integrity = "sha256-" + base64.b64encode(bytes.fromhex(asset["sha256"])).decode("ascii")
+    return f'<script src="{asset["url"]}" integrity="{integrity}" crossorigin="anonymous"></script>'
+
+def _mindmap_svg_path(mindmap_content):
+    digest = hashlib.sha256(mindmap_content.encode("utf-8")).hexdigest()
+    return os.path.join(MINDMAP_SVG_CACHE_DIR, f"{digest}.svg")
+
+def prerender_mindmap_svg(mindmap_content):
+    """
+    Renders a large mind map to SVG with mermaid-cli and caches it by content hash, so the
+    browser only has to pan and zoom it. Returns the SVG path, or None when the map is small,
+    mermaid-cli is not installed or rendering failed (the browser renders it instead).
+    """
+    import subprocess
+    import tempfile
+    svg_path = _mindmap_svg_path(mindmap_content)
+    if os.path.exists(svg_path):
+        return svg_path
+    if len(mindmap_content.splitlines()) - 1 <= MINDMAP_PRERENDER_NODES or shutil.which(MERMAID_CLI) is None:
+        return None
+
+    os.makedirs(MINDMAP_SVG_CACHE_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_path = os.path.join(tmp_dir, "mindmap.mmd")
+        output_path = os.path.join(tmp_dir, "mindmap.svg")
+        with open(source_path, "w", encoding="utf-8") as f:
+            f.write(mindmap_content)
+        with span("prerender_mindmap"):
+            try:
+                subprocess.run([MERMAID_CLI, "-i", source_path, "-o", output_path, "-b", "transparent", "-q"],
+                               check=True, capture_output=True, timeout=MINDMAP_PRERENDER_TIMEOUT)
+            except (subprocess.SubprocessError, OSError) as e:
+                print(f"Mind map prerendering failed: {e}")
+                return None
+        with open(output_path, "r", encoding="utf-8") as f:
+            _write_file_atomically(svg_path, f.read())
+    return svg_path
+
+def schedule_mindmap_prerender(mindmap_content):
+    """
+    Prerenders a mind map on a background thread, so the request that generated it does not
+    wait for mermaid-cli; the browser renders the map until the SVG is cached. Returns whether
+    a render was queued.
+    """
+    global _prerender_executor
+    if len(mindmap_content.splitlines()) - 1 <= MINDMAP_PRERENDER_NODES or shutil.which(MERMAID_CLI) is None:
+        return False
+    svg_path = _mindmap_svg_path(mindmap_content)
+    with _prerender_lock:
+        if svg_path in _prerender_pending or os.path.exists(svg_path):
+            return False
+        _prerender_pending.add(svg_path)
+        if _prerender_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _prerender_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mindmap-prerender")
+
+    def render():
+        try:
+            prerender_mindmap_svg(mindmap_content)
+        except Exception as e:
+            print(f"Mind map prerendering failed: {e}")
+        finally:
+            with _prerender_lock:
+                _prerender_pending.discard(svg_path)
+    _prerender_executor.submit(render)
+    return True
+
 def get_mermaid_html(mindmap_content: str):
+    # Prerendered SVG of a large map replaces the diagram source, and mermaid is not loaded at all
+    svg_path = _mindmap_svg_path(mindmap_content)
+    if os.path.exists(svg_path):
+        with open(svg_path, "r", encoding="utf-8") as f:
+            diagram = f.read()
+        mermaid_script = ""
+    else:
+        diagram = html.escape(mindmap_content, quote=False)
+        mermaid_script = get_mindmap_script_tag("mermaid.min.js")
+    pan_zoom_script = get_mindmap_script_tag(MINDMAP_PAN_ZOOM_SCRIPT)
+    if pan_zoom_script is None or mermaid_script is None:
+        return ("<p>The mind map rendering assets are missing from static/. "
+                "Run <code>python backend.py download-assets</code> and restart the app.</p>")
+
     mermaid_html = f"""
             <html>
                 <head>
-                    <script src="https://cdn.jsdelivr.net/npm/mermaid/dist/mermaid.min.js"></script>
-                    <script src="https://cdn.jsdelivr.net/npm/svg-pan-zoom/dist/svg-pan-zoom.min.js"></script>
+                    {mermaid_script}
+                    {pan_zoom_script}
                     <style>
                         html, body {{
                             margin: 0; padding: 0; width: 100%; height: 100%;
@@ -54,41 +203,39 @@ def get_mermaid_html(mindmap_content: str):
                 </head>
                 <body>
                     <div class="mermaid">
-                        {mindmap_content}
+                        {diagram}
                     </div>
                     <script>
-                        mermaid.initialize({{ startOnLoad: true, theme: 'default' }});
-
-                        document.addEventListener("DOMContentLoaded", function() {{
-                            setTimeout(function() {{
-                                var svg = document.querySelector('.mermaid > svg');
-                                if (!svg) return;
-
-                                var nodes = svg.querySelectorAll('.node .label, .nodeLabel span');
-
-                                nodes.forEach(function(node) {{
-                                    node.style.pointerEvents = "all";
-                                    node.addEventListener('click', function(event) {{
-                                        event.stopPropagation();
-                                        var query = node.textContent.trim();
-                                        if (query) {{
-                                            if (window.confirm("Do you want to search Google for '" + query + "'?")) {{
-                                                var url = "https://www.google.com/search?q=" + encodeURIComponent(query);
-                                                window.open(url, "_blank");
-                                            }}
+                        function enableMindMap() {{
+                            var svg = document.querySelector('.mermaid > svg');
+                            if (!svg) return;
+
+                            var nodes = svg.querySelectorAll('.node .label, .nodeLabel span');
+
+                            nodes.forEach(function(node) {{
+                                node.style.pointerEvents = "all";
+                                node.addEventListener('click', function(event) {{
+                                    event.stopPropagation();
+                                    var query = node.textContent.trim();
+                                    if (query) {{
+                                        if (window.confirm("Do you want to search Google for '" + query + "'?")) {{
+                                            var url = "https://www.google.com/search?q=" + encodeURIComponent(query);
+                                            window.open(url, "_blank");
                                         }}
-                                    }});
+                                    }}
                                 }});
+                            }});
 
-                                svgPanZoom(svg, {{
-                                    zoomEnabled: true,
-                                    panEnabled: true,
-                                    controlIconsEnabled: true,
-                                    fit: true,
-                                    center: true
-                                }});
-                            }}, 1000);
-                        }});
+                            mindmapPanZoom(svg);
+                        }}
+
+                        // Wire pan/zoom as soon as mermaid has finished rendering, not after a fixed delay
+                        if (window.mermaid) {{
+                            mermaid.initialize({{ startOnLoad: false, theme: 'default' }});
+                            mermaid.run({{ querySelector: '.mermaid' }}).then(enableMindMap);
+                        }} else {{
+                            enableMindMap();
+                        }}
                     </script>
                 </body>
             </html>
@@ -99,6 +246,10 @@ def get_mermaid_html(mindmap_content: str):
 # Define the database file
 DB_FILE = "study_app.db"
 
+# init_db switches older databases up to this size to incremental auto-vacuum on start;
+# larger ones are converted with `python backend.py upgrade-db` while the app is stopped
+AUTO_VACUUM_MIGRATION_MAX_BYTES = int(os.getenv("AUTO_VACUUM_MIGRATION_MAX_MB", "64")) * 2**20
+
 def create_db_file():
     """Creates the database file if it doesn't exist."""
     if not os.path.exists(DB_FILE):
@@ -107,9 +258,38 @@ def create_db_file():
     else:
         print(f"Database file '{DB_FILE}' already exists.")
 
+@functools.lru_cache(maxsize=512)
+def _statement_name(sql):
+    """Short span name for a SQL statement, e.g. "select chat_history"."""
+    words = sql.split()
+    verb = words[0].lower() if words else "unknown"
+    match = re.search(r"\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+(\w+)", sql, re.IGNORECASE)
+    return f"{verb} {match.group(1)}" if match else verb
+
+class _TracedCursor(sqlite3.Cursor):
+    """Cursor that times every statement as a "db.<verb> <table>" span."""
+    def execute(self, sql, parameters=()):
+        with span(f"db.{_statement_name(sql)}"):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with span(f"db.{_statement_name(sql)}"):
+            return super().executemany(sql, seq_of_parameters)
+
+class _TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=_TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
 def get_db_connection():
     """Establishes a connection to the SQLite database."""
-    conn = sqlite3.connect(DB_FILE)
+    # The traced connection is only used while telemetry is on, so it costs nothing otherwise
+    conn = sqlite3.connect(DB_FILE, factory=_TracedConnection if telemetry_enabled() else sqlite3.Connection)
     conn.row_factory = sqlite3.Row  # Allows accessing columns by name
     conn.execute("PRAGMA foreign_keys = ON;") # Enforce foreign key constraints
     return conn
@@ -119,6 +299,9 @@ def init_db():
     create_db_file()
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        # Free pages are returned to the file system by the retention job (incremental_vacuum);
+        # this only takes effect on an empty database, older ones are converted below
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL;")
         
         # --- Core Tables (Unchanged) ---
         cursor.execute('''
@@ -149,6 +332,15 @@ def init_db():
             );
         ''')
         
+        # --- Per-chapter settings (embeddings the chapter is indexed with) ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chapter_settings (
+                chapter_id INTEGER PRIMARY KEY,
+                embedding TEXT NOT NULL DEFAULT 'default',
+                FOREIGN KEY (chapter_id) REFERENCES chapters (id) ON DELETE CASCADE
+            );
+        ''')
+
         # --- Chat with AI history table ---
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS chat_history (
@@ -160,10 +352,299 @@ def init_db():
                 FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
             );
         ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history (user_id, id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_timestamp ON chat_history (timestamp);")
+
+        # --- Chat messages moved out of chat_history, one row per compressed archive segment ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_archive_segments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                path TEXT UNIQUE NOT NULL,
+                first_message_id INTEGER NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                first_timestamp DATETIME,
+                last_timestamp DATETIME,
+                messages INTEGER NOT NULL,
+                raw_bytes INTEGER NOT NULL,
+                compressed_bytes INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+            );
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_archive_segments_user ON chat_archive_segments (user_id, last_message_id);")
+
+        # --- Last run of each maintenance job (claimed by one process at a time) with its stats as JSON ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance_runs (
+                task TEXT PRIMARY KEY,
+                started_at INTEGER NOT NULL DEFAULT 0,
+                finished_at INTEGER,
+                stats TEXT NOT NULL DEFAULT '{}'
+            );
+        ''')
+
+        # --- Chapter chat memory (rolling summary + recent turns as JSON) ---
+        # pending_turns holds evicted turns whose summary failed, to be folded in on the next update
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chapter_chat_memory (
+                chapter_id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                recent_turns TEXT NOT NULL DEFAULT '[]',
+                pending_turns TEXT NOT NULL DEFAULT '[]',
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (chapter_id) REFERENCES chapters (id) ON DELETE CASCADE
+            );
+        ''')
+        _add_column_if_missing(cursor, "chapter_chat_memory", "pending_turns", "TEXT NOT NULL DEFAULT '[]'")
+
+        # --- Mind maps per chapter and index version (merged map + per-file branches as JSON) ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chapter_mindmaps (
+                chapter_id INTEGER NOT NULL,
+                index_version TEXT NOT NULL,
+                mermaid TEXT NOT NULL,
+                branches TEXT NOT NULL DEFAULT '{}',
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (chapter_id, index_version),
+                FOREIGN KEY (chapter_id) REFERENCES chapters (id) ON DELETE CASCADE
+            );
+        ''')
+
+        # --- Flashcards with their spaced-repetition (SM-2) state ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS flashcards (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chapter_id INTEGER NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                repetitions INTEGER NOT NULL DEFAULT 0,
+                interval_days REAL NOT NULL DEFAULT 0,
+                ease REAL NOT NULL DEFAULT 2.5,
+                lapses INTEGER NOT NULL DEFAULT 0,
+                due_at INTEGER NOT NULL,
+                last_reviewed_at INTEGER,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+                FOREIGN KEY (chapter_id) REFERENCES chapters (id) ON DELETE CASCADE,
+                UNIQUE(chapter_id, question)
+            );
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_flashcards_chapter_due ON flashcards (chapter_id, due_at);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_flashcards_user_due ON flashcards (user_id, due_at);")
+
+        # --- Quiz and exam attempts, one row per attempt and per answered question ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS attempts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chapter_id INTEGER NOT NULL,
+                kind TEXT CHECK(kind IN ('quiz', 'exam')) NOT NULL,
+                num_questions INTEGER NOT NULL,
+                score REAL NOT NULL,
+                max_score REAL NOT NULL,
+                started_at INTEGER,
+                finished_at INTEGER NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+                FOREIGN KEY (chapter_id) REFERENCES chapters (id) ON DELETE CASCADE
+            );
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_attempts_chapter_finished ON attempts (chapter_id, finished_at);")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS attempt_answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                attempt_id INTEGER NOT NULL,
+                topic TEXT NOT NULL,
+                question TEXT NOT NULL,
+                given_answer TEXT,
+                correct_answer TEXT,
+                score REAL NOT NULL,
+                max_score REAL NOT NULL,
+                FOREIGN KEY (attempt_id) REFERENCES attempts (id) ON DELETE CASCADE
+            );
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_attempt_answers_attempt ON attempt_answers (attempt_id);")
+
+        # --- Progress aggregates, updated with every recorded attempt so dashboards never scan attempts ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chapter_progress (
+                chapter_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                questions INTEGER NOT NULL DEFAULT 0,
+                score REAL NOT NULL DEFAULT 0,
+                max_score REAL NOT NULL DEFAULT 0,
+                recent_accuracy REAL NOT NULL DEFAULT 0,
+                best_accuracy REAL NOT NULL DEFAULT 0,
+                last_attempt_at INTEGER,
+                PRIMARY KEY (chapter_id, kind),
+                FOREIGN KEY (chapter_id) REFERENCES chapters (id) ON DELETE CASCADE
+            );
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS topic_progress (
+                chapter_id INTEGER NOT NULL,
+                topic TEXT NOT NULL,
+                answered INTEGER NOT NULL DEFAULT 0,
+                score REAL NOT NULL DEFAULT 0,
+                max_score REAL NOT NULL DEFAULT 0,
+                recent_accuracy REAL NOT NULL DEFAULT 0,
+                last_seen_at INTEGER,
+                PRIMARY KEY (chapter_id, topic),
+                FOREIGN KEY (chapter_id) REFERENCES chapters (id) ON DELETE CASCADE
+            );
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_topic_progress_accuracy ON topic_progress (chapter_id, recent_accuracy);")
+
+        # --- LLM usage per task and model profile (feeds the model routing) ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS llm_task_stats (
+                task TEXT NOT NULL,
+                profile TEXT NOT NULL,
+                provider TEXT NOT NULL,
+                model TEXT NOT NULL,
+                calls INTEGER NOT NULL DEFAULT 0,
+                errors INTEGER NOT NULL DEFAULT 0,
+                total_seconds REAL NOT NULL DEFAULT 0,
+                max_seconds REAL NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                recent_seconds REAL NOT NULL DEFAULT 0,
+                recent_error_rate REAL NOT NULL DEFAULT 0,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (task, profile, provider, model)
+            );
+        ''')
+
+        # --- Full-text search (FTS5) over chat messages, flashcards and quiz/exam answers ---
+        # The indexes read their text through views that add an "owner" token (u<user id>), so a
+        # search only intersects the postings of one user; triggers keep them in sync.
+        _create_search_index(
+            cursor, "chat_history_fts", ["message"],
+            "SELECT id, 'u' || user_id AS owner, message FROM chat_history",
+            ['''
+            CREATE TRIGGER IF NOT EXISTS chat_history_fts_insert AFTER INSERT ON chat_history BEGIN
+                INSERT INTO chat_history_fts (rowid, owner, message) VALUES (new.id, 'u' || new.user_id, new.message);
+            END;
+            ''', '''
+            CREATE TRIGGER IF NOT EXISTS chat_history_fts_delete AFTER DELETE ON chat_history BEGIN
+                INSERT INTO chat_history_fts (chat_history_fts, rowid, owner, message)
+                VALUES ('delete', old.id, 'u' || old.user_id, old.message);
+            END;
+            ''', '''
+            CREATE TRIGGER IF NOT EXISTS chat_history_fts_update AFTER UPDATE OF user_id, message ON chat_history BEGIN
+                INSERT INTO chat_history_fts (chat_history_fts, rowid, owner, message)
+                VALUES ('delete', old.id, 'u' || old.user_id, old.message);
+                INSERT INTO chat_history_fts (rowid, owner, message) VALUES (new.id, 'u' || new.user_id, new.message);
+            END;
+            ''']
+        )
+        # Reviews update the SM-2 columns of a card all the time; only text changes touch the index
+        _create_search_index(
+            cursor, "flashcards_fts", ["question", "answer"],
+            "SELECT id, 'u' || user_id AS owner, question, answer FROM flashcards",
+            ['''
+            CREATE TRIGGER IF NOT EXISTS flashcards_fts_insert AFTER INSERT ON flashcards BEGIN
+                INSERT INTO flashcards_fts (rowid, owner, question, answer)
+                VALUES (new.id, 'u' || new.user_id, new.question, new.answer);
+            END;
+            ''', '''
+            CREATE TRIGGER IF NOT EXISTS flashcards_fts_delete AFTER DELETE ON flashcards BEGIN
+                INSERT INTO flashcards_fts (flashcards_fts, rowid, owner, question, answer)
+                VALUES ('delete', old.id, 'u' || old.user_id, old.question, old.answer);
+            END;
+            ''', '''
+            CREATE TRIGGER IF NOT EXISTS flashcards_fts_update AFTER UPDATE OF user_id, question, answer ON flashcards BEGIN
+                INSERT INTO flashcards_fts (flashcards_fts, rowid, owner, question, answer)
+                VALUES ('delete', old.id, 'u' || old.user_id, old.question, old.answer);
+                INSERT INTO flashcards_fts (rowid, owner, question, answer)
+                VALUES (new.id, 'u' || new.user_id, new.question, new.answer);
+            END;
+            ''']
+        )
+        # Answers take their owner from the attempt, which is already gone when a cascade deletes
+        # them, so they leave the index together with their attempt (answers are never deleted alone)
+        _create_search_index(
+            cursor, "attempt_answers_fts", ["question", "given_answer", "correct_answer"],
+            '''
+            SELECT a.id, 'u' || t.user_id AS owner, a.question, a.given_answer, a.correct_answer
+            FROM attempt_answers a JOIN attempts t ON a.attempt_id = t.id
+            ''',
+            ['''
+            CREATE TRIGGER IF NOT EXISTS attempt_answers_fts_insert AFTER INSERT ON attempt_answers BEGIN
+                INSERT INTO attempt_answers_fts (rowid, owner, question, given_answer, correct_answer)
+                SELECT new.id, 'u' || user_id, new.question, new.given_answer, new.correct_answer
+                FROM attempts WHERE id = new.attempt_id;
+            END;
+            ''', '''
+            CREATE TRIGGER IF NOT EXISTS attempt_answers_fts_delete BEFORE DELETE ON attempts BEGIN
+                INSERT INTO attempt_answers_fts (attempt_answers_fts, rowid, owner, question, given_answer, correct_answer)
+                SELECT 'delete', id, 'u' || old.user_id, question, given_answer, correct_answer
+                FROM attempt_answers WHERE attempt_id = old.id;
+            END;
+            ''']
+        )
 
         conn.commit()
+    if os.path.getsize(DB_FILE) <= AUTO_VACUUM_MIGRATION_MAX_BYTES:
+        try:
+            enable_incremental_vacuum()
+        except sqlite3.OperationalError as e:
+            # Another process holds the database; the next start converts it
+            print(f"Could not switch the database to incremental vacuum yet: {e}")
     print("Database initialized successfully.")
 
+def enable_incremental_vacuum():
+    """
+    Switches a database created before chat retention to incremental auto-vacuum. That takes
+    one full VACUUM, which rewrites the file under an exclusive lock. Returns True if it ran.
+    """
+    conn = sqlite3.connect(DB_FILE, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close()
+
+def _create_search_index(cursor, name: str, columns: list, content_sql: str, triggers: list):
+    """
+    Creates the FTS5 index `name` over the view `<name>_content` (id, owner, *columns) and its
+    sync triggers. A newly created index is filled from the rows already in the database.
+    """
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+    cursor.execute(f"CREATE VIEW IF NOT EXISTS {name}_content AS {content_sql}")
+    cursor.execute(
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5(
+            owner, {", ".join(columns)},
+            content='{name}_content', content_rowid='id', tokenize='porter unicode61 remove_diacritics 2'
+        )
+        """
+    )
+    for trigger in triggers:
+        cursor.execute(trigger)
+    if not exists:
+        cursor.execute(f"INSERT INTO {name} ({name}) VALUES ('rebuild')")
+
+def _add_column_if_missing(cursor, table: str, column: str, definition: str):
+    """Adds a column introduced in a newer version to a table of an existing database."""
+    if column not in {row["name"] for row in cursor.execute(f"PRAGMA table_info({table})")}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+_db_initialized = False
+
+def ensure_db():
+    """Runs init_db once per process, so tables added in newer versions reach existing databases."""
+    global _db_initialized
+    if not _db_initialized:
+        init_db()
+        _db_initialized = True
+
 # --- Helper function to get user ID ---def _get_user_id(cursor, sha1_of_username):
 def _get_user_id(cursor, sha1_of_username):
     """Fetches user ID from a user hash. Returns None if not found."""
@@ -330,8 +811,61 @@ def add_chapter(sha1_of_username: str, subject: str, chapter: str):
         except sqlite3.IntegrityError:
             return "exists"
 
-def get_chat_history(sha1_of_username: str):
-    """Retrieves the chat history for a user from the database."""
+# Embeddings a chapter can be indexed with: the configured AI provider, or a local CPU
+# model (providers.LocalEmbeddings) that needs no API calls
+CHAPTER_EMBEDDINGS = {
+    "default": "AI provider (default)",
+    "hashing": "Local hashing (offline)",
+    "tfidf": "Local TF-IDF + SVD (offline, fitted per subject)",
+}
+
+def get_chapter_embedding(sha1_of_username: str, subject: str, chapter: str):
+    """Returns the embeddings a chapter is indexed with, one of CHAPTER_EMBEDDINGS."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return "default"
+        cursor.execute("SELECT embedding FROM chapter_settings WHERE chapter_id = ?", (chapter_id,))
+        row = cursor.fetchone()
+        return row['embedding'] if row else "default"
+
+def set_chapter_embedding(sha1_of_username: str, subject: str, chapter: str, embedding: str):
+    """Sets the embeddings used the next time a chapter is indexed."""
+    if embedding not in CHAPTER_EMBEDDINGS:
+        return "invalid_embedding"
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return "chapter_not_found"
+        cursor.execute(
+            """
+            INSERT INTO chapter_settings (chapter_id, embedding) VALUES (?, ?)
+            ON CONFLICT(chapter_id) DO UPDATE SET embedding = excluded.embedding
+            """,
+            (chapter_id, embedding)
+        )
+        conn.commit()
+        return "success"
+
+def delete_chapter(sha1_of_username: str, subject: str, chapter: str):
+    """Deletes a chapter with everything stored for it in the database, and its materials and indexes."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if chapter_id:
+            cursor.execute("DELETE FROM chapters WHERE id = ?", (chapter_id,))
+            conn.commit()
+    for part in ("materials", "data"):
+        shutil.rmtree(os.path.join(sha1_of_username, part, subject, chapter), ignore_errors=True)
+    return "success"
+
+def get_chat_history(sha1_of_username: str, limit: int = None, before_id: int = None):
+    """
+    Retrieves the chat history for a user from the database, oldest first: all of it, or
+    the last `limit` messages (before the message before_id). Archived messages are not included.
+    """
     with get_db_connection() as conn:
         cursor = conn.cursor()
         user_id = _get_user_id(cursor, sha1_of_username)
@@ -339,11 +873,15 @@ def get_chat_history(sha1_of_username: str):
             return []
         
         cursor.execute(
-            "SELECT role, message, timestamp FROM chat_history WHERE user_id = ? ORDER BY timestamp ASC",
-            (user_id,)
+            """
+            SELECT id, role, message, timestamp FROM chat_history
+            WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?
+            """,
+            (user_id, before_id if before_id is not None else 2**63 - 1, limit if limit is not None else -1)
         )
-        history = [{"role": row['role'], "content": row['message'], "timestamp": row['timestamp']} for row in cursor.fetchall()]
-        return history
+        history = [{"id": row['id'], "role": row['role'], "content": row['message'], "timestamp": row['timestamp']}
+                   for row in cursor.fetchall()]
+        return history[::-1]
 
 def add_chat_message(sha1_of_username: str, role: str, message: str):
     """Adds a new chat message to the user's chat history in the database."""
@@ -360,6 +898,755 @@ def add_chat_message(sha1_of_username: str, role: str, message: str):
         conn.commit()
         return "success"
 
+def get_chapter_chat_memory(sha1_of_username: str, subject: str, chapter: str):
+    """Retrieves the conversation memory of a chapter chat as {"summary": str, "turns": list, "pending": list}."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return {"summary": "", "turns": [], "pending": []}
+
+        cursor.execute("SELECT summary, recent_turns, pending_turns FROM chapter_chat_memory WHERE chapter_id = ?",
+                       (chapter_id,))
+        row = cursor.fetchone()
+        if not row:
+            return {"summary": "", "turns": [], "pending": []}
+        return {"summary": row['summary'], "turns": json.loads(row['recent_turns']),
+                "pending": json.loads(row['pending_turns'])}
+
+def save_chapter_chat_memory(sha1_of_username: str, subject: str, chapter: str, memory: dict):
+    """Stores the conversation memory of a chapter chat, replacing the previous one."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return "chapter_not_found"
+
+        cursor.execute(
+            """
+            INSERT INTO chapter_chat_memory (chapter_id, summary, recent_turns, pending_turns, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(chapter_id) DO UPDATE SET
+                summary = excluded.summary,
+                recent_turns = excluded.recent_turns,
+                pending_turns = excluded.pending_turns,
+                updated_at = excluded.updated_at
+            """,
+            (chapter_id, memory["summary"], json.dumps(memory["turns"]), json.dumps(memory.get("pending", [])))
+        )
+        conn.commit()
+        return "success"
+
+MINDMAPS_TO_KEEP = 2
+
+def get_chapter_mindmap(sha1_of_username: str, subject: str, chapter: str, index_version=None):
+    """
+    Returns the stored mind map of a chapter for an index version (the most recently
+    stored one when index_version is None) as {"version", "mermaid", "branches"}, or None.
+    "mermaid" is None for a map whose generation failed part way; its branches are the
+    ones that were generated.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return None
+        if index_version is None:
+            cursor.execute(
+                "SELECT * FROM chapter_mindmaps WHERE chapter_id = ? ORDER BY created_at DESC, rowid DESC LIMIT 1",
+                (chapter_id,)
+            )
+        else:
+            cursor.execute("SELECT * FROM chapter_mindmaps WHERE chapter_id = ? AND index_version = ?",
+                           (chapter_id, index_version))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return {"version": row['index_version'], "mermaid": row['mermaid'] or None, "branches": json.loads(row['branches'])}
+
+def save_chapter_mindmap(sha1_of_username: str, subject: str, chapter: str, index_version: str,
+                         mermaid, branches: dict):
+    """
+    Stores the mind map of an index version (mermaid None for an incomplete one) and drops
+    all but the newest MINDMAPS_TO_KEEP of the chapter.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return "chapter_not_found"
+
+        cursor.execute(
+            "INSERT OR REPLACE INTO chapter_mindmaps (chapter_id, index_version, mermaid, branches) VALUES (?, ?, ?, ?)",
+            (chapter_id, index_version, mermaid or "", json.dumps(branches))
+        )
+        cursor.execute(
+            """
+            DELETE FROM chapter_mindmaps WHERE chapter_id = ? AND rowid NOT IN (
+                SELECT rowid FROM chapter_mindmaps WHERE chapter_id = ?
+                ORDER BY created_at DESC, rowid DESC LIMIT ?
+            )
+            """,
+            (chapter_id, chapter_id, MINDMAPS_TO_KEEP)
+        )
+        conn.commit()
+        return "success"
+
+# --- Flashcard Spaced Repetition Functions ---
+# SM-2: a card answered with grade >= 3 (of 0-5) is due again after 1 day, then 6 days,
+# then the previous interval times its ease factor. A lapse restarts it a few minutes later.
+FLASHCARD_GRADES = {"Again": 1, "Hard": 3, "Good": 4, "Easy": 5}
+FLASHCARD_MIN_EASE = 1.3
+FLASHCARD_RELEARN_SECONDS = 600
+SECONDS_PER_DAY = 86400
+
+def schedule_sm2(repetitions: int, interval_days: float, ease: float, grade: int):
+    """Returns the next (repetitions, interval_days, ease, lapsed) of a card reviewed with grade 0-5."""
+    ease = max(FLASHCARD_MIN_EASE, ease + 0.1 - (5 - grade) * (0.08 + (5 - grade) * 0.02))
+    if grade < 3:
+        return 0, 0.0, ease, True
+    if repetitions == 0:
+        interval_days = 1.0
+    elif repetitions == 1:
+        interval_days = 6.0
+    else:
+        interval_days = round(interval_days * ease, 1)
+    return repetitions + 1, interval_days, ease, False
+
+def add_flashcards(sha1_of_username: str, subject: str, chapter: str, cards: list, now=None):
+    """Adds new cards (dicts with question and answer), due immediately. Returns how many were new."""
+    now = int(now if now is not None else time.time())
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        user_id = _get_user_id(cursor, sha1_of_username)
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return 0
+        # rowcount leaves out the rows the search index triggers write, unlike total_changes
+        cursor.executemany(
+            "INSERT OR IGNORE INTO flashcards (user_id, chapter_id, question, answer, due_at) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, chapter_id, card["question"], card["answer"], now) for card in cards]
+        )
+        conn.commit()
+        return cursor.rowcount
+
+def get_due_flashcards(sha1_of_username: str, subject: str, chapter: str, limit: int = 20, now=None):
+    """Returns up to limit cards of a chapter that are due, most overdue first."""
+    now = int(now if now is not None else time.time())
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return []
+        cursor.execute(
+            """
+            SELECT id, question, answer, repetitions, interval_days, ease, lapses, due_at
+            FROM flashcards WHERE chapter_id = ? AND due_at <= ?
+            ORDER BY due_at LIMIT ?
+            """,
+            (chapter_id, now, limit)
+        )
+        return [dict(row) for row in cursor.fetchall()]
+
+def get_flashcard_counts(sha1_of_username: str, subject: str, chapter: str, now=None):
+    """Returns {"due": ..., "total": ...} card counts of a chapter."""
+    now = int(now if now is not None else time.time())
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return {"due": 0, "total": 0}
+        due = cursor.execute("SELECT COUNT(*) FROM flashcards WHERE chapter_id = ? AND due_at <= ?",
+                             (chapter_id, now)).fetchone()[0]
+        total = cursor.execute("SELECT COUNT(*) FROM flashcards WHERE chapter_id = ?", (chapter_id,)).fetchone()[0]
+        return {"due": due, "total": total}
+
+def review_flashcard(sha1_of_username: str, card_id: int, grade: int, now=None):
+    """
+    Records a review of one of a user's cards with grade 0-5 and schedules its next review.
+    Returns the new due time, or None if the user has no such card.
+    """
+    now = int(now if now is not None else time.time())
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        user_id = _get_user_id(cursor, sha1_of_username)
+        if not user_id:
+            return None
+        card = cursor.execute("SELECT repetitions, interval_days, ease FROM flashcards WHERE id = ? AND user_id = ?",
+                              (card_id, user_id)).fetchone()
+        if not card:
+            return None
+        repetitions, interval_days, ease, lapsed = schedule_sm2(card['repetitions'], card['interval_days'], card['ease'], grade)
+        due_at = now + (FLASHCARD_RELEARN_SECONDS if lapsed else int(interval_days * SECONDS_PER_DAY))
+        cursor.execute(
+            """
+            UPDATE flashcards SET repetitions = ?, interval_days = ?, ease = ?, lapses = lapses + ?,
+                                  due_at = ?, last_reviewed_at = ?
+            WHERE id = ? AND user_id = ?
+            """,
+            (repetitions, interval_days, ease, int(lapsed), due_at, now, card_id, user_id)
+        )
+        conn.commit()
+        return due_at
+
+# --- Quiz and Exam Attempt Functions ---
+# Rolling accuracy is an exponentially weighted average: the newest attempt counts this much
+PROGRESS_RECENT_WEIGHT = 0.3
+WEAK_TOPIC_MIN_ANSWERED = 3
+DEFAULT_TOPIC = "General"
+
+def _record_attempt(cursor, user_id: int, chapter_id: int, kind: str, answers: list, started_at, finished_at: int):
+    """Inserts one attempt with its answers and folds it into the progress aggregates."""
+    score = sum(answer["score"] for answer in answers)
+    max_score = sum(answer["max_score"] for answer in answers)
+    cursor.execute(
+        """
+        INSERT INTO attempts (user_id, chapter_id, kind, num_questions, score, max_score, started_at, finished_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (user_id, chapter_id, kind, len(answers), score, max_score, started_at, finished_at)
+    )
+    attempt_id = cursor.lastrowid
+    cursor.executemany(
+        """
+        INSERT INTO attempt_answers (attempt_id, topic, question, given_answer, correct_answer, score, max_score)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        [(attempt_id, answer.get("topic") or DEFAULT_TOPIC, answer["question"], answer.get("given_answer"),
+          answer.get("correct_answer"), answer["score"], answer["max_score"]) for answer in answers]
+    )
+
+    accuracy = score / max_score if max_score else 0.0
+    cursor.execute(
+        """
+        INSERT INTO chapter_progress (chapter_id, kind, attempts, questions, score, max_score,
+                                      recent_accuracy, best_accuracy, last_attempt_at)
+        VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(chapter_id, kind) DO UPDATE SET
+            attempts = attempts + 1,
+            questions = questions + excluded.questions,
+            score = score + excluded.score,
+            max_score = max_score + excluded.max_score,
+            recent_accuracy = recent_accuracy * (1 - ?) + excluded.recent_accuracy * ?,
+            best_accuracy = MAX(best_accuracy, excluded.best_accuracy),
+            last_attempt_at = excluded.last_attempt_at
+        """,
+        (chapter_id, kind, len(answers), score, max_score, accuracy, accuracy, finished_at,
+         PROGRESS_RECENT_WEIGHT, PROGRESS_RECENT_WEIGHT)
+    )
+
+    topics = {}
+    for answer in answers:
+        totals = topics.setdefault(answer.get("topic") or DEFAULT_TOPIC, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += answer["score"]
+        totals[2] += answer["max_score"]
+    cursor.executemany(
+        """
+        INSERT INTO topic_progress (chapter_id, topic, answered, score, max_score, recent_accuracy, last_seen_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(chapter_id, topic) DO UPDATE SET
+            answered = answered + excluded.answered,
+            score = score + excluded.score,
+            max_score = max_score + excluded.max_score,
+            recent_accuracy = recent_accuracy * (1 - ?) + excluded.recent_accuracy * ?,
+            last_seen_at = excluded.last_seen_at
+        """,
+        [(chapter_id, topic, answered, topic_score, topic_max, topic_score / topic_max if topic_max else 0.0,
+          finished_at, PROGRESS_RECENT_WEIGHT, PROGRESS_RECENT_WEIGHT)
+         for topic, (answered, topic_score, topic_max) in topics.items()]
+    )
+    return attempt_id
+
+def record_attempt(sha1_of_username: str, subject: str, chapter: str, kind: str, answers: list,
+                   started_at=None, finished_at=None):
+    """
+    Stores a finished quiz or exam (kind "quiz" or "exam") and updates the chapter and topic
+    progress in the same transaction. answers are dicts with question, topic, given_answer,
+    correct_answer, score and max_score. Returns the attempt id, or None when nothing was
+    stored because answers is empty or the chapter does not exist.
+    """
+    if not answers:
+        return None
+    finished_at = int(finished_at if finished_at is not None else time.time())
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        user_id = _get_user_id(cursor, sha1_of_username)
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return None
+        attempt_id = _record_attempt(cursor, user_id, chapter_id, kind, answers, started_at, finished_at)
+        conn.commit()
+        return attempt_id
+
+def get_chapter_progress(sha1_of_username: str, subject: str, chapter: str):
+    """Returns the precomputed progress of a chapter as {"quiz": {...}, "exam": {...}} (missing kinds omitted)."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return {}
+        cursor.execute("SELECT * FROM chapter_progress WHERE chapter_id = ?", (chapter_id,))
+        progress = {}
+        for row in cursor.fetchall():
+            entry = dict(row)
+            entry["accuracy"] = row['score'] / row['max_score'] if row['max_score'] else 0.0
+            progress[row['kind']] = entry
+        return progress
+
+def get_topic_progress(sha1_of_username: str, subject: str, chapter: str, min_answered: int = 1, limit: int = None):
+    """Returns the per-topic progress of a chapter, weakest (lowest rolling accuracy) first."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return []
+        cursor.execute(
+            """
+            SELECT topic, answered, score, max_score, recent_accuracy, last_seen_at FROM topic_progress
+            WHERE chapter_id = ? AND answered >= ? ORDER BY recent_accuracy LIMIT ?
+            """,
+            (chapter_id, min_answered, -1 if limit is None else limit)
+        )
+        return [dict(row) for row in cursor.fetchall()]
+
+def get_weak_topics(sha1_of_username: str, subject: str, chapter: str, limit: int = 5):
+    """Returns the topics of a chapter with the lowest rolling accuracy among those answered often enough."""
+    return get_topic_progress(sha1_of_username, subject, chapter, WEAK_TOPIC_MIN_ANSWERED, limit)
+
+def get_recent_attempts(sha1_of_username: str, subject: str, chapter: str, limit: int = 10):
+    """Returns the latest attempts of a chapter, newest first."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_id = _get_chapter_id(cursor, sha1_of_username, subject, chapter)
+        if not chapter_id:
+            return []
+        cursor.execute(
+            """
+            SELECT id, kind, num_questions, score, max_score, started_at, finished_at FROM attempts
+            WHERE chapter_id = ? ORDER BY finished_at DESC LIMIT ?
+            """,
+            (chapter_id, limit)
+        )
+        return [dict(row) for row in cursor.fetchall()]
+
+# --- LLM Usage Statistics ---
+# Weight of the newest call in the smoothed latency / error rate the routing reads,
+# so a profile that recovers is routed to again after a few dozen calls
+LLM_STATS_RECENT_WEIGHT = 0.1
+
+# Calls are added up in memory and written in one transaction per flush: by the
+# maintenance thread every LLM_STATS_FLUSH_SECONDS, before the statistics are read and
+# at exit. Per (task, profile, provider, model): the sums, plus the smoothed latency and
+# error rate of the batch alone ("seed_*", for a new row) and what the batch adds to the
+# stored ones once they are scaled by "decay".
+LLM_STATS_FLUSH_SECONDS = float(os.getenv("LLM_STATS_FLUSH_SECONDS", "10"))
+_pending_llm_stats = {}
+_pending_llm_stats_lock = threading.Lock()
+
+def record_llm_call(task: str, profile: str, provider: str, model: str, seconds: float,
+                    prompt_tokens: int = 0, output_tokens: int = 0, cost: float = 0.0, error: bool = False):
+    """Adds one LLM call to the per-task statistics (written by the next flush_llm_stats())."""
+    weight = LLM_STATS_RECENT_WEIGHT
+    with _pending_llm_stats_lock:
+        entry = _pending_llm_stats.get((task, profile, provider, model))
+        if entry is None:
+            _pending_llm_stats[(task, profile, provider, model)] = {
+                "calls": 1, "errors": int(error), "total_seconds": seconds, "max_seconds": seconds,
+                "prompt_tokens": prompt_tokens, "output_tokens": output_tokens, "cost": cost,
+                "seed_seconds": seconds, "seed_error_rate": float(error),
+                "decay": 1 - weight, "recent_seconds": seconds * weight, "recent_error_rate": float(error) * weight,
+            }
+            return "success"
+        entry["calls"] += 1
+        entry["errors"] += int(error)
+        entry["total_seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+        entry["prompt_tokens"] += prompt_tokens
+        entry["output_tokens"] += output_tokens
+        entry["cost"] += cost
+        entry["seed_seconds"] = entry["seed_seconds"] * (1 - weight) + seconds * weight
+        entry["seed_error_rate"] = entry["seed_error_rate"] * (1 - weight) + float(error) * weight
+        entry["decay"] *= 1 - weight
+        entry["recent_seconds"] = entry["recent_seconds"] * (1 - weight) + seconds * weight
+        entry["recent_error_rate"] = entry["recent_error_rate"] * (1 - weight) + float(error) * weight
+    return "success"
+
+def flush_llm_stats():
+    """Writes the LLM calls recorded since the last flush to llm_task_stats."""
+    with _pending_llm_stats_lock:
+        pending = dict(_pending_llm_stats)
+        _pending_llm_stats.clear()
+    if not pending:
+        return "success"
+    try:
+        with get_db_connection() as conn:
+            conn.executemany(
+                """
+                INSERT INTO llm_task_stats (task, profile, provider, model, calls, errors, total_seconds,
+                                            max_seconds, prompt_tokens, output_tokens, cost,
+                                            recent_seconds, recent_error_rate)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(task, profile, provider, model) DO UPDATE SET
+                    calls = calls + excluded.calls,
+                    errors = errors + excluded.errors,
+                    total_seconds = total_seconds + excluded.total_seconds,
+                    max_seconds = MAX(max_seconds, excluded.max_seconds),
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    output_tokens = output_tokens + excluded.output_tokens,
+                    cost = cost + excluded.cost,
+                    recent_seconds = recent_seconds * ? + ?,
+                    recent_error_rate = recent_error_rate * ? + ?,
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                [key + (entry["calls"], entry["errors"], entry["total_seconds"], entry["max_seconds"],
+                        entry["prompt_tokens"], entry["output_tokens"], entry["cost"],
+                        entry["seed_seconds"], entry["seed_error_rate"],
+                        entry["decay"], entry["recent_seconds"], entry["decay"], entry["recent_error_rate"])
+                 for key, entry in pending.items()]
+            )
+            conn.commit()
+            return "success"
+    except sqlite3.Error as e:
+        # Statistics must never break the calls they describe; this batch is dropped
+        return ("error", str(e))
+
+atexit.register(flush_llm_stats)
+
+def get_llm_task_stats():
+    """Returns the per-task LLM statistics, with mean latency, error rate and cost per call."""
+    flush_llm_stats()
+    try:
+        with get_db_connection() as conn:
+            rows = conn.execute("SELECT * FROM llm_task_stats ORDER BY task, profile").fetchall()
+    except sqlite3.Error:
+        return []
+    stats = []
+    for row in rows:
+        entry = dict(row)
+        entry["mean_seconds"] = row['total_seconds'] / row['calls'] if row['calls'] else 0.0
+        entry["error_rate"] = row['errors'] / row['calls'] if row['calls'] else 0.0
+        entry["cost_per_call"] = row['cost'] / row['calls'] if row['calls'] else 0.0
+        stats.append(entry)
+    return stats
+
+# --- Search ---
+# Full-text search over chat history, flashcards and quiz/exam answers
+SEARCH_KINDS = ("chat", "flashcard", "quiz")
+SEARCH_SNIPPET_TOKENS = 24
+# Words, optionally ending in * to match every word they start (at least SEARCH_PREFIX_MIN_CHARS
+# long, since short prefixes expand to a large part of the vocabulary)
+SEARCH_WORD_PATTERN = re.compile(r"(\w+)(\*?)")
+SEARCH_PREFIX_MIN_CHARS = 3
+
+# Per kind: FTS5 index, searched columns, bm25 weights (owner first, never scored) and the
+# query that fills in the results of one page; it gets the highlight markers, the match and ids
+_SEARCH_SOURCES = {
+    "chat": {
+        "index": "chat_history_fts",
+        "columns": "{message}",
+        "weights": "0.0, 1.0",
+        "details": '''
+            SELECT chat_history_fts.rowid AS id, NULL AS title,
+                   snippet(chat_history_fts, 1, ?1, ?2, '…', ?3) AS snippet,
+                   c.role, NULL AS subject, NULL AS chapter, c.timestamp
+            FROM chat_history_fts JOIN chat_history c ON c.id = chat_history_fts.rowid
+            WHERE chat_history_fts MATCH ?4 AND chat_history_fts.rowid IN ({ids})
+        ''',
+    },
+    "flashcard": {
+        "index": "flashcards_fts",
+        "columns": "{question answer}",
+        "weights": "0.0, 2.0, 1.0",
+        "details": '''
+            SELECT flashcards_fts.rowid AS id, highlight(flashcards_fts, 1, ?1, ?2) AS title,
+                   snippet(flashcards_fts, 2, ?1, ?2, '…', ?3) AS snippet,
+                   NULL AS role, s.name AS subject, ch.name AS chapter, c.created_at AS timestamp
+            FROM flashcards_fts JOIN flashcards c ON c.id = flashcards_fts.rowid
+            JOIN chapters ch ON ch.id = c.chapter_id JOIN subjects s ON s.id = ch.subject_id
+            WHERE flashcards_fts MATCH ?4 AND flashcards_fts.rowid IN ({ids})
+        ''',
+    },
+    "quiz": {
+        "index": "attempt_answers_fts",
+        "columns": "{question given_answer correct_answer}",
+        "weights": "0.0, 2.0, 1.0, 1.0",
+        "details": '''
+            SELECT attempt_answers_fts.rowid AS id, highlight(attempt_answers_fts, 1, ?1, ?2) AS title,
+                   snippet(attempt_answers_fts, 3, ?1, ?2, '…', ?3) AS snippet,
+                   t.kind AS role, s.name AS subject, ch.name AS chapter,
+                   datetime(t.finished_at, 'unixepoch') AS timestamp
+            FROM attempt_answers_fts JOIN attempt_answers a ON a.id = attempt_answers_fts.rowid
+            JOIN attempts t ON t.id = a.attempt_id
+            JOIN chapters ch ON ch.id = t.chapter_id JOIN subjects s ON s.id = ch.subject_id
+            WHERE attempt_answers_fts MATCH ?4 AND attempt_answers_fts.rowid IN ({ids})
+        ''',
+    },
+}
+
+def build_search_query(text: str):
+    """
+    FTS5 query for free text typed by a user: every word has to match, "word*" as a prefix.
+    Operators and quotes are not passed through. None without words.
+    """
+    words = SEARCH_WORD_PATTERN.findall(text or "")
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' if star and len(word) >= SEARCH_PREFIX_MIN_CHARS else f'"{word}"' for word, star in words)
+
+def search_history(sha1_of_username: str, text: str, kinds=SEARCH_KINDS, limit: int = 20, offset: int = 0,
+                   highlight=("**", "**")):
+    """
+    Ranked full-text search over a user's chat messages, flashcards and quiz/exam answers.
+    Returns one page of results, best first, as dicts with kind ("chat", "flashcard" or "quiz"),
+    id, title (highlighted question, None for chat), snippet (highlighted excerpt), role
+    ("user"/"assistant" for chat, "quiz"/"exam" for answers), subject, chapter and timestamp.
+    Matches are wrapped in the highlight markers. Ask for limit + 1 results to know if a next page exists.
+    Chat messages moved to the archive by archive_chat_history() are no longer indexed and
+    drop out of the results; get_archived_chat_history() still reads them back.
+    """
+    query = build_search_query(text)
+    kinds = [kind for kind in kinds if kind in _SEARCH_SOURCES]
+    if not query or not kinds or limit <= 0:
+        return []
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        user_id = _get_user_id(cursor, sha1_of_username)
+        if not user_id:
+            return []
+        matches = {kind: f'{{owner}}: "u{user_id}" AND {_SEARCH_SOURCES[kind]["columns"]}: ({query})' for kind in kinds}
+
+        # Rank on rowids and scores only; snippets are made for the rows of the page alone
+        ranked = " UNION ALL ".join(
+            f"""
+            SELECT * FROM (
+                SELECT '{kind}' AS kind, rowid AS id, bm25({source["index"]}, {source["weights"]}) AS score
+                FROM {source["index"]} WHERE {source["index"]} MATCH ? ORDER BY score LIMIT ?
+            )
+            """
+            for kind, source in ((kind, _SEARCH_SOURCES[kind]) for kind in kinds)
+        )
+        parameters = [value for kind in kinds for value in (matches[kind], offset + limit)]
+        page = cursor.execute(f"{ranked} ORDER BY score LIMIT ? OFFSET ?", parameters + [limit, offset]).fetchall()
+
+        details = {}
+        for kind in kinds:
+            ids = [row["id"] for row in page if row["kind"] == kind]
+            if not ids:
+                continue
+            sql = _SEARCH_SOURCES[kind]["details"].format(ids=", ".join("?" * len(ids)))
+            for row in cursor.execute(sql, [highlight[0], highlight[1], SEARCH_SNIPPET_TOKENS, matches[kind], *ids]):
+                details[(kind, row["id"])] = {"kind": kind, **dict(row)}
+        return [details[key] for key in ((row["kind"], row["id"]) for row in page) if key in details]
+
+# --- Chat History Retention ---
+# Messages older than CHAT_RETENTION_DAYS are moved out of chat_history into gzip-compressed
+# JSON Lines segments under <user>/archive/chat_history/, listed in chat_archive_segments.
+# The freed database pages go back to the file system with an incremental VACUUM. The job
+# runs on a daemon thread of each app process (one process per interval does the work) or
+# with `python backend.py archive-chat` from cron. Archived messages are read back on demand,
+# but are no longer part of the full-text search (the search page says so).
+CHAT_RETENTION_DAYS = float(os.getenv("CHAT_RETENTION_DAYS", "180"))  # 0 turns archiving off
+CHAT_RETENTION_INTERVAL_SECONDS = float(os.getenv("CHAT_RETENTION_INTERVAL_HOURS", "24")) * 3600
+CHAT_ARCHIVE_DIR = os.path.join("archive", "chat_history")
+CHAT_ARCHIVE_SEGMENT_MESSAGES = 5000
+# Users with fewer old messages are left alone, so archives are not split into tiny files
+CHAT_ARCHIVE_MIN_MESSAGES = 50
+# Pages handed back to the file system per run (SQLite's default page is 4 KiB), bounding how long the write lock is held
+VACUUM_PAGES_PER_RUN = 65536
+CHAT_RETENTION_TASK = "chat_retention"
+
+_maintenance_thread = None
+
+def _claim_maintenance_run(task: str, interval_seconds: float, now: int):
+    """Marks task as started unless another process ran it within the interval. Returns True if claimed."""
+    with get_db_connection() as conn:
+        conn.execute("INSERT OR IGNORE INTO maintenance_runs (task) VALUES (?)", (task,))
+        claimed = conn.execute(
+            "UPDATE maintenance_runs SET started_at = ? WHERE task = ? AND started_at <= ?",
+            (now, task, now - interval_seconds)
+        ).rowcount
+        conn.commit()
+        return bool(claimed)
+
+def _write_chat_archive_segment(user_hash: str, rows: list):
+    """Writes messages as a gzip JSONL segment. Returns its path, raw and compressed size."""
+    path = os.path.join(user_hash, CHAT_ARCHIVE_DIR, f"{rows[0]['id']:012d}-{rows[-1]['id']:012d}.jsonl.gz")
+    raw = "".join(json.dumps({"id": row["id"], "role": row["role"], "content": row["message"],
+                              "timestamp": row["timestamp"]}, ensure_ascii=False) + "\n" for row in rows).encode("utf-8")
+    compressed = gzip.compress(raw, compresslevel=6)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(compressed)
+    os.replace(tmp_path, path)
+    return path, len(raw), len(compressed)
+
+def archive_chat_history(retention_days: float = None, now=None, vacuum_pages: int = VACUUM_PAGES_PER_RUN):
+    """
+    Moves the messages older than retention_days of every user with at least
+    CHAT_ARCHIVE_MIN_MESSAGES of them into archive segments, then returns free pages to the
+    file system. Databases not yet converted by enable_incremental_vacuum() keep the freed
+    pages; the stats report them with needs_full_vacuum. Returns the stats of the run (also
+    kept in maintenance_runs).
+    """
+    retention_days = CHAT_RETENTION_DAYS if retention_days is None else retention_days
+    now = time.time() if now is None else now
+    start = time.perf_counter()
+    db_bytes_before = os.path.getsize(DB_FILE)
+    stats = {"archived_messages": 0, "segments": 0, "raw_bytes": 0, "compressed_bytes": 0}
+    # chat_history timestamps are CURRENT_TIMESTAMP, i.e. UTC text
+    cutoff = datetime.datetime.fromtimestamp(now - retention_days * 86400, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    with get_db_connection() as conn:
+        # Ids grow with time, so the old messages of a user are a range of idx_chat_history_user
+        last_old_id = conn.execute("SELECT MAX(id) FROM chat_history WHERE timestamp < ?", (cutoff,)).fetchone()[0]
+        users = conn.execute("SELECT id, user_hash FROM users").fetchall() if last_old_id else []
+        for user in users:
+            old_messages = conn.execute("SELECT COUNT(*) FROM chat_history WHERE user_id = ? AND id <= ? AND timestamp < ?",
+                                        (user["id"], last_old_id, cutoff)).fetchone()[0]
+            if old_messages < CHAT_ARCHIVE_MIN_MESSAGES:
+                continue
+            while True:
+                rows = conn.execute(
+                    """
+                    SELECT id, role, message, timestamp FROM chat_history
+                    WHERE user_id = ? AND id <= ? AND timestamp < ? ORDER BY id LIMIT ?
+                    """,
+                    (user["id"], last_old_id, cutoff, CHAT_ARCHIVE_SEGMENT_MESSAGES)
+                ).fetchall()
+                if not rows:
+                    break
+                # The segment is on disk before its messages leave the database; if the transaction
+                # fails, the file is removed again and the messages stay where they were
+                path, raw_bytes, compressed_bytes = _write_chat_archive_segment(user["user_hash"], rows)
+                try:
+                    conn.execute(
+                        """
+                        INSERT INTO chat_archive_segments (user_id, path, first_message_id, last_message_id,
+                            first_timestamp, last_timestamp, messages, raw_bytes, compressed_bytes)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        """,
+                        (user["id"], path, rows[0]["id"], rows[-1]["id"], rows[0]["timestamp"], rows[-1]["timestamp"],
+                         len(rows), raw_bytes, compressed_bytes)
+                    )
+                    conn.executemany("DELETE FROM chat_history WHERE id = ?", [(row["id"],) for row in rows])
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    os.remove(path)
+                    raise
+                stats["archived_messages"] += len(rows)
+                stats["segments"] += 1
+                stats["raw_bytes"] += raw_bytes
+                stats["compressed_bytes"] += compressed_bytes
+        if stats["archived_messages"]:
+            # Folds some of the deleted entries out of the search index
+            conn.execute("INSERT INTO chat_history_fts (chat_history_fts, rank) VALUES ('merge', 500)")
+            conn.commit()
+
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        free_pages_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        stats["needs_full_vacuum"] = conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2
+        if not stats["needs_full_vacuum"]:
+            # executescript steps the pragma to the end; execute would free a single page
+            conn.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)});")
+        stats["free_pages_left"] = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    stats["freed_pages"] = free_pages_before - stats["free_pages_left"]
+    stats["db_bytes_before"] = db_bytes_before
+    stats["db_bytes_after"] = os.path.getsize(DB_FILE)
+    stats["reclaimed_bytes"] = db_bytes_before - stats["db_bytes_after"]
+    stats["page_size"] = page_size
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+
+    with get_db_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO maintenance_runs (task, started_at, finished_at, stats) VALUES (?, ?, ?, ?)
+            ON CONFLICT(task) DO UPDATE SET finished_at = excluded.finished_at, stats = excluded.stats
+            """,
+            (CHAT_RETENTION_TASK, int(now), int(time.time()), json.dumps(stats))
+        )
+        conn.commit()
+    count("archived_chat_messages", stats["archived_messages"])
+    count("reclaimed_db_bytes", max(stats["reclaimed_bytes"], 0))
+    count("chat_retention_runs", needs_full_vacuum=str(stats["needs_full_vacuum"]).lower())
+    return stats
+
+def run_chat_retention(now=None):
+    """Runs archive_chat_history unless retention is off or another process ran it within the interval."""
+    now = int(time.time() if now is None else now)
+    if CHAT_RETENTION_DAYS <= 0 or not _claim_maintenance_run(CHAT_RETENTION_TASK, CHAT_RETENTION_INTERVAL_SECONDS, now):
+        return None
+    return archive_chat_history(now=now)
+
+def start_maintenance_scheduler(check_seconds: float = 600):
+    """
+    Starts (once per process) a daemon thread that flushes the LLM statistics every
+    LLM_STATS_FLUSH_SECONDS and runs the retention job when it is due.
+    """
+    global _maintenance_thread
+    if _maintenance_thread is not None:
+        return
+    def loop():
+        next_check = 0
+        while True:
+            flush_llm_stats()
+            if CHAT_RETENTION_DAYS > 0 and time.monotonic() >= next_check:
+                next_check = time.monotonic() + check_seconds
+                try:
+                    run_chat_retention()
+                except Exception as e:
+                    # Maintenance must never take the app down; the next check retries
+                    print(f"Chat retention failed: {e}")
+            time.sleep(min(LLM_STATS_FLUSH_SECONDS, check_seconds))
+    _maintenance_thread = threading.Thread(target=loop, name="maintenance", daemon=True)
+    _maintenance_thread.start()
+
+def get_maintenance_stats():
+    """Returns {task: {"started_at", "finished_at", **stats of the last run}} for every maintenance job."""
+    with get_db_connection() as conn:
+        rows = conn.execute("SELECT task, started_at, finished_at, stats FROM maintenance_runs").fetchall()
+    return {row["task"]: {"started_at": row["started_at"], "finished_at": row["finished_at"], **json.loads(row["stats"])}
+            for row in rows}
+
+def get_archived_chat_history(sha1_of_username: str, limit: int = None, before_id: int = None):
+    """
+    Reads archived messages of a user back from their segments, oldest first: all of them, or
+    the last `limit` (before the message before_id). Only the segments needed are decompressed.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        user_id = _get_user_id(cursor, sha1_of_username)
+        if not user_id:
+            return []
+        segments = cursor.execute(
+            """
+            SELECT path FROM chat_archive_segments
+            WHERE user_id = ? AND first_message_id < ? ORDER BY last_message_id DESC
+            """,
+            (user_id, before_id if before_id is not None else 2**63 - 1)
+        ).fetchall()
+    messages = []
+    for segment in segments:
+        with gzip.open(segment["path"], "rt", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f]
+        rows = [dict(row, archived=True) for row in rows if before_id is None or row["id"] < before_id]
+        messages = rows + messages
+        if limit is not None and len(messages) >= limit:
+            return messages[-limit:]
+    return messages
+
+def get_chat_transcript(sha1_of_username: str, limit: int):
+    """
+    The last `limit` messages of a user, archived ones included when the live history is
+    shorter. Returns {"messages": [...] oldest first, "has_more": bool}.
+    """
+    messages = get_chat_history(sha1_of_username, limit=limit + 1)
+    if len(messages) <= limit:
+        before_id = messages[0]["id"] if messages else None
+        messages = get_archived_chat_history(sha1_of_username, limit=limit + 1 - len(messages), before_id=before_id) + messages
+    return {"messages": messages[-limit:], "has_more": len(messages) > limit}
+
 # --- File Management Functions ---
 
 def upload_material(sha1_of_username: str, subject: str, chapter: str, file):
@@ -399,3 +1686,389 @@ def delete_temporary_chat(sha1_of_username: str):
             except Exception as e:
                 return ("error", str(e))
     return "success"
+
+
+# --- Extracted Text Store ---
+# Page texts of parsed PDF and Word files, gzip-compressed JSON keyed by the sha256 of the
+# file content and the extractor version. Entries are shared by every user and chapter
+# with the same file, survive restarts, and the least recently used ones are deleted
+# once the store grows past EXTRACTED_TEXT_MAX_BYTES.
+EXTRACTED_TEXT_DIR = os.path.join(".cache", "extracted_text")
+EXTRACTED_TEXT_MAX_BYTES = int(os.getenv("EXTRACTED_TEXT_CACHE_MB", "512")) * 2**20
+# Saves add to a running total of the store size, so the store is only walked when that
+# total passes the cap, or every EXTRACTED_TEXT_RESCAN_EVERY saves to catch up with
+# entries written by other processes
+EXTRACTED_TEXT_RESCAN_EVERY = 64
+_extracted_text_bytes = None
+_extracted_text_saves = itertools.count(1)
+_extracted_text_lock = threading.Lock()
+
+def _extracted_text_path(content_sha256: str, extractor: str):
+    return os.path.join(EXTRACTED_TEXT_DIR, content_sha256[:2], f"{content_sha256}.{extractor}.json.gz")
+
+def get_extracted_pages(content_sha256: str, extractor: str):
+    """Returns the stored pages of a file content, or None. A hit marks the entry as recently used."""
+    path = _extracted_text_path(content_sha256, extractor)
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            pages = json.load(f)
+        os.utime(path)
+    except (OSError, EOFError, ValueError):
+        # Missing, evicted meanwhile or truncated: extracting again rewrites it
+        return None
+    return pages
+
+def save_extracted_pages(content_sha256: str, extractor: str, pages: list):
+    """Stores the pages of a file content, then evicts old entries if the store is over its cap."""
+    global _extracted_text_bytes
+    path = _extracted_text_path(content_sha256, extractor)
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    data = gzip.compress(json.dumps(pages, ensure_ascii=False).encode("utf-8"), compresslevel=6)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        # The store only saves time; indexing goes on without it
+        print(f"Could not store extracted text: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+    with _extracted_text_lock:
+        if _extracted_text_bytes is not None:
+            _extracted_text_bytes += len(data)
+        rescan = (_extracted_text_bytes is None or _extracted_text_bytes > EXTRACTED_TEXT_MAX_BYTES
+                  or next(_extracted_text_saves) % EXTRACTED_TEXT_RESCAN_EVERY == 0)
+    if rescan:
+        try:
+            evict_extracted_text()
+        except OSError as e:
+            print(f"Could not evict extracted text: {e}")
+
+def evict_extracted_text(max_bytes: int = None):
+    """Deletes least recently used entries until the store fits max_bytes. Returns the bytes freed."""
+    global _extracted_text_bytes
+    max_bytes = EXTRACTED_TEXT_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for root, _, files in os.walk(EXTRACTED_TEXT_DIR):
+        for name in files:
+            if name.endswith(".json.gz"):
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    total = sum(size for _, size, _ in entries)
+    freed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        freed += size
+    with _extracted_text_lock:
+        _extracted_text_bytes = total
+    return freed
+
+
+# --- Vector Index Version Functions ---
+# Each chapter index lives in its own immutable version directory under
+# <user>/data/<subject>/<chapter>/versions/. The CURRENT file names the published
+# version and is swapped atomically with os.replace, so readers never see a
+# half-built index and a crashed build leaves the previous version in place.
+INDEX_POINTER_FILE = "CURRENT"
+INDEX_MANIFEST_FILE = "manifest.json"
+INDEX_CHUNKS_FILE = "chunks.json"
+INDEX_SUMMARIES_FILE = "summaries.json"
+INDEX_VERSIONS_DIR = "versions"
+INDEX_VERSIONS_TO_KEEP = 2
+INDEX_STALE_BUILD_SECONDS = 3600
+LEGACY_INDEX_VERSION = "legacy"
+
+def get_index_root(sha1_of_username: str, subject: str, chapter: str):
+    """Returns the directory holding all index versions of a chapter."""
+    return os.path.join(sha1_of_username, "data", subject, chapter)
+
+def get_current_index_version(sha1_of_username: str, subject: str, chapter: str):
+    """Returns the published index version of a chapter, or None if there is none."""
+    index_root = get_index_root(sha1_of_username, subject, chapter)
+    try:
+        with open(os.path.join(index_root, INDEX_POINTER_FILE), "r", encoding="utf-8") as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        # Indexes built before versioning were saved straight into the chapter directory
+        if os.path.exists(os.path.join(index_root, "index.faiss")):
+            return LEGACY_INDEX_VERSION
+        return None
+    return version or None
+
+def get_index_dir(sha1_of_username: str, subject: str, chapter: str, version=None):
+    """Returns the directory of an index version (the current one by default)."""
+    if version is None:
+        version = get_current_index_version(sha1_of_username, subject, chapter)
+        if version is None:
+            return None
+    index_root = get_index_root(sha1_of_username, subject, chapter)
+    if version == LEGACY_INDEX_VERSION:
+        return index_root
+    return os.path.join(index_root, INDEX_VERSIONS_DIR, version)
+
+def create_index_version_dir(sha1_of_username: str, subject: str, chapter: str):
+    """Creates an empty, unpublished version directory and returns (version, path)."""
+    # Nanosecond timestamps keep version names unique and sortable by age
+    version = f"v{time.time_ns()}"
+    version_dir = get_index_dir(sha1_of_username, subject, chapter, version)
+    os.makedirs(version_dir)
+    return version, version_dir
+
+def _write_file_atomically(path: str, content: str):
+    """Writes content to a temporary file and renames it over path."""
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def publish_index_version(sha1_of_username: str, subject: str, chapter: str, version: str, manifest: dict):
+    """Writes the manifest of a fully built version and makes it the current one."""
+    version_dir = get_index_dir(sha1_of_username, subject, chapter, version)
+    manifest = {**manifest, "version": version, "created_at": datetime.datetime.now().isoformat()}
+    _write_file_atomically(os.path.join(version_dir, INDEX_MANIFEST_FILE), json.dumps(manifest, indent=2))
+    _write_file_atomically(os.path.join(get_index_root(sha1_of_username, subject, chapter), INDEX_POINTER_FILE), version)
+    return version
+
+def update_index_manifest(sha1_of_username: str, subject: str, chapter: str, version: str, **fields):
+    """Sets fields of the manifest of a published version (e.g. once a missing summary tree is filled in)."""
+    manifest = {**(read_index_manifest(sha1_of_username, subject, chapter, version) or {}), **fields}
+    version_dir = get_index_dir(sha1_of_username, subject, chapter, version)
+    _write_file_atomically(os.path.join(version_dir, INDEX_MANIFEST_FILE), json.dumps(manifest, indent=2))
+    return manifest
+
+def read_index_manifest(sha1_of_username: str, subject: str, chapter: str, version=None):
+    """Returns the manifest of an index version (the current one by default), or None."""
+    version_dir = get_index_dir(sha1_of_username, subject, chapter, version)
+    if version_dir is None:
+        return None
+    try:
+        with open(os.path.join(version_dir, INDEX_MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+# The chunk table stores the citation metadata, topic label and vector cluster of every chunk
+# of a version, in FAISS insertion order, as integer rows with file names, headings and topics
+# interned: {"sources": [...], "headings": [...], "topics": [...],
+#  "rows": [[source, page, start, end, heading or -1, topic or -1, cluster or -1], ...],
+#  "duplicates": {"<chunk id>": [[source, page, start, end, heading or -1], ...]}}
+# "duplicates" keeps the provenance of the near-duplicate chunks collapsed into a chunk.
+def build_chunk_table(chunk_metadata: list):
+    """Returns the chunk table of chunks from their metadata dicts, with repeated strings interned."""
+    sources, headings, topics, rows, duplicates = {}, {}, {}, [], {}
+
+    def location(metadata):
+        source = sources.setdefault(metadata["source"], len(sources))
+        heading = headings.setdefault(metadata["heading"], len(headings)) if metadata.get("heading") else -1
+        return [source, metadata["page"], metadata["start_offset"], metadata["end_offset"], heading]
+
+    for chunk_id, metadata in enumerate(chunk_metadata):
+        row = location(metadata)
+        topic = topics.setdefault(metadata["topic"], len(topics)) if metadata.get("topic") else -1
+        cluster = metadata["cluster"] if metadata.get("cluster") is not None else -1
+        rows.append(row + [topic, cluster])
+        if metadata.get("duplicates"):
+            duplicates[str(chunk_id)] = [location(duplicate) for duplicate in metadata["duplicates"]]
+    return {"sources": list(sources), "headings": list(headings), "topics": list(topics), "rows": rows,
+            "duplicates": duplicates}
+
+def write_chunk_table(version_dir: str, chunk_metadata: list):
+    """Writes the chunk table of an index version from the metadata dicts of its chunks."""
+    table = build_chunk_table(chunk_metadata)
+    _write_file_atomically(os.path.join(version_dir, INDEX_CHUNKS_FILE), json.dumps(table, separators=(",", ":")))
+
+@functools.lru_cache(maxsize=32)
+def read_chunk_table(sha1_of_username: str, subject: str, chapter: str, version: str):
+    """Returns the chunk table of an index version, or None for versions built without one."""
+    version_dir = get_index_dir(sha1_of_username, subject, chapter, version)
+    if version_dir is None:
+        return None
+    try:
+        with open(os.path.join(version_dir, INDEX_CHUNKS_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def get_chunk_citation(chunk_table: dict, chunk_id: int):
+    """Returns {"source", "page", "start_offset", "end_offset", "heading"} of one chunk."""
+    source, page, start_offset, end_offset, heading = chunk_table["rows"][chunk_id][:5]
+    return {
+        "source": chunk_table["sources"][source],
+        "page": page,
+        "start_offset": start_offset,
+        "end_offset": end_offset,
+        "heading": chunk_table["headings"][heading] if heading >= 0 else None,
+    }
+
+# The summary tree of a version: section summaries (runs of consecutive chunks of a file),
+# merged into one summary per file and one for the chapter:
+# {"root": node id, "nodes": [{"id", "level": "section" | "group" | "file" | "chapter",
+#  "title", "source", "sha256" (of the summarized input), "summary", "children", "chunk_ids"}, ...]}
+def write_summary_tree(version_dir: str, tree: dict):
+    """Writes the summary tree of an index version."""
+    _write_file_atomically(os.path.join(version_dir, INDEX_SUMMARIES_FILE), json.dumps(tree, separators=(",", ":")))
+
+def read_summary_tree(sha1_of_username: str, subject: str, chapter: str, version: str):
+    """
+    Returns the summary tree of an index version, or None for versions built without one.
+    A failed tree is filled into the published version later (see fill_summary_tree()), so the
+    cache is keyed on the file's modification time and every process picks the new tree up.
+    """
+    version_dir = get_index_dir(sha1_of_username, subject, chapter, version)
+    if version_dir is None:
+        return None
+    path = os.path.join(version_dir, INDEX_SUMMARIES_FILE)
+    try:
+        modified_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _read_summary_tree_file(path, modified_ns)
+
+@functools.lru_cache(maxsize=32)
+def _read_summary_tree_file(path: str, modified_ns: int):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def get_summary_nodes(tree: dict, level: str, source=None):
+    """Returns the nodes of a summary tree at one level, optionally of one material file, in document order."""
+    return [node for node in tree["nodes"] if node["level"] == level and (source is None or node["source"] == source)]
+
+def get_chunk_duplicates(chunk_table: dict, chunk_id: int):
+    """Returns the locations ({"source", "page", ...} like get_chunk_citation) of the near-duplicates collapsed into a chunk."""
+    return [{
+        "source": chunk_table["sources"][source],
+        "page": page,
+        "start_offset": start_offset,
+        "end_offset": end_offset,
+        "heading": chunk_table["headings"][heading] if heading >= 0 else None,
+    } for source, page, start_offset, end_offset, heading in chunk_table.get("duplicates", {}).get(str(chunk_id), [])]
+
+def get_chunk_topic(chunk_table: dict, chunk_id: int):
+    """Returns the topic label of one chunk, or None for tables written without topics."""
+    row = chunk_table["rows"][chunk_id]
+    return chunk_table["topics"][row[5]] if len(row) > 5 and row[5] >= 0 else None
+
+def get_topic_chunks(chunk_table: dict):
+    """Returns {topic: [chunk ids]} of an index version."""
+    topic_chunks = {}
+    for chunk_id, row in enumerate(chunk_table["rows"]):
+        if len(row) > 5 and row[5] >= 0:
+            topic_chunks.setdefault(chunk_table["topics"][row[5]], []).append(chunk_id)
+    return topic_chunks
+
+def get_cluster_chunks(chunk_table: dict, source=None):
+    """Returns {cluster: [chunk ids]} of an index version, or of one of its material files."""
+    if source is not None and source not in chunk_table["sources"]:
+        return {}
+    source_id = chunk_table["sources"].index(source) if source is not None else None
+    duplicates = chunk_table.get("duplicates", {})
+    cluster_chunks = {}
+    for chunk_id, row in enumerate(chunk_table["rows"]):
+        # A chunk also belongs to the files its collapsed near-duplicates came from
+        in_source = source_id is None or row[0] == source_id or any(
+            duplicate[0] == source_id for duplicate in duplicates.get(str(chunk_id), []))
+        if len(row) > 6 and row[6] >= 0 and in_source:
+            cluster_chunks.setdefault(row[6], []).append(chunk_id)
+    return cluster_chunks
+
+def gc_index_versions(sha1_of_username: str, subject: str, chapter: str, keep: int = INDEX_VERSIONS_TO_KEEP):
+    """Removes old published versions and abandoned builds. Returns the removed versions."""
+    current = get_current_index_version(sha1_of_username, subject, chapter)
+    index_root = get_index_root(sha1_of_username, subject, chapter)
+    versions_dir = os.path.join(index_root, INDEX_VERSIONS_DIR)
+    if current is None or not os.path.isdir(versions_dir):
+        return []
+
+    removed = []
+    published_kept = 1 if current != LEGACY_INDEX_VERSION else 0
+    for version in sorted(os.listdir(versions_dir), reverse=True):
+        if version == current:
+            continue
+        version_dir = os.path.join(versions_dir, version)
+        if os.path.exists(os.path.join(version_dir, INDEX_MANIFEST_FILE)):
+            if published_kept < keep:
+                published_kept += 1
+                continue
+        elif time.time() - os.path.getmtime(version_dir) < INDEX_STALE_BUILD_SECONDS:
+            continue  # Possibly a build still running in another session
+        shutil.rmtree(version_dir, ignore_errors=True)
+        removed.append(version)
+
+    # Drop the pre-versioning index files once a versioned index has replaced them
+    if current != LEGACY_INDEX_VERSION:
+        for legacy_file in ("index.faiss", "index.pkl"):
+            legacy_path = os.path.join(index_root, legacy_file)
+            if os.path.isfile(legacy_path):
+                os.remove(legacy_path)
+    return removed
+
+# Fitted local embedding models of a subject, content-addressed by the materials they were
+# fitted on. Index manifests name the model they were built with ("embedding": {"model"}).
+EMBEDDING_MODELS_DIR = ".embeddings"
+
+def get_embedding_model_path(sha1_of_username: str, subject: str, model: str):
+    """Returns the path of a fitted local embedding model of a subject."""
+    return os.path.join(sha1_of_username, "data", subject, EMBEDDING_MODELS_DIR, f"{model}.npz")
+
+def gc_embedding_models(sha1_of_username: str, subject: str):
+    """Removes the embedding models of a subject that no index version refers to. Returns their names."""
+    subject_dir = os.path.join(sha1_of_username, "data", subject)
+    models_dir = os.path.join(subject_dir, EMBEDDING_MODELS_DIR)
+    if not os.path.isdir(models_dir):
+        return []
+    referenced = set()
+    for chapter in os.listdir(subject_dir):
+        versions_dir = os.path.join(subject_dir, chapter, INDEX_VERSIONS_DIR)
+        if chapter == EMBEDDING_MODELS_DIR or not os.path.isdir(versions_dir):
+            continue
+        for version in os.listdir(versions_dir):
+            manifest = read_index_manifest(sha1_of_username, subject, chapter, version)
+            if manifest and manifest.get("embedding", {}).get("model"):
+                referenced.add(manifest["embedding"]["model"])
+
+    removed = []
+    for file_name in os.listdir(models_dir):
+        model, extension = os.path.splitext(file_name)
+        if extension != ".npz" or model in referenced:
+            continue
+        if time.time() - os.path.getmtime(os.path.join(models_dir, file_name)) < INDEX_STALE_BUILD_SECONDS:
+            continue  # Possibly fitted for a build still running in another session
+        os.remove(os.path.join(models_dir, file_name))
+        removed.append(model)
+    return removed
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Maintenance commands for AI Study Coach.")
+    parser.add_argument("command", choices=["download-assets", "archive-chat", "upgrade-db"])
+    parser.add_argument("--days", type=float, default=None, help="archive-chat: archive messages older than this.")
+    args = parser.parse_args()
+    if args.command == "download-assets":
+        print(f"Downloaded {', '.join(download_mindmap_assets())} into {STATIC_DIR}")
+    elif args.command == "archive-chat":
+        ensure_db()
+        for key, value in archive_chat_history(args.days).items():
+            print(f"{key}: {value}")
+    elif args.command == "upgrade-db":
+        ensure_db()
+        converted = enable_incremental_vacuum()
+        print("Switched the database to incremental vacuum." if converted else "The database already uses incremental vacuum.")
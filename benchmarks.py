@@ -0,0 +1,1364 @@
+"""
+Offline benchmarks for AI Study Coach.
+
+Run from the repository root, for example:
+    python benchmarks.py chunking
+    python benchmarks.py chunking --corpus path/to/materials --settings 1000:100,2000:200,legacy
+    python benchmarks.py embeddings --candidates bm25,fake,hashing,tfidf
+    python benchmarks.py e2e --provider fake --llm-latency 0.5 --concurrency 8
+    python benchmarks.py startup
+    python benchmarks.py retrieval --workers 4 --sessions 8
+    python benchmarks.py cache --replicas 3 --backends memory,disk,redis
+    python benchmarks.py coalesce --sessions 20 --llm-latency 0.5
+    python benchmarks.py flashcards --cards 50000
+    python benchmarks.py attempts --attempts 1000000
+    python benchmarks.py search --messages 2000000
+    python benchmarks.py retention --messages 300000 --retention-days 180
+    python benchmarks.py adaptive --weak-topics 3 --draws 500
+    python benchmarks.py coverage --prompts 10
+    python benchmarks.py dedup --editions 3 --edit-rate 0.02
+    python benchmarks.py summaries --llm-latency 0.2
+    python benchmarks.py extraction --documents 10 --pages 40
+    python benchmarks.py tempchat --documents 8 --pages 6
+"""
+import os
+import re
+import sys
+import math
+import time
+import random
+import shutil
+import argparse
+import itertools
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+SENTENCE_PATTERN = re.compile(r"[^.!?\n]{40,}[.!?]")
+
+
+# ================= Shared helpers =================
+def percentile(values, pct):
+    """Returns the pct-th percentile of values using linear interpolation."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def print_table(rows, columns):
+    """Prints a list of dicts as a fixed-width table."""
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(str(row[c]).ljust(widths[c]) for c in columns))
+
+def measure(operation, iterations, concurrency=1):
+    """
+    Calls operation(i) for i in range(iterations) on `concurrency` threads.
+    Returns a row with p50/p95 latency in milliseconds and throughput in operations per second.
+    """
+    def timed(i):
+        start = time.perf_counter()
+        operation(i)
+        return (time.perf_counter() - start) * 1000
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, range(iterations)))
+    wall = time.perf_counter() - wall_start
+    return {
+        "n": iterations,
+        "p50_ms": f"{percentile(latencies, 50):.1f}",
+        "p95_ms": f"{percentile(latencies, 95):.1f}",
+        "ops_per_s": f"{iterations / wall:.2f}",
+    }
+
+def use_offline_provider(provider, llm_latency=0.0, token_latency=0.0, embedding_latency=0.0, port=8765):
+    """
+    Points ai_features at the fake or local provider. Must run before ai_features creates
+    its cached model. Returns the local stand-in server when one was started.
+    """
+    os.environ["AI_PROVIDER"] = provider
+    os.environ["FAKE_LLM_LATENCY"] = str(llm_latency)
+    os.environ["FAKE_LLM_TOKEN_LATENCY"] = str(token_latency)
+    os.environ["FAKE_EMBEDDING_LATENCY"] = str(embedding_latency)
+    if provider != "local":
+        return None
+    from providers import start_local_provider_server
+    os.environ["LOCAL_PROVIDER_URL"] = f"http://127.0.0.1:{port}"
+    return start_local_provider_server(port=port, latency=llm_latency, token_latency=token_latency,
+                                       embedding_latency=embedding_latency)
+
+def tokenize(text):
+    return WORD_PATTERN.findall(text.lower())
+
+def read_corpus(corpus_dir):
+    """Returns [(file_name, doc_type, pages)] of the supported files of a directory."""
+    from ai_features import extract_pages
+    documents = []
+    for file_name in sorted(os.listdir(corpus_dir)):
+        doc_type, pages = extract_pages(os.path.join(corpus_dir, file_name))
+        if doc_type is not None:
+            documents.append((file_name, doc_type, pages))
+    if not documents:
+        raise SystemExit(f"No supported files found in {corpus_dir}")
+    return documents
+
+def sample_probes(documents, count, seed):
+    """Picks probe sentences from the corpus, so every setting answers the same questions."""
+    rng = random.Random(seed)
+    sentences = [m.group(0).strip() for _, _, pages in documents for page in pages for m in SENTENCE_PATTERN.finditer(page)]
+    return rng.sample(sentences, min(count, len(sentences)))
+
+def probe_query(probe):
+    """Students paraphrase, so only a few of the probe's words make it into the query."""
+    words = [w for w in probe.split() if len(w) > 3] or probe.split()
+    return " ".join(random.Random(probe).sample(words, max(1, len(words) // 3)))
+
+def write_synthetic_corpus(target_dir, num_documents=3, pages_per_document=8, seed=7):
+    """Writes a deterministic corpus of paged, sectioned .txt files and returns its directory."""
+    rng = random.Random(seed)
+    syllables = ["ka", "lo", "mi", "ter", "vas", "on", "pre", "ly", "dun", "si", "gra", "phe", "nor", "tu"]
+    common = ["the", "of", "and", "is", "in", "which", "a", "to", "by", "with", "from", "that"]
+
+    def word():
+        return "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+
+    os.makedirs(target_dir, exist_ok=True)
+    for doc in range(num_documents):
+        pages = []
+        for page in range(pages_per_document):
+            lines = []
+            for section in range(rng.randint(2, 3)):
+                vocabulary = [word() for _ in range(25)]
+                lines.append(f"{doc + 1}.{page * 3 + section + 1} {vocabulary[0].title()} {vocabulary[1].title()}")
+                for _ in range(rng.randint(2, 4)):
+                    sentences = []
+                    for _ in range(rng.randint(3, 6)):
+                        words = [rng.choice(vocabulary if rng.random() < 0.6 else common) for _ in range(rng.randint(9, 18))]
+                        sentences.append(" ".join(words).capitalize() + ".")
+                    lines.append(" ".join(sentences))
+                    lines.append("")
+            pages.append("\n".join(lines))
+        with open(os.path.join(target_dir, f"document_{doc + 1}.txt"), "w", encoding="utf-8") as f:
+            f.write("\f".join(pages))
+    return target_dir
+
+def write_pdf(path, pages, line_chars=90, lines_per_page=60):
+    """Writes a plain text-only PDF (Helvetica, one content stream per page) without a PDF library."""
+    def escape(text):
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page in pages:
+        lines = [line[i:i + line_chars] for line in page.splitlines() for i in range(0, max(len(line), 1), line_chars)]
+        stream = "BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({escape(line)}) '" for line in lines[:lines_per_page]) + " ET"
+        objects.append(f"<< /Length {len(stream.encode('latin-1', 'replace'))} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {len(objects)} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> >> >>")
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>"
+
+    data, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1", "replace")
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    data += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+
+class BM25:
+    """Small lexical retriever so retrieval quality can be measured without embeddings."""
+
+    def __init__(self, texts, k1=1.5, b=0.75):
+        self.k1, self.b = k1, b
+        self.docs = [Counter(tokenize(t)) for t in texts]
+        self.lengths = [sum(d.values()) for d in self.docs]
+        self.avg_length = sum(self.lengths) / max(len(self.lengths), 1)
+        document_frequency = Counter(term for d in self.docs for term in d)
+        n = len(self.docs)
+        self.idf = {t: math.log(1 + (n - df + 0.5) / (df + 0.5)) for t, df in document_frequency.items()}
+
+    def search(self, query, k=4):
+        terms = [t for t in set(tokenize(query)) if t in self.idf]
+        scores = []
+        for i, doc in enumerate(self.docs):
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avg_length)
+            score = sum(self.idf[t] * doc[t] * (self.k1 + 1) / (doc[t] + norm) for t in terms if t in doc)
+            scores.append((score, i))
+        scores.sort(reverse=True)
+        return [i for _, i in scores[:k]]
+
+
+# ================= Chunking benchmark =================
+def parse_chunk_settings(settings):
+    """Parses "1000:100,2000:200,legacy" into [(label, size, overlap), ...]."""
+    parsed = []
+    for item in settings.split(","):
+        item = item.strip()
+        if item == "legacy":
+            parsed.append(("legacy 8000:2000", 8000, 2000))
+        elif item == "profile":
+            parsed.append(("profile", None, None))
+        else:
+            size, overlap = item.split(":")
+            parsed.append((f"{size}:{overlap}", int(size), int(overlap)))
+    return parsed
+
+def run_chunking_benchmark(args):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from ai_features import chunk_document, estimate_tokens
+
+    corpus_dir = args.corpus or write_synthetic_corpus(tempfile.mkdtemp(prefix="chunking_corpus_"))
+    documents = read_corpus(corpus_dir)
+    probes = sample_probes(documents, args.probes, args.seed)
+
+    rows = []
+    for label, size, overlap in parse_chunk_settings(args.settings):
+        if label.startswith("legacy"):
+            # The pre-structure splitter: all files concatenated, fixed windows
+            all_text = "\n".join("\n".join(pages) for _, _, pages in documents)
+            splitter = RecursiveCharacterTextSplitter(chunk_size=size, chunk_overlap=overlap)
+            texts = splitter.split_text(all_text)
+        else:
+            texts = [chunk["text"]
+                     for file_name, doc_type, pages in documents
+                     for chunk in chunk_document(pages, file_name, doc_type, size, overlap)]
+
+        retriever = BM25(texts)
+        hits, context_tokens = 0, 0
+        for probe in probes:
+            top = retriever.search(probe_query(probe), k=args.k)
+            hits += any(probe in texts[i] for i in top)
+            context_tokens += sum(estimate_tokens(texts[i]) for i in top)
+
+        embedding_tokens = sum(estimate_tokens(t) for t in texts)
+        rows.append({
+            "setting": label,
+            "chunks": len(texts),
+            "embedding_tokens": embedding_tokens,
+            "avg_chunk_tokens": embedding_tokens // max(len(texts), 1),
+            f"hit_rate@{args.k}": f"{hits / max(len(probes), 1):.3f}",
+            f"context_tokens@{args.k}": context_tokens // max(len(probes), 1),
+        })
+
+    print(f"Corpus: {corpus_dir} ({len(documents)} files, {len(probes)} probes)")
+    print_table(rows, list(rows[0].keys()))
+
+
+def print_llm_task_stats(stats):
+    """Prints the per-task LLM usage that feeds the model routing."""
+    rows = [{"task": row["task"], "profile": row["profile"], "model": f'{row["provider"]}/{row["model"]}',
+             "calls": row["calls"], "mean_ms": f'{row["mean_seconds"] * 1000:.1f}',
+             "max_ms": f'{row["max_seconds"] * 1000:.1f}', "error_rate": f'{row["error_rate"]:.2f}',
+             "usd_per_call": f'{row["cost_per_call"]:.6f}'} for row in stats]
+    if rows:
+        print("\nLLM usage by task")
+        print_table(rows, list(rows[0].keys()))
+
+
+# ================= Embedding comparison =================
+EMBEDDING_CANDIDATES = ("bm25", "fake", "hashing", "tfidf", "google")
+
+def run_embeddings_benchmark(args):
+    import numpy as np
+    from providers import HashEmbeddings, LocalEmbeddings, create_embeddings
+    from ai_features import EMBEDDING_MODEL, chunk_document
+
+    corpus_dir = args.corpus or write_synthetic_corpus(tempfile.mkdtemp(prefix="embeddings_corpus_"),
+                                                       args.documents, args.pages)
+    documents = read_corpus(corpus_dir)
+    texts = [chunk["text"] for file_name, doc_type, pages in documents
+             for chunk in chunk_document(pages, file_name, doc_type)]
+    probes = sample_probes(documents, args.probes, args.seed)
+    queries = [probe_query(probe) for probe in probes]
+
+    rows = []
+    for name in args.candidates.split(","):
+        name = name.strip()
+        if name not in EMBEDDING_CANDIDATES:
+            raise SystemExit(f"Unknown candidate '{name}'. Expected some of {', '.join(EMBEDDING_CANDIDATES)}.")
+        fit_ms, embed_s, query_ms = 0.0, 0.0, []
+        if name == "bm25":
+            retriever = BM25(texts)
+            search = lambda query: retriever.search(query, k=args.k)
+            dimensions = "-"
+        else:
+            if name == "fake":
+                embeddings = HashEmbeddings()
+            elif name == "google":
+                embeddings = create_embeddings("google", EMBEDDING_MODEL, google_api_key=os.getenv("GOOGLE_API_KEY"))
+            else:
+                embeddings = LocalEmbeddings(name)
+                if name == "tfidf":
+                    start = time.perf_counter()
+                    embeddings.fit(texts)
+                    fit_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            matrix = np.array(embeddings.embed_documents(texts), dtype=np.float32)
+            embed_s = time.perf_counter() - start
+            dimensions = matrix.shape[1]
+
+            def search(query):
+                query_start = time.perf_counter()
+                vector = np.array(embeddings.embed_query(query), dtype=np.float32)
+                query_ms.append((time.perf_counter() - query_start) * 1000)
+                # Every candidate returns unit vectors, so the dot product is the cosine similarity
+                return np.argsort(-(matrix @ vector))[:args.k]
+
+        hits = sum(any(probe in texts[i] for i in search(query)) for probe, query in zip(probes, queries))
+        rows.append({
+            "embeddings": name,
+            "dimensions": dimensions,
+            "fit_ms": f"{fit_ms:.0f}",
+            "chunks_per_s": f"{len(texts) / embed_s:.0f}" if embed_s else "-",
+            "query_p50_ms": f"{percentile(query_ms, 50):.2f}" if query_ms else "-",
+            f"hit_rate@{args.k}": f"{hits / max(len(probes), 1):.3f}",
+        })
+
+    print(f"Corpus: {corpus_dir} ({len(documents)} files, {len(texts)} chunks, {len(probes)} probes)")
+    print_table(rows, list(rows[0].keys()))
+
+
+# ================= End-to-end benchmark =================
+def run_e2e_benchmark(args):
+    server = use_offline_provider(args.provider, args.llm_latency, args.token_latency, args.embedding_latency, args.port)
+    if args.metrics_file:
+        import telemetry
+        telemetry.enable()
+        args.metrics_file = os.path.abspath(args.metrics_file)
+    if args.routes_file:
+        os.environ["MODEL_ROUTES_FILE"] = os.path.abspath(args.routes_file)
+    workdir = tempfile.mkdtemp(prefix="e2e_benchmark_")
+    os.chdir(workdir)
+
+    import backend
+    import ai_features
+    backend.ensure_db()
+    user, subject, chapter = "benchmark_user", "Benchmark", "Chapter 1"
+    write_synthetic_corpus(os.path.join(user, "materials", subject, chapter), args.documents, args.pages)
+
+    rows = [{"scenario": "indexing", **measure(lambda i: ai_features.build_vector_store(user, subject, chapter), args.index_iterations)}]
+    vector_db = ai_features.load_vector_store(user, subject, chapter)
+    questions = [f"What does section {i % 20 + 1} say about {word}?"
+                 for i, word in enumerate(["structure", "process", "function", "origin", "effect"] * args.iterations)]
+    scenarios = [
+        ("chat", lambda i: ai_features.get_chat_response(questions[i], vector_db)),
+        ("quiz", lambda i: ai_features.generate_quiz_from_faiss(vector_db, 5)),
+        ("exam_generation", lambda i: ai_features.generate_exam_from_faiss(vector_db, 10, 5)),
+        ("exam_grading", lambda i: ai_features.evaluate_exam("Water boils at 100 C at sea level.", f"About {90 + i % 10} C.", 5)),
+        ("mindmap", lambda i: ai_features.generate_mindmap_from_faiss(vector_db)),
+    ]
+    for name, operation in scenarios:
+        if args.only and name not in args.only:
+            continue
+        rows.append({"scenario": name, **measure(operation, args.iterations, args.concurrency)})
+
+    print(f"Provider: {args.provider}, LLM latency {args.llm_latency}s, concurrency {args.concurrency}, workdir {workdir}")
+    print_table(rows, list(rows[0].keys()))
+    print_llm_task_stats(backend.get_llm_task_stats())
+    if args.metrics_file:
+        telemetry.write_prometheus_file(args.metrics_file)
+        print(f"Per-stage metrics written to {args.metrics_file}")
+    if server:
+        server.shutdown()
+
+
+# ================= Request coalescing benchmark =================
+def run_concurrently(operation, sessions):
+    """Starts operation(i) on `sessions` threads at the same instant. Returns (results, errors, wall seconds)."""
+    barrier = threading.Barrier(sessions)
+    results, errors = [None] * sessions, [None] * sessions
+
+    def session(i):
+        barrier.wait()
+        try:
+            results[i] = operation(i)
+        except Exception as e:
+            errors[i] = e
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        list(pool.map(session, range(sessions)))
+    return results, errors, time.perf_counter() - start
+
+def run_coalesce_benchmark(args):
+    use_offline_provider("fake", args.llm_latency)
+    os.chdir(tempfile.mkdtemp(prefix="coalesce_test_"))
+    import backend
+    import ai_features
+    backend.ensure_db()
+    user, subject, chapter = "benchmark_user", "Benchmark", "Chapter 1"
+    write_synthetic_corpus(os.path.join(user, "materials", subject, chapter), 2, 4)
+    ai_features.build_vector_store(user, subject, chapter)
+    vector_db = ai_features.load_vector_store(user, subject, chapter)
+
+    def model_calls(task):
+        return sum(row["calls"] for row in backend.get_llm_task_stats() if row["task"] == task)
+
+    cases = [
+        ("identical prompt", "chat", lambda i: ai_features.invoke_llm("chat", "Explain osmosis.")),
+        ("distinct prompts", "general_chat", lambda i: ai_features.invoke_llm("general_chat", f"Question {i}")),
+        ("mindmap, class opens chapter", "mindmap", lambda i: ai_features.generate_mindmap_from_faiss(vector_db)),
+        ("quiz, same request", "quiz", lambda i: ai_features.generate_quiz_from_faiss(vector_db, 5)),
+    ]
+    rows = []
+    for name, task, operation in cases:
+        before = model_calls(task)
+        _, errors, wall = run_concurrently(operation, args.sessions)
+        rows.append({"case": name, "sessions": args.sessions, "model_calls": model_calls(task) - before,
+                     "errors": sum(1 for e in errors if e), "wall_s": f"{wall:.2f}"})
+
+    print(f"Fake LLM latency {args.llm_latency}s, {args.sessions} concurrent sessions")
+    print_table(rows, list(rows[0].keys()))
+
+
+# ================= Flashcard scheduler benchmark =================
+def run_flashcards_benchmark(args):
+    os.chdir(tempfile.mkdtemp(prefix="flashcards_benchmark_"))
+    import backend
+    backend.ensure_db()
+    user = backend.generate_sha1_hash("benchmark_user")
+    backend.signup_user("benchmark_user", "benchmark")
+    chapters = [f"Chapter {i + 1}" for i in range(args.chapters)]
+    for chapter in chapters:
+        backend.add_chapter(user, "Benchmark", chapter)
+
+    # Cards were added over the last months, so their due times spread from overdue to weeks ahead
+    rng = random.Random(args.seed)
+    now = int(time.time())
+    start = time.perf_counter()
+    batch = 1000
+    for offset in range(0, args.cards, batch):
+        chapter = chapters[(offset // batch) % len(chapters)]
+        cards = [{"question": f"Question {i}?", "answer": f"Answer {i}."} for i in range(offset, min(offset + batch, args.cards))]
+        backend.add_flashcards(user, "Benchmark", chapter, cards, now=now + rng.randint(-30, 30) * backend.SECONDS_PER_DAY)
+    print(f"Inserted {args.cards} cards in {args.chapters} chapters in {time.perf_counter() - start:.1f}s")
+
+    with backend.get_db_connection() as conn:
+        plan = " ".join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM flashcards WHERE chapter_id = ? AND due_at <= ? ORDER BY due_at LIMIT ?",
+            (1, now, args.session_size)))
+    print(f"Due query plan: {plan}")
+
+    due_cards = backend.get_due_flashcards(user, "Benchmark", chapters[0], args.iterations * args.session_size)
+    grades = list(backend.FLASHCARD_GRADES.values())
+    rows = [
+        {"operation": f"load review session ({args.session_size} due cards)",
+         **measure(lambda i: backend.get_due_flashcards(user, "Benchmark", chapters[i % len(chapters)], args.session_size), args.iterations)},
+        {"operation": "due / total counts",
+         **measure(lambda i: backend.get_flashcard_counts(user, "Benchmark", chapters[i % len(chapters)]), args.iterations)},
+        {"operation": "grade one card",
+         **measure(lambda i: backend.review_flashcard(user, due_cards[i % len(due_cards)]["id"], grades[i % len(grades)]), args.iterations)},
+    ]
+    print_table(rows, list(rows[0].keys()))
+
+    intervals, state = [], (0, 0.0, 2.5)
+    for _ in range(5):
+        repetitions, interval_days, ease, _ = backend.schedule_sm2(*state, backend.FLASHCARD_GRADES["Good"])
+        state = (repetitions, interval_days, ease)
+        intervals.append(interval_days)
+    print(f"SM-2 intervals for consecutive 'Good' reviews (days): {intervals}")
+
+
+# ================= Attempt analytics benchmark =================
+def run_attempts_benchmark(args):
+    os.chdir(tempfile.mkdtemp(prefix="attempts_benchmark_"))
+    import backend
+    backend.ensure_db()
+    rng = random.Random(args.seed)
+    users = [f"student_{i}" for i in range(args.users)]
+    chapters = [f"Chapter {i + 1}" for i in range(args.chapters)]
+    for user in users:
+        backend.signup_user(user, "benchmark")
+        for chapter in chapters:
+            backend.add_chapter(backend.generate_sha1_hash(user), "Benchmark", chapter)
+    topics = [f"Topic {i + 1}" for i in range(args.topics)]
+
+    # Attempts go through the same incremental aggregate update as the app, in large transactions
+    start = time.perf_counter()
+    now = int(time.time())
+    with backend.get_db_connection() as conn:
+        cursor = conn.cursor()
+        chapter_rows = cursor.execute("SELECT c.id, s.user_id FROM chapters c JOIN subjects s ON c.subject_id = s.id").fetchall()
+        for i in range(args.attempts):
+            chapter_id, user_id = chapter_rows[rng.randrange(len(chapter_rows))]
+            answers = [{"question": f"Question {j}?", "topic": rng.choice(topics), "score": float(rng.random() < 0.7),
+                        "max_score": 1.0} for j in range(args.questions)]
+            backend._record_attempt(cursor, user_id, chapter_id, rng.choice(("quiz", "exam")), answers,
+                                    None, now - args.attempts + i)
+            if i % 50000 == 49999:
+                conn.commit()
+        conn.commit()
+    load_seconds = time.perf_counter() - start
+    print(f"Recorded {args.attempts} attempts ({args.attempts * args.questions} answers) for {len(chapter_rows)} chapters "
+          f"in {load_seconds:.1f}s ({args.attempts / load_seconds:.0f} attempts/s), database {os.path.getsize(backend.DB_FILE) / 2**20:.0f} MiB")
+
+    def pick(i):
+        return backend.generate_sha1_hash(users[i % len(users)]), chapters[(i * 7) % len(chapters)]
+
+    def dashboard_from_aggregates(i):
+        user, chapter = pick(i)
+        return backend.get_chapter_progress(user, "Benchmark", chapter), backend.get_weak_topics(user, "Benchmark", chapter)
+
+    def dashboard_by_scanning(i):
+        user, chapter = pick(i)
+        with backend.get_db_connection() as conn:
+            chapter_id = backend._get_chapter_id(conn.cursor(), user, "Benchmark", chapter)
+            kinds = conn.execute("SELECT kind, COUNT(*), SUM(score), SUM(max_score) FROM attempts WHERE chapter_id = ? GROUP BY kind",
+                                 (chapter_id,)).fetchall()
+            weak = conn.execute(
+                """
+                SELECT a.topic, SUM(a.score) / SUM(a.max_score) AS accuracy FROM attempt_answers a
+                JOIN attempts t ON a.attempt_id = t.id WHERE t.chapter_id = ?
+                GROUP BY a.topic HAVING COUNT(*) >= 3 ORDER BY accuracy LIMIT 5
+                """, (chapter_id,)).fetchall()
+        return kinds, weak
+
+    def record_one(i):
+        user, chapter = pick(i)
+        return backend.record_attempt(user, "Benchmark", chapter, "quiz",
+                                      [{"question": "Q?", "topic": topics[i % len(topics)], "score": 1.0, "max_score": 1.0}] * args.questions)
+
+    rows = [
+        {"operation": "dashboard from aggregates", **measure(dashboard_from_aggregates, args.iterations)},
+        {"operation": "dashboard by scanning attempts", **measure(dashboard_by_scanning, args.iterations)},
+        {"operation": "record attempt + aggregates", **measure(record_one, args.iterations)},
+    ]
+    print_table(rows, list(rows[0].keys()))
+
+
+# ================= Chat history search benchmark =================
+def run_search_benchmark(args):
+    os.chdir(tempfile.mkdtemp(prefix="search_benchmark_"))
+    import backend
+    backend.ensure_db()
+    rng = random.Random(args.seed)
+    users = [f"student_{i}" for i in range(args.users)]
+    for user in users:
+        backend.signup_user(user, "benchmark")
+        backend.add_chapter(backend.generate_sha1_hash(user), "Benchmark", "Chapter 1")
+
+    # Messages draw Zipf-distributed words from a synthetic vocabulary, like real text
+    vocabulary = [f"{rng.choice('bcdfghklmnprstvz')}{rng.choice('aeiou')}{rng.choice('lmnrst')}{i}" for i in range(args.vocabulary)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    def message():
+        return " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(5, 40)))
+
+    start = time.perf_counter()
+    batch = 50000
+    with backend.get_db_connection() as conn:
+        for offset in range(0, args.messages, batch):
+            conn.executemany("INSERT INTO chat_history (user_id, role, message) VALUES (?, ?, ?)",
+                             [(rng.randint(1, args.users), rng.choice(("user", "assistant")), message())
+                              for _ in range(min(batch, args.messages - offset))])
+            conn.commit()
+        chapter_ids = [row[0] for row in conn.execute("SELECT id FROM chapters ORDER BY id")]
+        conn.executemany("INSERT INTO flashcards (user_id, chapter_id, question, answer, due_at) VALUES (?, ?, ?, ?, 0)",
+                         [(user_id, chapter_ids[user_id - 1], message() + "?", message())
+                          for user_id in (rng.randint(1, args.users) for _ in range(args.flashcards))])
+        conn.commit()
+    load_seconds = time.perf_counter() - start
+    print(f"Inserted {args.messages} messages and {args.flashcards} flashcards for {args.users} users in {load_seconds:.1f}s "
+          f"({(args.messages + args.flashcards) / load_seconds:.0f} rows/s with the FTS triggers), "
+          f"database {os.path.getsize(backend.DB_FILE) / 2**20:.0f} MiB")
+
+    # Queries are a less common word, every other one with a common word; every third one is a prefix search
+    def query(i):
+        words = [vocabulary[rng.randrange(len(vocabulary) // 100, len(vocabulary) // 4)]]
+        if i % 2:
+            words.append(vocabulary[rng.randrange(len(vocabulary) // 100)])
+        if i % 3 == 0:
+            words[0] = words[0][:-1] + "*"
+        return backend.generate_sha1_hash(users[i % len(users)]), " ".join(words)
+    queries = [query(i) for i in range(args.iterations)]
+
+    def search_page(i):
+        return backend.search_history(*queries[i], limit=args.page_size + 1)
+
+    def search_third_page(i):
+        return backend.search_history(*queries[i], limit=args.page_size + 1, offset=2 * args.page_size)
+
+    def scan_history(i):
+        user, text = queries[i]
+        with backend.get_db_connection() as conn:
+            user_id = backend._get_user_id(conn.cursor(), user)
+            words = [word.rstrip("*") for word in text.split()]
+            return conn.execute(
+                "SELECT id, message FROM chat_history WHERE user_id = ? AND " + " AND ".join(["message LIKE ?"] * len(words))
+                + " ORDER BY timestamp DESC LIMIT ?", [user_id, *(f"%{word}%" for word in words), args.page_size]).fetchall()
+
+    hits = [len(search_page(i)) for i in range(args.iterations)]
+    rows = [
+        {"operation": f"ranked search, first page of {args.page_size}", **measure(search_page, args.iterations)},
+        {"operation": "ranked search, third page", **measure(search_third_page, args.iterations)},
+        {"operation": "LIKE scan of chat_history (before)", **measure(scan_history, min(args.iterations, 20))},
+        {"operation": "add chat message (+ FTS trigger)",
+         **measure(lambda i: backend.add_chat_message(queries[i][0], "user", message()), args.iterations)},
+    ]
+    print_table(rows, list(rows[0].keys()))
+    print(f"{sum(1 for hit in hits if hit)} of {len(hits)} queries found results")
+
+
+# ================= Chat history retention benchmark =================
+def run_retention_benchmark(args):
+    os.chdir(tempfile.mkdtemp(prefix="retention_benchmark_"))
+    import backend
+    backend.ensure_db()
+    rng = random.Random(args.seed)
+    users = [f"student_{i}" for i in range(args.users)]
+    for user in users:
+        backend.signup_user(user, "benchmark")
+
+    # A year of chats; half of the users stopped using the app some months ago
+    corpus = read_corpus(write_synthetic_corpus(tempfile.mkdtemp(prefix="retention_corpus_"), 4, 10))
+    sentences = [sentence for _, _, pages in corpus for page in pages for sentence in SENTENCE_PATTERN.findall(page)]
+    now = time.time()
+    last_active = {user_id: now - (0 if user_id % 2 else rng.uniform(200, 330)) * 86400 for user_id in range(1, args.users + 1)}
+    messages = []
+    for i in range(args.messages):
+        user_id = rng.randint(1, args.users)
+        age_days = 365 * (1 - i / args.messages)
+        sent_at = min(now - age_days * 86400, last_active[user_id])
+        messages.append((user_id, "user" if i % 2 else "assistant", " ".join(rng.choices(sentences, k=rng.randint(1, 6))),
+                         time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(sent_at))))
+    messages.sort(key=lambda message: message[3])
+    with backend.get_db_connection() as conn:
+        for offset in range(0, len(messages), 50000):
+            conn.executemany("INSERT INTO chat_history (user_id, role, message, timestamp) VALUES (?, ?, ?, ?)",
+                             messages[offset:offset + 50000])
+            conn.commit()
+
+    per_user = Counter(message[0] for message in messages)
+    heaviest = backend.generate_sha1_hash(users[max((user_id for user_id in per_user if user_id % 2), key=per_user.get) - 1])
+    inactive = backend.generate_sha1_hash(users[max((user_id for user_id in per_user if not user_id % 2), key=per_user.get) - 1])
+    history_length = len(backend.get_chat_history(heaviest))
+    rows = [
+        {"operation": f"open chat page, whole history ({history_length} messages, before)",
+         **measure(lambda i: backend.get_chat_history(heaviest), args.iterations)},
+        {"operation": "open chat page, last 50 messages",
+         **measure(lambda i: backend.get_chat_transcript(heaviest, 50), args.iterations)},
+    ]
+
+    stats = backend.archive_chat_history(args.retention_days, now=now)
+    again = backend.archive_chat_history(args.retention_days, now=now)
+    rows += [
+        {"operation": "open chat page, last 50 messages (after archiving)",
+         **measure(lambda i: backend.get_chat_transcript(heaviest, 50), args.iterations)},
+        {"operation": "load 500 earlier messages from the archive",
+         **measure(lambda i: backend.get_chat_transcript(heaviest, 500 + 50 * (i % 10)), args.iterations)},
+        {"operation": "open chat page of an inactive user (archive only)",
+         **measure(lambda i: backend.get_chat_transcript(inactive, 50), args.iterations)},
+    ]
+    print(f"{args.messages} messages of {args.users} users over a year, archiving those older than {args.retention_days} days")
+    print_table(rows, list(rows[0].keys()))
+    print(f"Archived {stats['archived_messages']} messages into {stats['segments']} segments in {stats['seconds']:.1f}s: "
+          f"{stats['raw_bytes'] / 2**20:.1f} MiB of JSON compressed to {stats['compressed_bytes'] / 2**20:.1f} MiB")
+    print(f"Database {stats['db_bytes_before'] / 2**20:.1f} MiB -> {stats['db_bytes_after'] / 2**20:.1f} MiB "
+          f"({stats['freed_pages']} pages freed by incremental VACUUM, {stats['free_pages_left']} left); "
+          f"second run archived {again['archived_messages']} in {again['seconds']:.2f}s")
+
+
+# ================= Adaptive quiz sampling =================
+def run_adaptive_benchmark(args):
+    use_offline_provider("fake")
+    os.chdir(tempfile.mkdtemp(prefix="adaptive_benchmark_"))
+    import backend
+    import ai_features
+    backend.ensure_db()
+    user, subject, chapter = "benchmark_user", "Benchmark", "Chapter 1"
+    write_synthetic_corpus(os.path.join(user, "materials", subject, chapter), args.documents, args.pages)
+    ai_features.build_vector_store(user, subject, chapter)
+    vector_db = ai_features.load_vector_store(user, subject, chapter)
+    topic_chunks = backend.get_topic_chunks(vector_db.chunk_table)
+    topics = sorted(topic_chunks)
+    rng = random.Random(args.seed)
+    weak = set(rng.sample(topics, min(args.weak_topics, len(topics))))
+    topic_stats = [{"topic": topic, "recent_accuracy": 0.2 if topic in weak else 0.9} for topic in topics]
+
+    searches = []
+    search = vector_db.similarity_search_with_score
+    vector_db.similarity_search_with_score = lambda *a, **kw: searches.append(1) or search(*a, **kw)
+    # Each quiz is the same request, retaken as the session's next attempt
+    drawn, contexts = Counter(), set()
+    start = time.perf_counter()
+    for i in range(args.draws):
+        docs = ai_features.retrieve_adaptive_docs(vector_db, topic_stats, attempt=i)
+        contexts.add(tuple(doc.metadata["chunk_id"] for doc in docs))
+        drawn.update(backend.get_chunk_topic(vector_db.chunk_table, doc.metadata["chunk_id"]) for doc in docs)
+    per_draw_ms = (time.perf_counter() - start) * 1000 / args.draws
+
+    total = sum(drawn.values())
+    weak_chunks = sum(len(topic_chunks[t]) for t in weak)
+    rows = [{"topics": len(topics), "weak_topics": len(weak),
+             "weak_share_of_chunks": f"{weak_chunks / len(vector_db.chunk_table['rows']):.2f}",
+             "weak_share_of_context": f"{sum(drawn[t] for t in weak) / total:.2f}",
+             "distinct_contexts": len(contexts), "similarity_searches": len(searches),
+             "ms_per_quiz_context": f"{per_draw_ms:.2f}"}]
+    print(f"{args.draws} quiz contexts from {len(vector_db.chunk_table['rows'])} chunks")
+    print_table(rows, list(rows[0].keys()))
+
+
+# ================= Generation context coverage =================
+def run_coverage_benchmark(args):
+    use_offline_provider("fake")
+    os.chdir(tempfile.mkdtemp(prefix="coverage_benchmark_"))
+    import backend
+    import ai_features
+    backend.ensure_db()
+    user, subject, chapter = "benchmark_user", "Benchmark", "Chapter 1"
+    write_synthetic_corpus(os.path.join(user, "materials", subject, chapter), args.documents, args.pages)
+    ai_features.build_vector_store(user, subject, chapter)
+    vector_db = ai_features.load_vector_store(user, subject, chapter)
+    cluster_chunks = backend.get_cluster_chunks(vector_db.chunk_table)
+    cluster_of = {chunk_id: cluster for cluster, chunk_ids in cluster_chunks.items() for chunk_id in chunk_ids}
+    num_chunks = len(vector_db.chunk_table["rows"])
+
+    queries = ["Generate quiz questions about the key concepts and main ideas in the document.",
+               "Create a quiz based on the important details and factual information presented.",
+               "What are some potential multiple-choice questions from this text?"]
+    embedded = Counter()
+    embed_query = vector_db.embedding_function.embed_query
+    vector_db.embedding_function.embed_query = lambda text: embedded.update(queries=1) or embed_query(text)
+    methods = {
+        "similarity search (before)": lambda: ai_features.pack_context(
+            ai_features.scored_search(vector_db, random.choice(queries), ai_features.GENERATION_RETRIEVAL_K),
+            ai_features.GENERATION_CONTEXT_TOKEN_BUDGET),
+        # The same request the generators make, as the session's next attempt each time
+        "stratified clusters": lambda: ai_features.retrieve_generation_docs(vector_db, queries, attempt=next(attempts)),
+    }
+    attempts = itertools.count()
+
+    rows = []
+    random.seed(args.seed)
+    for name, retrieve in methods.items():
+        embedded.clear()
+        seen, clusters_per_prompt, chunks_per_prompt, tokens_per_prompt = set(), [], [], []
+        start = time.perf_counter()
+        for _ in range(args.prompts):
+            docs = retrieve()
+            chunk_ids = [doc.metadata["chunk_id"] for doc in docs]
+            seen.update(chunk_ids)
+            clusters_per_prompt.append(len({cluster_of[i] for i in chunk_ids}))
+            chunks_per_prompt.append(len(docs))
+            tokens_per_prompt.append(sum(ai_features.estimate_tokens(doc.page_content) for doc in docs))
+        elapsed_ms = (time.perf_counter() - start) * 1000 / args.prompts
+        rows.append({
+            "method": name,
+            "chunks_per_prompt": f"{sum(chunks_per_prompt) / args.prompts:.1f}",
+            "tokens_per_prompt": f"{sum(tokens_per_prompt) / args.prompts:.0f}",
+            "clusters_per_prompt": f"{sum(clusters_per_prompt) / args.prompts:.1f}/{len(cluster_chunks)}",
+            f"chapter_coverage@{args.prompts}": f"{len(seen) / num_chunks:.2f}",
+            "embedding_calls": embedded["queries"],
+            "ms_per_prompt": f"{elapsed_ms:.2f}",
+        })
+
+    print(f"{num_chunks} chunks in {len(cluster_chunks)} clusters, {args.prompts} prompts per method")
+    print_table(rows, list(rows[0].keys()))
+
+
+# ================= Near-duplicate chunk benchmark =================
+def write_edition(source_path, target_path, edit_rate, seed):
+    """Copies a corpus file as another "edition", replacing a share of its words."""
+    rng = random.Random(seed)
+    with open(source_path, encoding="utf-8") as f:
+        text = f.read()
+    edited = re.sub(r"[a-z]{4,}", lambda m: "revised" if rng.random() < edit_rate else m.group(0), text)
+    with open(target_path, "w", encoding="utf-8") as f:
+        f.write(edited)
+
+def run_dedup_benchmark(args):
+    use_offline_provider("fake")
+    os.chdir(tempfile.mkdtemp(prefix="dedup_benchmark_"))
+    import backend
+    import ai_features
+    backend.ensure_db()
+    user, subject = "benchmark_user", "Benchmark"
+    for chapter, editions in (("distinct", 1), ("editions", args.editions)):
+        materials_dir = os.path.join(user, "materials", subject, chapter)
+        write_synthetic_corpus(materials_dir, args.documents, args.pages)
+        for file_name in sorted(os.listdir(materials_dir)):
+            for edition in range(2, editions + 1):
+                write_edition(os.path.join(materials_dir, file_name),
+                              os.path.join(materials_dir, file_name.replace(".txt", f"_edition_{edition}.txt")),
+                              args.edit_rate, seed=edition)
+
+    embeddings = ai_features.get_embeddings()
+    embed_documents = embeddings.embed_documents
+    embedded = Counter()
+    embeddings.embed_documents = lambda texts: embedded.update(chunks=len(texts)) or embed_documents(texts)
+    collapse = ai_features.collapse_near_duplicates
+
+    rows = []
+    for chapter in ("distinct", "editions"):
+        for dedup in (False, True):
+            ai_features.collapse_near_duplicates = collapse if dedup else (lambda chunks: (chunks, 0))
+            embedded.clear()
+            start = time.perf_counter()
+            ai_features.build_vector_store(user, subject, chapter)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            manifest = backend.read_index_manifest(user, subject, chapter)
+            rows.append({"chapter": chapter, "dedup": "on" if dedup else "off",
+                         "chunks": manifest["num_chunks"] + manifest["duplicate_chunks"],
+                         "embedded": embedded["chunks"], "dedup_ratio": f"{manifest['dedup_ratio']:.2f}",
+                         "index_ms": f"{elapsed_ms:.0f}"})
+    ai_features.collapse_near_duplicates = collapse
+
+    print(f"{args.documents} documents of {args.pages} pages; 'editions' adds {args.editions - 1} edition(s) "
+          f"of each with {args.edit_rate:.0%} of the words changed")
+    print_table(rows, list(rows[0].keys()))
+
+
+# ================= Chapter summary tree benchmark =================
+def run_summaries_benchmark(args):
+    use_offline_provider("fake", llm_latency=args.llm_latency)
+    os.chdir(tempfile.mkdtemp(prefix="summaries_benchmark_"))
+    import backend
+    import ai_features
+    backend.ensure_db()
+    user, subject, chapter = "benchmark_user", "Benchmark", "Chapter 1"
+    materials_dir = write_synthetic_corpus(os.path.join(user, "materials", subject, chapter), args.documents, args.pages)
+
+    prompts = []
+    invoke_llm = ai_features.invoke_llm
+    def recording_invoke_llm(task, prompt, inputs=None):
+        prompts.append((task, ai_features.estimate_tokens(prompt.format(**inputs) if inputs is not None else prompt)))
+        return invoke_llm(task, prompt, inputs)
+    ai_features.invoke_llm = recording_invoke_llm
+
+    rows = []
+    def build(label):
+        prompts.clear()
+        start = time.perf_counter()
+        ai_features.build_vector_store(user, subject, chapter)
+        calls = sum(1 for task, _ in prompts if task == "summary")
+        rows.append({"build": label, "summary_calls": calls, "index_s": f"{time.perf_counter() - start:.2f}",
+                     "sequential_llm_s": f"{calls * args.llm_latency:.2f}"})
+    build("first build")
+    build("unchanged rebuild")
+    write_synthetic_corpus(materials_dir, 1, args.pages, seed=99)
+    build("one file changed")
+    print(f"{args.documents} documents of {args.pages} pages, fake LLM latency {args.llm_latency}s, "
+          f"{ai_features.SUMMARY_WORKERS} summary workers")
+    print_table(rows, list(rows[0].keys()))
+
+    vector_db = ai_features.load_vector_store(user, subject, chapter)
+    tree = vector_db.summary_tree
+    sections = backend.get_summary_nodes(tree, "section")
+    mindmap_rows = []
+    for label, summary_tree in (("raw chunks (before)", None), ("summary tree", tree)):
+        vector_db.summary_tree = summary_tree
+        prompts.clear()
+        docs = []
+        pack_context = ai_features.pack_context
+        ai_features.pack_context = lambda *a, **kw: docs.extend(pack_context(*a, **kw)) or docs
+        ai_features.generate_mindmap_from_faiss(vector_db)
+        ai_features.pack_context = pack_context
+        chunk_ids = {doc.metadata["chunk_id"] for doc in docs}
+        covered = len(sections) if summary_tree else sum(1 for node in sections if chunk_ids & set(node["chunk_ids"]))
+        mindmap_rows.append({"mindmap_context": label, "prompt_tokens": prompts[0][1],
+                             "sections_covered": f"{covered}/{len(sections)}"})
+    print_table(mindmap_rows, list(mindmap_rows[0].keys()))
+    ai_features.invoke_llm = invoke_llm
+
+
+# ================= Extracted text store benchmark =================
+def run_extraction_benchmark(args):
+    use_offline_provider("fake")
+    os.chdir(tempfile.mkdtemp(prefix="extraction_benchmark_"))
+    import backend
+    import ai_features
+    backend.ensure_db()
+    user, subject, chapter = "benchmark_user", "Benchmark", "Chapter 1"
+    materials_dir = os.path.join(user, "materials", subject, chapter)
+    # The synthetic text corpus, rewritten as PDFs so extraction goes through the real parser
+    text_dir = write_synthetic_corpus(tempfile.mkdtemp(prefix="extraction_text_"), args.documents, args.pages)
+    os.makedirs(materials_dir)
+    for file_name in sorted(os.listdir(text_dir)):
+        with open(os.path.join(text_dir, file_name), encoding="utf-8") as f:
+            write_pdf(os.path.join(materials_dir, file_name.replace(".txt", ".pdf")), f.read().split("\f"))
+    files = [os.path.join(materials_dir, name) for name in sorted(os.listdir(materials_dir))]
+    pdf_bytes = sum(os.path.getsize(path) for path in files)
+
+    def extract_all(i):
+        return [ai_features.extract_pages(path) for path in files]
+
+    def store_bytes():
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(backend.EXTRACTED_TEXT_DIR) for name in names)
+
+    rows = []
+    shutil.rmtree(backend.EXTRACTED_TEXT_DIR, ignore_errors=True)
+    rows.append({"operation": "extract, empty store", **measure(extract_all, 1)})
+    rows.append({"operation": "extract, stored", **measure(extract_all, args.iterations)})
+    shutil.rmtree(backend.EXTRACTED_TEXT_DIR, ignore_errors=True)
+    walks = []
+    evict_extracted_text = backend.evict_extracted_text
+    backend.evict_extracted_text = lambda *a, **kw: walks.append(1) or evict_extracted_text(*a, **kw)
+    rows.append({"operation": "re-index, empty store",
+                 **measure(lambda i: ai_features.build_vector_store(user, subject, chapter), 1)})
+    backend.evict_extracted_text = evict_extracted_text
+    rows.append({"operation": "re-index, stored",
+                 **measure(lambda i: ai_features.build_vector_store(user, subject, chapter), args.iterations)})
+    text_bytes = sum(len(page.encode("utf-8")) for _, pages in extract_all(0) for page in pages)
+    print(f"{len(files)} PDFs, {args.pages} pages each, {pdf_bytes / 2**20:.1f} MiB; "
+          f"extracted text {text_bytes / 2**20:.2f} MiB stored in {store_bytes() / 2**20:.2f} MiB; "
+          f"the store was walked {len(walks)} times for {len(files)} saves")
+    print_table(rows, list(rows[0].keys()))
+
+
+# ================= Temporary chat benchmark =================
+def run_tempchat_benchmark(args):
+    use_offline_provider("fake")
+    os.chdir(tempfile.mkdtemp(prefix="tempchat_benchmark_"))
+    import backend
+    import ai_features
+    backend.ensure_db()
+    user, subject, chapter = "benchmark_user", "Temporary", "Temporary Chat"
+    corpus_dir = write_synthetic_corpus(tempfile.mkdtemp(prefix="tempchat_corpus_"), args.documents, args.pages)
+    uploads = []
+    for file_name in sorted(os.listdir(corpus_dir)):
+        with open(os.path.join(corpus_dir, file_name), "rb") as f:
+            uploads.append((file_name, f.read()))
+
+    def files_on_disk():
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(".") for name in names)
+
+    # Before: every upload was written to disk and the whole temporary chapter re-indexed
+    materials_dir = os.path.join(user, "materials", subject, chapter)
+    os.makedirs(materials_dir)
+    rebuild_ms, embedded = [], Counter()
+    embeddings = ai_features.get_embeddings()
+    embed_documents = embeddings.embed_documents
+    embeddings.embed_documents = lambda texts: embedded.update(chunks=len(texts)) or embed_documents(texts)
+    for file_name, data in uploads:
+        start = time.perf_counter()
+        with open(os.path.join(materials_dir, file_name), "wb") as f:
+            f.write(data)
+        ai_features.build_vector_store(user, subject, chapter)
+        rebuild_ms.append((time.perf_counter() - start) * 1000)
+    rebuild_chunks = embedded["chunks"]
+    shutil.rmtree(user)
+
+    embedded.clear()
+    disk_before = files_on_disk()
+    append_ms = []
+    for file_name, data in uploads:
+        start = time.perf_counter()
+        status = ai_features.add_temp_material("benchmark_session", file_name, data)
+        append_ms.append((time.perf_counter() - start) * 1000)
+        if status != "success":
+            raise SystemExit(f"uploading {file_name} returned {status}")
+    append_chunks = embedded["chunks"]
+    entry = ai_features.get_temp_index("benchmark_session")
+
+    rows = [
+        {"mode": "disk, full rebuild", "last_upload_ms": f"{rebuild_ms[-1]:.1f}", "total_ms": f"{sum(rebuild_ms):.1f}",
+         "chunks_embedded": rebuild_chunks},
+        {"mode": "memory, append", "last_upload_ms": f"{append_ms[-1]:.1f}", "total_ms": f"{sum(append_ms):.1f}",
+         "chunks_embedded": append_chunks},
+    ]
+    print(f"{len(uploads)} uploads of {args.pages} pages, {len(entry['chunks'])} chunks, "
+          f"estimated {entry['bytes'] / 2**20:.2f} MiB in memory, {len(files_on_disk()) - len(disk_before)} files written")
+    print_table(rows, list(rows[0].keys()))
+
+
+# ================= Retrieval service load test =================
+def current_rss_bytes():
+    """Resident memory of this process (Linux)."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def run_retrieval_worker(args):
+    """One app worker of the load test: concurrent sessions searching the chapters. Prints its report as JSON."""
+    import json
+    import ai_features
+    rss_after_imports = current_rss_bytes()
+    queries = [line for line in open(args.queries_file, encoding="utf-8").read().splitlines() if line]
+    chapters = [f"Chapter {i + 1}" for i in range(args.chapters)]
+    latencies = []
+
+    def search(i):
+        start = time.perf_counter()
+        vector_db = ai_features.load_vector_store("benchmark_user", "Benchmark", chapters[i % len(chapters)])
+        ai_features.scored_search(vector_db, queries[i % len(queries)], ai_features.CHAT_RETRIEVAL_K)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        list(executor.map(search, range(args.worker_index, args.worker_index + args.searches)))
+    print(json.dumps({"latencies": latencies, "seconds": time.perf_counter() - wall_start,
+                      "rss_bytes": current_rss_bytes(), "retrieval_bytes": current_rss_bytes() - rss_after_imports}))
+
+def run_retrieval_benchmark(args):
+    import json
+    use_offline_provider("fake", embedding_latency=args.embedding_latency)
+    os.chdir(tempfile.mkdtemp(prefix="retrieval_benchmark_"))
+    import backend
+    import ai_features
+    backend.ensure_db()
+    from retrieval_service import RETRIEVAL_WORKERS, RetrievalClient
+    chapters = [f"Chapter {i + 1}" for i in range(args.chapters)]
+    sentences = []
+    for i, chapter in enumerate(chapters):
+        materials_dir = write_synthetic_corpus(os.path.join("benchmark_user", "materials", "Benchmark", chapter),
+                                               args.documents, args.pages, seed=i)
+        ai_features.build_vector_store("benchmark_user", "Benchmark", chapter)
+        sentences.extend(sentence for _, _, pages in read_corpus(materials_dir) for page in pages
+                         for sentence in SENTENCE_PATTERN.findall(page))
+    queries_file = os.path.abspath("queries.txt")
+    with open(queries_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(random.Random(args.seed).sample(sentences, min(len(sentences), 2000))))
+    num_chunks = sum(backend.read_index_manifest("benchmark_user", "Benchmark", chapter)["num_chunks"] for chapter in chapters)
+    print(f"{args.chapters} chapters, {num_chunks} chunks; {args.workers} app workers x {args.sessions} sessions, "
+          f"{args.searches} searches per worker, fake embedding latency {args.embedding_latency}s")
+
+    def run_workers(extra_env):
+        env = dict(os.environ, **extra_env)
+        command = [sys.executable, os.path.join(REPO_DIR, "benchmarks.py"), "retrieval-worker",
+                   "--chapters", str(args.chapters), "--sessions", str(args.sessions), "--searches", str(args.searches),
+                   "--queries-file", queries_file]
+        workers = [subprocess.Popen(command + ["--worker-index", str(i * args.searches)], env=env,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+                   for i in range(args.workers)]
+        reports = []
+        for worker in workers:
+            output, _ = worker.communicate()
+            if worker.returncode != 0:
+                raise SystemExit(f"a retrieval worker failed with exit code {worker.returncode}")
+            reports.append(json.loads(output.strip().splitlines()[-1]))
+        return reports
+
+    def summarize(mode, reports, service_stats=None):
+        latencies = [latency for report in reports for latency in report["latencies"]]
+        searches = len(latencies)
+        return {
+            "mode": mode,
+            "p50_ms": f"{percentile(latencies, 50):.1f}",
+            "p95_ms": f"{percentile(latencies, 95):.1f}",
+            "searches_per_s": f"{searches / max(report['seconds'] for report in reports):.0f}",
+            "embedding_calls": service_stats["embedding_calls"] if service_stats else searches,
+            # Memory the indexes add: to each worker, plus to the service beyond its startup imports
+            "index_memory_mib": f"{(sum(r['retrieval_bytes'] for r in reports) + service_index_bytes(service_stats)) / 2**20:.0f}",
+            "total_rss_mib": f"{(sum(r['rss_bytes'] for r in reports) + (service_stats or {}).get('peak_rss_bytes', 0)) / 2**20:.0f}",
+        }
+
+    def service_index_bytes(service_stats):
+        return service_stats["peak_rss_bytes"] - service_stats["startup_rss_bytes"] if service_stats else 0
+
+    in_process = run_workers({"RETRIEVAL_SERVICE": ""})
+    rows = [summarize("in-process (before)", in_process)]
+
+    socket_path = os.path.abspath(os.path.join(".cache", "retrieval.sock"))
+    service = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "retrieval_service.py"), "serve", "--socket", socket_path],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        service.stdout.readline()
+        reports = run_workers({"RETRIEVAL_SERVICE": f"unix:{socket_path}"})
+        stats = RetrievalClient(f"unix:{socket_path}").call("stats")
+    finally:
+        service.terminate()
+        service.wait()
+    rows.append(summarize("retrieval service", reports, stats))
+    print_table(rows, list(rows[0].keys()))
+    print(f"Service: {stats['loads']} index loads, {stats['searches']} searches in {stats['batches']} batches "
+          f"({stats['searches'] / max(stats['batches'], 1):.1f} per batch), {stats['lookups']} chunk lookups")
+    if args.workers * args.sessions <= RETRIEVAL_WORKERS:
+        print(f"{args.workers * args.sessions} concurrent searches do not exceed the service's {RETRIEVAL_WORKERS} "
+              f"workers, so each runs on its own and embedding calls are not expected to drop")
+    saved_per_worker = (sum(report["retrieval_bytes"] for report in in_process)
+                        - sum(report["retrieval_bytes"] for report in reports)) / args.workers
+    if saved_per_worker > 0:
+        break_even = (stats["startup_rss_bytes"] + service_index_bytes(stats)) / saved_per_worker
+        print(f"The service process costs {stats['startup_rss_bytes'] / 2**20:.0f} MiB before loading any index; each worker "
+              f"saves {saved_per_worker / 2**20:.0f} MiB, so total memory is lower from {math.ceil(break_even)} workers on")
+
+
+# ================= Shared cache benchmark =================
+def run_cache_replica(args):
+    """One app replica of the shared cache test: indexes the chapters and grades answers. Prints its report as JSON."""
+    import json
+    os.chdir(args.workdir)
+    import telemetry
+    telemetry.enable()
+    import backend
+    import ai_features
+    backend.ensure_db()
+    start = time.perf_counter()
+    for i in range(args.chapters):
+        ai_features.build_vector_store("benchmark_user", "Benchmark", f"Chapter {i + 1}")
+    index_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(args.answers):
+        # Half the answers repeat, as when many students give the same short answer
+        answer = i % (args.answers // 2 or 1)
+        ai_features.evaluate_exam(f"Section {answer} describes the structure of the cell.", f"It describes part {answer}.", 5)
+    counters = telemetry.snapshot()["counters"]
+    stats = ai_features.get_shared_cache().stats()
+    # Misses of the local extracted text store that the shared cache did not answer either
+    parsed = sum(value for (name, labels), value in counters.items()
+                 if name == "cache_requests" and dict(labels) == {"cache": "extracted_text", "result": "miss"})
+    parsed -= stats["caches"].get("extracted_pages", {}).get("hits", 0)
+    print(json.dumps({"index_seconds": index_seconds, "grading_seconds": time.perf_counter() - start, "pdfs_parsed": parsed,
+                      "llm_calls": sum(row["calls"] for row in backend.get_llm_task_stats()), "caches": stats["caches"]}))
+
+def run_cache_benchmark(args):
+    import json
+    from cache import FakeRedisServer
+    use_offline_provider("fake", llm_latency=args.llm_latency)
+    root = tempfile.mkdtemp(prefix="cache_benchmark_")
+    os.chdir(root)
+    server = FakeRedisServer(port=args.redis_port).start()
+    redis_url = f"redis://127.0.0.1:{args.redis_port}/0"
+
+    # The materials, as PDFs so extraction goes through the real parser; every replica gets its own copy
+    materials_dir = os.path.join(root, "materials")
+    for i in range(args.chapters):
+        text_dir = write_synthetic_corpus(tempfile.mkdtemp(prefix="cache_text_"), args.documents, args.pages, seed=i)
+        chapter_dir = os.path.join(materials_dir, "benchmark_user", "materials", "Benchmark", f"Chapter {i + 1}")
+        os.makedirs(chapter_dir)
+        for file_name in sorted(os.listdir(text_dir)):
+            with open(os.path.join(text_dir, file_name), encoding="utf-8") as f:
+                write_pdf(os.path.join(chapter_dir, file_name.replace(".txt", ".pdf")), f.read().split("\f"))
+    print(f"{args.replicas} replicas one after another, {args.chapters} chapters of {args.documents} PDFs x {args.pages} pages, "
+          f"{args.answers} graded answers each, fake LLM latency {args.llm_latency}s")
+
+    rows = []
+    for kind in args.backends.split(","):
+        env = dict(os.environ, CACHE_BACKEND=kind, CACHE_PATH=os.path.join(root, f"{kind}.db"), CACHE_URL=redis_url)
+        for replica in range(args.replicas):
+            workdir = os.path.join(root, f"{kind}_replica_{replica + 1}")
+            shutil.copytree(os.path.join(materials_dir, "benchmark_user"), os.path.join(workdir, "benchmark_user"))
+            result = subprocess.run([sys.executable, os.path.join(REPO_DIR, "benchmarks.py"), "cache-replica",
+                                     "--workdir", workdir, "--chapters", str(args.chapters), "--answers", str(args.answers)],
+                                    env=env, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise SystemExit(f"replica failed:\n{result.stderr[-2000:]}")
+            report = json.loads(result.stdout.strip().splitlines()[-1])
+            caches = report["caches"]
+            def hit_rate(cache):
+                return f"{caches[cache]['hit_rate']:.0%}" if cache in caches else "-"
+            rows.append({"backend": kind, "replica": replica + 1, "index_s": f"{report['index_seconds']:.2f}",
+                         "grading_s": f"{report['grading_seconds']:.2f}", "llm_calls": report["llm_calls"],
+                         "pdfs_parsed": report["pdfs_parsed"],
+                         "pages_hit": hit_rate("extracted_pages"), "chunks_hit": hit_rate("chunks"),
+                         "summary_hit": hit_rate("summary"), "grading_hit": hit_rate("grading")})
+    print_table(rows, list(rows[0].keys()))
+    server.shutdown()
+
+
+# ================= Startup benchmark =================
+# Modules the login and home pages must not import; they belong to chapter features
+STARTUP_FORBIDDEN_MODULES = ("ai_features", "langchain", "langchain_core", "langchain_community",
+                             "langchain_classic", "langchain_google_genai", "faiss", "PyPDF2", "docx")
+
+def profile_imports(module, cwd=None):
+    """Imports module in a fresh interpreter with -X importtime. Returns {top-level package: self time in us}."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd or os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise SystemExit(result.stderr[-2000:])
+    packages = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)", line)
+        if match:
+            package = match.group(2).split(".")[0]
+            packages[package] = packages.get(package, 0) + int(match.group(1))
+    return packages
+
+def run_startup_benchmark(args):
+    packages = profile_imports(args.module, args.cwd)
+    total_ms = sum(packages.values()) / 1000
+    rows = [{"package": name, "self_ms": f"{us / 1000:.1f}"}
+            for name, us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]]
+    print(f"Cold import of '{args.module}': {total_ms:.1f} ms")
+    print_table(rows, ["package", "self_ms"])
+    loaded = [name for name in STARTUP_FORBIDDEN_MODULES if name in packages]
+    if loaded:
+        print(f"Chapter-only modules imported at startup: {', '.join(loaded)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    chunking = subparsers.add_parser("chunking", help="Chunk count, embedding tokens and retrieval hit rate per chunk setting.")
+    chunking.add_argument("--corpus", help="Directory of PDF/DOCX/TXT files (default: a generated synthetic corpus).")
+    chunking.add_argument("--settings", default="legacy,profile,1000:100,2000:200,4000:400",
+                          help="Comma separated size:overlap pairs, 'profile' for CHUNKING_PROFILES, 'legacy' for the old splitter.")
+    chunking.add_argument("--probes", type=int, default=200)
+    chunking.add_argument("--k", type=int, default=4)
+    chunking.add_argument("--seed", type=int, default=13)
+    chunking.set_defaults(func=run_chunking_benchmark)
+
+    embeddings = subparsers.add_parser("embeddings", help="Retrieval hit rate and throughput of the embedding providers.")
+    embeddings.add_argument("--corpus", help="Directory of .pdf/.docx/.txt files (default: a synthetic corpus).")
+    embeddings.add_argument("--documents", type=int, default=6)
+    embeddings.add_argument("--pages", type=int, default=10)
+    embeddings.add_argument("--candidates", default="bm25,fake,hashing,tfidf",
+                            help=f"Comma separated, any of {', '.join(EMBEDDING_CANDIDATES)} (google needs GOOGLE_API_KEY).")
+    embeddings.add_argument("--probes", type=int, default=200)
+    embeddings.add_argument("--k", type=int, default=4)
+    embeddings.add_argument("--seed", type=int, default=13)
+    embeddings.set_defaults(func=run_embeddings_benchmark)
+
+    e2e = subparsers.add_parser("e2e", help="p50/p95 latency and throughput of indexing, chat, quiz, exam and mind map.")
+    e2e.add_argument("--provider", choices=["fake", "local"], default="fake")
+    e2e.add_argument("--llm-latency", type=float, default=0.0, help="Seconds added to every LLM call.")
+    e2e.add_argument("--token-latency", type=float, default=0.0, help="Seconds added per generated word.")
+    e2e.add_argument("--embedding-latency", type=float, default=0.0, help="Seconds added to every embedding call.")
+    e2e.add_argument("--iterations", type=int, default=20)
+    e2e.add_argument("--index-iterations", type=int, default=3)
+    e2e.add_argument("--concurrency", type=int, default=1)
+    e2e.add_argument("--documents", type=int, default=3)
+    e2e.add_argument("--pages", type=int, default=8)
+    e2e.add_argument("--port", type=int, default=8765, help="Port of the local stand-in server (--provider local).")
+    e2e.add_argument("--only", nargs="*", help="Run only these scenarios (indexing always runs).")
+    e2e.add_argument("--routes-file", help="JSON overrides of the model profiles and task routes (MODEL_ROUTES_FILE).")
+    e2e.add_argument("--metrics-file", help="Enable telemetry and write the per-stage Prometheus metrics here.")
+    e2e.set_defaults(func=run_e2e_benchmark)
+
+    retrieval = subparsers.add_parser("retrieval", help="Memory and latency of N app workers with in-process indexes against the retrieval service.")
+    retrieval.add_argument("--workers", type=int, default=4)
+    retrieval.add_argument("--sessions", type=int, default=8, help="Concurrent sessions (threads) per worker.")
+    retrieval.add_argument("--searches", type=int, default=400, help="Searches per worker.")
+    retrieval.add_argument("--chapters", type=int, default=6)
+    retrieval.add_argument("--documents", type=int, default=6)
+    retrieval.add_argument("--pages", type=int, default=20)
+    retrieval.add_argument("--embedding-latency", type=float, default=0.02, help="Seconds every fake embeddings call takes.")
+    retrieval.add_argument("--seed", type=int, default=7)
+    retrieval.set_defaults(func=run_retrieval_benchmark)
+
+    retrieval_worker = subparsers.add_parser("retrieval-worker", help="One app worker of the retrieval load test (internal).")
+    retrieval_worker.add_argument("--chapters", type=int, required=True)
+    retrieval_worker.add_argument("--sessions", type=int, required=True)
+    retrieval_worker.add_argument("--searches", type=int, required=True)
+    retrieval_worker.add_argument("--worker-index", type=int, default=0)
+    retrieval_worker.add_argument("--queries-file", required=True)
+    retrieval_worker.set_defaults(func=run_retrieval_worker)
+
+    shared_cache = subparsers.add_parser("cache", help="The work replicas repeat with each cache backend.")
+    shared_cache.add_argument("--backends", default="none,memory,disk,redis")
+    shared_cache.add_argument("--replicas", type=int, default=3)
+    shared_cache.add_argument("--chapters", type=int, default=2)
+    shared_cache.add_argument("--documents", type=int, default=3)
+    shared_cache.add_argument("--pages", type=int, default=8)
+    shared_cache.add_argument("--answers", type=int, default=20, help="Exam answers each replica grades.")
+    shared_cache.add_argument("--llm-latency", type=float, default=0.1, help="Seconds every fake LLM call takes.")
+    shared_cache.add_argument("--redis-port", type=int, default=6390, help="Port of the fake Redis server.")
+    shared_cache.set_defaults(func=run_cache_benchmark)
+
+    cache_replica = subparsers.add_parser("cache-replica", help="One replica of the shared cache benchmark (internal).")
+    cache_replica.add_argument("--workdir", required=True)
+    cache_replica.add_argument("--chapters", type=int, required=True)
+    cache_replica.add_argument("--answers", type=int, required=True)
+    cache_replica.set_defaults(func=run_cache_replica)
+
+    startup = subparsers.add_parser("startup", help="Import-time breakdown of the login page.")
+    startup.add_argument("--module", default="frontend", help="Module app.py starts from.")
+    startup.add_argument("--cwd", help="Directory to import from (default: this repository).")
+    startup.add_argument("--top", type=int, default=15)
+    startup.set_defaults(func=run_startup_benchmark)
+
+    coalesce = subparsers.add_parser("coalesce", help="Model calls and wall time of concurrent sessions with a slow fake model.")
+    coalesce.add_argument("--sessions", type=int, default=20)
+    coalesce.add_argument("--llm-latency", type=float, default=0.5, help="Seconds every fake LLM call takes.")
+    coalesce.set_defaults(func=run_coalesce_benchmark)
+
+    flashcards = subparsers.add_parser("flashcards", help="Due-card queries and SM-2 updates with tens of thousands of cards.")
+    flashcards.add_argument("--cards", type=int, default=50000)
+    flashcards.add_argument("--chapters", type=int, default=5)
+    flashcards.add_argument("--session-size", type=int, default=20)
+    flashcards.add_argument("--iterations", type=int, default=200)
+    flashcards.add_argument("--seed", type=int, default=7)
+    flashcards.set_defaults(func=run_flashcards_benchmark)
+
+    attempts = subparsers.add_parser("attempts", help="Progress dashboard reads and attempt writes with a million stored attempts.")
+    attempts.add_argument("--attempts", type=int, default=1000000)
+    attempts.add_argument("--questions", type=int, default=5, help="Answers per attempt.")
+    attempts.add_argument("--users", type=int, default=100)
+    attempts.add_argument("--chapters", type=int, default=5, help="Chapters per user.")
+    attempts.add_argument("--topics", type=int, default=12, help="Topics per chapter.")
+    attempts.add_argument("--iterations", type=int, default=200)
+    attempts.add_argument("--seed", type=int, default=7)
+    attempts.set_defaults(func=run_attempts_benchmark)
+
+    search = subparsers.add_parser("search", help="Ranked full-text search over millions of chat messages against a LIKE scan.")
+    search.add_argument("--messages", type=int, default=2000000)
+    search.add_argument("--flashcards", type=int, default=100000)
+    search.add_argument("--users", type=int, default=100)
+    search.add_argument("--vocabulary", type=int, default=20000)
+    search.add_argument("--page-size", type=int, default=10)
+    search.add_argument("--iterations", type=int, default=200)
+    search.add_argument("--seed", type=int, default=7)
+    search.set_defaults(func=run_search_benchmark)
+
+    retention = subparsers.add_parser("retention", help="Chat history archiving: reclaimed space, archive size and chat page reads.")
+    retention.add_argument("--messages", type=int, default=300000)
+    retention.add_argument("--users", type=int, default=200)
+    retention.add_argument("--retention-days", type=float, default=180)
+    retention.add_argument("--iterations", type=int, default=50)
+    retention.add_argument("--seed", type=int, default=7)
+    retention.set_defaults(func=run_retention_benchmark)
+
+    adaptive = subparsers.add_parser("adaptive", help="Share of weak topics in adaptive quiz contexts, without similarity search.")
+    adaptive.add_argument("--documents", type=int, default=3)
+    adaptive.add_argument("--pages", type=int, default=6)
+    adaptive.add_argument("--weak-topics", type=int, default=3)
+    adaptive.add_argument("--draws", type=int, default=500)
+    adaptive.add_argument("--seed", type=int, default=7)
+    adaptive.set_defaults(func=run_adaptive_benchmark)
+
+    coverage = subparsers.add_parser("coverage", help="Chapter coverage of generation contexts: similarity search against cluster sampling.")
+    coverage.add_argument("--documents", type=int, default=6)
+    coverage.add_argument("--pages", type=int, default=10)
+    coverage.add_argument("--prompts", type=int, default=10)
+    coverage.add_argument("--seed", type=int, default=7)
+    coverage.set_defaults(func=run_coverage_benchmark)
+
+    dedup = subparsers.add_parser("dedup", help="Near-duplicate chunk elimination on a corpus with several editions.")
+    dedup.add_argument("--documents", type=int, default=4)
+    dedup.add_argument("--pages", type=int, default=8)
+    dedup.add_argument("--editions", type=int, default=3, help="Copies of every document in the 'editions' chapter.")
+    dedup.add_argument("--edit-rate", type=float, default=0.02, help="Share of words changed in each edition.")
+    dedup.set_defaults(func=run_dedup_benchmark)
+
+    summaries = subparsers.add_parser("summaries", help="Build time and reuse of the chapter summary tree, and mind map prompt size.")
+    summaries.add_argument("--documents", type=int, default=4)
+    summaries.add_argument("--pages", type=int, default=10)
+    summaries.add_argument("--llm-latency", type=float, default=0.2, help="Seconds every fake LLM call takes.")
+    summaries.set_defaults(func=run_summaries_benchmark)
+
+    extraction = subparsers.add_parser("extraction", help="PDF extraction and re-indexing with and without the extracted text store.")
+    extraction.add_argument("--documents", type=int, default=10)
+    extraction.add_argument("--pages", type=int, default=40)
+    extraction.add_argument("--iterations", type=int, default=5)
+    extraction.set_defaults(func=run_extraction_benchmark)
+
+    tempchat = subparsers.add_parser("tempchat", help="Temporary chat uploads: in-memory appends against on-disk rebuilds.")
+    tempchat.add_argument("--documents", type=int, default=8)
+    tempchat.add_argument("--pages", type=int, default=6)
+    tempchat.set_defaults(func=run_tempchat_benchmark)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
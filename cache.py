@@ -0,0 +1,615 @@
+"""
+Cache shared by the app replicas.
+
+    python cache.py stats [--backend disk]
+    python cache.py invalidate <namespace>
+    python cache.py fake-redis [--port 6390]
+
+CACHE_BACKEND picks where cached values live:
+    memory  an LRU dictionary in this process (the default; nothing is shared)
+    disk    a SQLite file (CACHE_PATH, default .cache/shared_cache.db) shared by the
+            replicas of one host or volume
+    redis   any server speaking the Redis protocol (CACHE_URL=redis://[:password@]host:6379/0),
+            shared by every replica; bound its memory with maxmemory and an LRU policy
+    none    caching off
+CACHE_MAX_MB bounds the memory and disk backends; values over CACHE_MAX_VALUE_KB are
+never stored. Values are JSON, zlib-compressed when large.
+
+Namespaces are paths whose last segment names the cache, e.g. "extracted_pages",
+"llm/grading" or "<user>/<subject>/<chapter>/chunks": invalidate("<user>") drops
+everything cached under that user at once, and hits and misses are counted per cache.
+Backend failures count as misses, since the cache only saves time.
+"""
+import os
+import re
+import json
+import time
+import zlib
+import socket
+import sqlite3
+import hashlib
+import argparse
+import itertools
+import threading
+import socketserver
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+
+from telemetry import cache_request, count
+
+CACHE_BACKENDS = ("memory", "disk", "redis", "none")
+DEFAULT_CACHE_PATH = os.path.join(".cache", "shared_cache.db")
+DEFAULT_CACHE_URL = "redis://127.0.0.1:6379/0"
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_MB", "64")) * 2**20
+CACHE_MAX_VALUE_BYTES = int(os.getenv("CACHE_MAX_VALUE_KB", "4096")) * 1024
+CACHE_DEFAULT_TTL = int(os.getenv("CACHE_DEFAULT_TTL_HOURS", "168")) * 3600
+CACHE_COMPRESS_MIN_BYTES = 1024
+CACHE_KEY_PREFIX = "study_coach:"
+# Disk entries record reads at most this often, so hits rarely write
+DISK_TOUCH_SECONDS = 60
+# The disk backend checks its size after this many writes
+DISK_EVICT_EVERY = 32
+# After a failed Redis call the backend answers misses for this long before reconnecting
+REDIS_RETRY_SECONDS = 10.0
+REDIS_TIMEOUT = 2.0
+
+
+class CacheError(Exception):
+    """The cache backend failed or answered with an error."""
+
+
+# Default of SharedCache.get() in get_or_compute(), so a cached null counts as a hit
+_MISSING = object()
+
+
+def _encode(value):
+    data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(data) >= CACHE_COMPRESS_MIN_BYTES:
+        return b"z" + zlib.compress(data, 6)
+    return b"j" + data
+
+def _decode(data):
+    if data[:1] == b"z":
+        return json.loads(zlib.decompress(data[1:]))
+    return json.loads(data[1:])
+
+def _in_namespace(namespace, prefix):
+    return namespace == prefix or namespace.startswith(prefix + "/")
+
+def hash_key(*parts):
+    """Short stable key of any JSON-serializable parts, e.g. hash_key(task, prompt_text)."""
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()[:32]
+
+
+# ================= Backends =================
+# A backend stores encoded values by (namespace, key) with an absolute expiry time
+# (None for no expiry) and drops whole namespace subtrees in invalidate().
+class MemoryBackend:
+    """LRU dictionary of this process, bounded by the total size of its values."""
+    name = "memory"
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # (namespace, key) -> (data, expires_at), least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, namespace, key):
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.time():
+                self._remove((namespace, key))
+                return None
+            self._entries.move_to_end((namespace, key))
+            return entry[0]
+
+    def set(self, namespace, key, data, expires_at):
+        with self._lock:
+            self._remove((namespace, key))
+            self._entries[(namespace, key)] = (data, expires_at)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+    def invalidate(self, namespace):
+        with self._lock:
+            keys = [entry_key for entry_key in self._entries if _in_namespace(entry_key[0], namespace)]
+            for entry_key in keys:
+                self._remove(entry_key)
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "evictions": self.evictions}
+
+
+class DiskBackend:
+    """
+    SQLite file shared by the processes of one host. Least recently read entries are
+    deleted once the values together exceed max_bytes; expired ones go first.
+    """
+    name = "disk"
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writes = itertools.count(1)
+        self.evictions = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_accessed ON cache_entries (accessed_at)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def get(self, namespace, key):
+        conn = self._connection()
+        row = conn.execute("SELECT value, expires_at, accessed_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                           (namespace, key)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row[1] is not None and row[1] <= now:
+            conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+            return None
+        if now - row[2] > DISK_TOUCH_SECONDS:
+            conn.execute("UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+        return bytes(row[0])
+
+    def set(self, namespace, key, data, expires_at):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache_entries (namespace, key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (namespace, key, data, len(data), expires_at, time.time()))
+        # next() on a count is atomic, so concurrent writers never skip an eviction check
+        if next(self._writes) % DISK_EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Deletes expired entries, then the least recently read ones until the values fit max_bytes."""
+        conn = self._connection()
+        conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+        while total > self.max_bytes:
+            rows = conn.execute("SELECT namespace, key, size FROM cache_entries ORDER BY accessed_at LIMIT 64").fetchall()
+            if not rows:
+                break
+            for namespace, key, size in rows:
+                conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+                total -= size
+                self.evictions += 1
+                if total <= self.max_bytes:
+                    break
+
+    def invalidate(self, namespace):
+        pattern = namespace.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "/%"
+        return self._connection().execute(
+            "DELETE FROM cache_entries WHERE namespace = ? OR namespace LIKE ? ESCAPE '\\'", (namespace, pattern)).rowcount
+
+    def stats(self):
+        entries, size = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries").fetchone()
+        return {"entries": entries, "bytes": size, "evictions": self.evictions}
+
+
+def _redis_command(*args):
+    """Encodes one command in the Redis protocol (RESP)."""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+def _read_redis_reply(stream):
+    line = stream.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("connection closed by the cache server")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode("utf-8")
+    if kind == b"-":
+        raise CacheError(payload.decode("utf-8"))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("connection closed by the cache server")
+        return data[:-2]
+    if kind == b"*":
+        length = int(payload)
+        return None if length < 0 else [_read_redis_reply(stream) for _ in range(length)]
+    raise ConnectionError(f"unexpected reply {line[:40]!r}")
+
+def _redis_glob_escape(text):
+    return re.sub(r"([*?\[\]\\])", r"\\\1", text)
+
+
+class RedisBackend:
+    """
+    Client of a Redis-protocol server, e.g. redis://:password@host:6379/0. Keys are
+    "study_coach:<namespace>|<key>"; expiry and memory limits are left to the server.
+    """
+    name = "redis"
+
+    def __init__(self, url: str = DEFAULT_CACHE_URL, timeout: float = REDIS_TIMEOUT):
+        parsed = urlparse(url)
+        if parsed.scheme not in ("redis", ""):
+            raise ValueError(f"unsupported cache URL {url!r}")
+        self.host, self.port = parsed.hostname or "127.0.0.1", parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        # One connection per thread (one per Streamlit session run), so sessions do not queue on one socket
+        self._local = threading.local()
+        self._down_until = 0.0
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = (sock, sock.makefile("rb"))
+            if self.password:
+                self._send(connection, "AUTH", self.password)
+            if self.db:
+                self._send(connection, "SELECT", self.db)
+        except Exception:
+            # Never keep a connection that is not authenticated or on the wrong database
+            sock.close()
+            raise
+        self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _send(connection, *args):
+        sock, stream = connection
+        sock.sendall(_redis_command(*args))
+        return _read_redis_reply(stream)
+
+    def call(self, *args):
+        """
+        Sends one command and returns its reply. Raises CacheError while the server is
+        unreachable or refuses the connection (e.g. a wrong password), and for error replies.
+        """
+        if time.monotonic() < self._down_until:
+            raise CacheError("cache server unavailable")
+        try:
+            connection = self._connection()
+        except Exception as e:
+            self._down_until = time.monotonic() + REDIS_RETRY_SECONDS
+            raise CacheError(f"cache server unavailable: {e}") from e
+        try:
+            return self._send(connection, *args)
+        except CacheError:
+            # An error reply is read in full, so the connection stays usable
+            raise
+        except Exception as e:
+            self._close()
+            self._down_until = time.monotonic() + REDIS_RETRY_SECONDS
+            raise CacheError(f"cache server unavailable: {e}") from e
+
+    def _close(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            try:
+                connection[0].close()
+            except OSError:
+                pass
+
+    @staticmethod
+    def _key(namespace, key):
+        return f"{CACHE_KEY_PREFIX}{namespace}|{key}"
+
+    def get(self, namespace, key):
+        return self.call("GET", self._key(namespace, key))
+
+    def set(self, namespace, key, data, expires_at):
+        if expires_at is None:
+            self.call("SET", self._key(namespace, key), data)
+        else:
+            self.call("SET", self._key(namespace, key), data, "PX", max(1, int((expires_at - time.time()) * 1000)))
+
+    def invalidate(self, namespace):
+        deleted = 0
+        escaped = _redis_glob_escape(CACHE_KEY_PREFIX + namespace)
+        for pattern in (escaped + "|*", escaped + "/*"):
+            cursor = "0"
+            while True:
+                cursor, keys = self.call("SCAN", cursor, "MATCH", pattern, "COUNT", 1000)
+                cursor = cursor.decode("utf-8") if isinstance(cursor, bytes) else str(cursor)
+                if keys:
+                    deleted += self.call("DEL", *keys)
+                if cursor == "0":
+                    break
+        return deleted
+
+    def stats(self):
+        return {"entries": self.call("DBSIZE"), "server": f"{self.host}:{self.port}/{self.db}"}
+
+
+# ================= Shared cache =================
+class SharedCache:
+    """
+    Namespaced cache over one backend, with TTLs and hit-rate metrics per cache (the
+    last namespace segment). Values must be JSON-serializable.
+    """
+
+    def __init__(self, backend, default_ttl: int = CACHE_DEFAULT_TTL, max_value_bytes: int = CACHE_MAX_VALUE_BYTES):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.max_value_bytes = max_value_bytes
+        self._counts = {}   # cache name -> {"hits", "misses", "sets", "errors"}
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.backend.name if self.backend is not None else "none"
+
+    def _count(self, namespace, field):
+        cache = namespace.rsplit("/", 1)[-1]
+        with self._lock:
+            counts = self._counts.setdefault(cache, {"hits": 0, "misses": 0, "sets": 0, "errors": 0})
+            counts[field] += 1
+        if field in ("hits", "misses"):
+            cache_request(cache, hit=field == "hits", backend=self.name)
+        elif field == "errors":
+            count("shared_cache_errors", cache=cache, backend=self.name)
+
+    def get(self, namespace, key, default=None):
+        """Returns the cached value, or default when it is missing, expired or the backend failed."""
+        if self.backend is None:
+            return default
+        try:
+            data = self.backend.get(namespace, key)
+            value = _decode(data) if data is not None else None
+        except (CacheError, sqlite3.Error, ValueError, zlib.error) as e:
+            print(f"Shared cache read failed: {e}")
+            self._count(namespace, "errors")
+            data = None
+        self._count(namespace, "hits" if data is not None else "misses")
+        return value if data is not None else default
+
+    def set(self, namespace, key, value, ttl=None):
+        """Stores value for ttl seconds (default_ttl when None, no expiry when 0). Returns whether it was stored."""
+        if self.backend is None:
+            return False
+        data = _encode(value)
+        if len(data) > self.max_value_bytes:
+            return False
+        ttl = self.default_ttl if ttl is None else ttl
+        try:
+            self.backend.set(namespace, key, data, time.time() + ttl if ttl else None)
+        except (CacheError, sqlite3.Error) as e:
+            print(f"Shared cache write failed: {e}")
+            self._count(namespace, "errors")
+            return False
+        self._count(namespace, "sets")
+        return True
+
+    def get_or_compute(self, namespace, key, compute, ttl=None):
+        """Returns the cached value (None included), or computes, stores and returns it."""
+        value = self.get(namespace, key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.set(namespace, key, value, ttl)
+        return value
+
+    def invalidate(self, namespace):
+        """Drops namespace and every namespace under it. Returns the number of entries dropped, or None on failure."""
+        if self.backend is None:
+            return 0
+        try:
+            return self.backend.invalidate(namespace)
+        except (CacheError, sqlite3.Error) as e:
+            print(f"Shared cache invalidation failed: {e}")
+            return None
+
+    def stats(self):
+        """Hit rates per cache and the size of the backend."""
+        with self._lock:
+            caches = {cache: dict(counts, hit_rate=counts["hits"] / max(counts["hits"] + counts["misses"], 1))
+                      for cache, counts in self._counts.items()}
+        try:
+            backend = self.backend.stats() if self.backend is not None else {}
+        except (CacheError, sqlite3.Error) as e:
+            backend = {"error": str(e)}
+        return {"backend": self.name, "caches": caches, **backend}
+
+
+def create_cache(kind: str = "memory", url: str = None, path: str = None, max_bytes: int = None, default_ttl: int = None):
+    """Returns a SharedCache over the named backend: "memory", "disk", "redis" or "none"."""
+    kind = (kind or "memory").lower()
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    if kind == "memory":
+        backend = MemoryBackend(max_bytes)
+    elif kind == "disk":
+        backend = DiskBackend(path or DEFAULT_CACHE_PATH, max_bytes)
+    elif kind == "redis":
+        backend = RedisBackend(url or DEFAULT_CACHE_URL)
+    elif kind == "none":
+        backend = None
+    else:
+        raise ValueError(f"unknown cache backend {kind!r}, expected one of {', '.join(CACHE_BACKENDS)}")
+    return SharedCache(backend, CACHE_DEFAULT_TTL if default_ttl is None else default_ttl)
+
+
+# ================= Fake Redis server =================
+def _redis_glob_to_regex(pattern):
+    regex, i = [], 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 1
+        elif char == "*":
+            regex.append(".*")
+        elif char == "?":
+            regex.append(".")
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return re.compile("".join(regex), re.DOTALL)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """
+    Small in-memory server speaking the subset of the Redis protocol RedisBackend uses
+    (PING, AUTH, SELECT, GET, SET with EX/PX, DEL, SCAN, DBSIZE, FLUSHDB), so the
+    backend can be tested without a Redis installation.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=6390, password=None):
+        self.password = password
+        self.data = {}     # db -> {key: (value, expires_at)}
+        self.lock = threading.Lock()
+        self.commands = 0
+        super().__init__((host, port), _FakeRedisHandler)
+
+    def start(self):
+        """Serves on a daemon thread and returns self."""
+        threading.Thread(target=self.serve_forever, daemon=True, name="fake-redis").start()
+        return self
+
+    def _live(self, db, key, now):
+        entry = self.data.setdefault(db, {}).get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self.data[db][key]
+            return None
+        return entry
+
+    def execute(self, session, args):
+        command = args[0].decode("utf-8").upper()
+        if self.password and not session.get("authenticated") and command not in ("AUTH", "PING"):
+            raise CacheError("NOAUTH Authentication required.")
+        db, now = session.get("db", 0), time.time()
+        with self.lock:
+            self.commands += 1
+            if command == "PING":
+                return "PONG"
+            if command == "AUTH":
+                if args[-1].decode("utf-8") != (self.password or ""):
+                    raise CacheError("WRONGPASS invalid password")
+                session["authenticated"] = True
+                return "OK"
+            if command == "SELECT":
+                session["db"] = int(args[1])
+                return "OK"
+            if command == "GET":
+                entry = self._live(db, args[1], now)
+                return entry[0] if entry is not None else None
+            if command == "SET":
+                expires_at, options = None, [arg.decode("utf-8").upper() for arg in args[3::2]]
+                for option, amount in zip(options, args[4::2]):
+                    expires_at = now + int(amount) / (1000 if option == "PX" else 1)
+                self.data.setdefault(db, {})[args[1]] = (args[2], expires_at)
+                return "OK"
+            if command == "DEL":
+                return sum(self.data.setdefault(db, {}).pop(key, None) is not None for key in args[1:])
+            if command == "SCAN":
+                # The whole keyspace in one page: cursor 0 both ways
+                options = {args[i].decode("utf-8").upper(): args[i + 1] for i in range(2, len(args) - 1, 2)}
+                pattern = _redis_glob_to_regex(options.get("MATCH", b"*").decode("utf-8"))
+                keys = [key for key in list(self.data.setdefault(db, {}))
+                        if self._live(db, key, now) is not None and pattern.fullmatch(key.decode("utf-8"))]
+                return [b"0", keys]
+            if command == "DBSIZE":
+                return sum(self._live(db, key, now) is not None for key in list(self.data.setdefault(db, {})))
+            if command == "FLUSHDB":
+                self.data[db] = {}
+                return "OK"
+        raise CacheError(f"ERR unknown command '{command}'")
+
+
+class _FakeRedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        session = {}
+        while True:
+            try:
+                args = _read_redis_reply(self.rfile)
+            except (ConnectionError, OSError, ValueError):
+                return
+            try:
+                reply = self.server.execute(session, args)
+            except CacheError as e:
+                self.wfile.write(b"-%s\r\n" % str(e).encode("utf-8"))
+                continue
+            self.wfile.write(_encode_redis_reply(reply))
+
+def _encode_redis_reply(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, str):
+        return b"+%s\r\n" % reply.encode("utf-8")
+    if isinstance(reply, bool) or isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    return b"*%d\r\n" % len(reply) + b"".join(_encode_redis_reply(item) for item in reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared cache maintenance and a fake Redis server for tests.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name in ("stats", "invalidate"):
+        sub = subparsers.add_parser(name)
+        sub.add_argument("--backend", default=os.getenv("CACHE_BACKEND", "disk"), choices=CACHE_BACKENDS)
+        sub.add_argument("--url", default=os.getenv("CACHE_URL"))
+        sub.add_argument("--path", default=os.getenv("CACHE_PATH"))
+        if name == "invalidate":
+            sub.add_argument("namespace", help='e.g. "llm/grading" or a user hash')
+    fake = subparsers.add_parser("fake-redis", help="Run the in-memory Redis stand-in.")
+    fake.add_argument("--host", default="127.0.0.1")
+    fake.add_argument("--port", type=int, default=6390)
+    fake.add_argument("--password")
+    args = parser.parse_args()
+
+    if args.command == "fake-redis":
+        server = FakeRedisServer(args.host, args.port, args.password)
+        print(f"Fake Redis server listening on {args.host}:{args.port} (Ctrl+C to stop)", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    cache = create_cache(args.backend, url=args.url, path=args.path)
+    if args.command == "stats":
+        print(json.dumps(cache.stats(), indent=2))
+    else:
+        print(f"Dropped {cache.invalidate(args.namespace)} entries under {args.namespace!r}")
+
+
+if __name__ == "__main__":
+    main()
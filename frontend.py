@@ -1,10 +1,16 @@
 import os
+import sys
 import time
+import uuid
+import datetime
+import telemetry
 from backend import *
 import streamlit as st
-from ai_features import *
 import streamlit.components.v1 as components
 
+# ai_features pulls in langchain, FAISS and the document parsers, so it is imported
+# inside the functions that need it. Login and the home page never load it.
+
 # ================ Home Page Functionality =================
 def home_page():
     st.header("🏠 Home")
@@ -96,7 +102,59 @@ def home_page():
 
 
 # ================ chapter functionality ====================
+def show_citations(citations, subject, chapter, key, get_passage=None):
+    """
+    Lists the sources of an answer; each button shows the passage read from the material file,
+    or from get_passage(citation) for materials that are not on disk.
+    """
+    if not citations:
+        return
+    from ai_features import get_source_passage
+    st.caption("Sources: " + " · ".join(f"[{i}] {citation['label']}" for i, citation in enumerate(citations, start=1)))
+    columns = st.columns(len(citations))
+    for i, (column, citation) in enumerate(zip(columns, citations), start=1):
+        with column:
+            if st.button(f"📄 [{i}]", key=f"source_{key}_{i}", help=f"Show source passage: {citation['label']}"):
+                shown = (key, i)
+                st.session_state.shown_source = None if st.session_state.get("shown_source") == shown else shown
+    shown_key, shown_index = st.session_state.get("shown_source") or (None, None)
+    if shown_key == key and shown_index <= len(citations):
+        citation = citations[shown_index - 1]
+        passage = (get_passage(citation) if get_passage
+                   else get_source_passage(st.session_state.sha1_of_username, subject, chapter, citation))
+        if passage:
+            also_in = f"\n\n*Also in: {'; '.join(citation['also_in'])}*" if citation.get("also_in") else ""
+            st.info(f"**{citation['label']}**\n\n{passage}{also_in}")
+        else:
+            st.warning(f"The source file {citation['source']} is no longer available.")
+
+def show_chapter_overview(subject, chapter):
+    """Shows the chapter and file summaries precomputed with the index, when it has them."""
+    version = get_current_index_version(st.session_state.sha1_of_username, subject, chapter)
+    tree = read_summary_tree(st.session_state.sha1_of_username, subject, chapter, version) if version else None
+    if not tree:
+        manifest = read_index_manifest(st.session_state.sha1_of_username, subject, chapter, version) if version else None
+        if manifest and manifest.get("summaries") == "missing":
+            st.caption("The chapter overview could not be built with the index.")
+            if st.button("Retry the chapter overview", key=f"retry_summaries_{subject}_{chapter}"):
+                from ai_features import fill_summary_tree
+                with st.spinner("Summarizing the chapter..."):
+                    try:
+                        fill_summary_tree(st.session_state.sha1_of_username, subject, chapter)
+                    except Exception as e:
+                        st.error(f"The chapter overview could not be built: {e}")
+                        return
+                st.rerun()
+        return
+    with st.expander("📝 Chapter overview"):
+        st.markdown(tree["nodes"][tree["root"]]["summary"])
+        file_nodes = get_summary_nodes(tree, "file")
+        if len(file_nodes) > 1:
+            for node in file_nodes:
+                st.markdown(f"**{node['title']}**\n\n{node['summary']}")
+
 def chat_with_ai_about_chapter(subject, chapter):
+    from ai_features import load_vector_store, get_chat_response, update_chat_memory
     vector_score = load_vector_store(st.session_state.sha1_of_username, subject, chapter)
     if st.session_state.chat_history.__len__() > 20:
         st.session_state.chat_history = st.session_state.chat_history[-20:]
@@ -105,11 +163,13 @@ def chat_with_ai_about_chapter(subject, chapter):
     with chat_container:
         conv_container = st.container(width=900, height=400, border=False)
         with conv_container:
-            for message in st.session_state.chat_history:
+            for i, message in enumerate(st.session_state.chat_history):
                 if message["role"] == "user":
                     st.chat_message("user").markdown(message["content"])
                 else:
-                    st.chat_message("assistant").markdown(message["content"])
+                    with st.chat_message("assistant"):
+                        st.markdown(message["content"])
+                        show_citations(message.get("citations"), subject, chapter, f"chapter_{i}")
         prompt = st.chat_input("Ask anything about this chapter...")
         if prompt:
             with conv_container:
@@ -117,19 +177,38 @@ def chat_with_ai_about_chapter(subject, chapter):
                 st.chat_message("user").markdown(prompt)
 
                 with st.spinner("AI is typing..."):
-                    response = get_chat_response(prompt, vector_score)
+                    sha1 = st.session_state.sha1_of_username
+                    memory = get_chapter_chat_memory(sha1, subject, chapter)
+                    response, citations = get_chat_response(prompt, vector_score, memory)
                     # response = "Response from AI based on the chapter content."
-                    st.session_state.chat_history.append({"role": "assistant", "content": response})
-                    st.chat_message("assistant").markdown(response)
+                    st.session_state.chat_history.append({"role": "assistant", "content": response, "citations": citations})
+                    with st.chat_message("assistant"):
+                        st.markdown(response)
+                        show_citations(citations, subject, chapter, f"chapter_{len(st.session_state.chat_history) - 1}")
+                    save_chapter_chat_memory(sha1, subject, chapter, update_chat_memory(memory, prompt, response))
+
+def next_generation_attempt():
+    """
+    Numbers this session's quiz, exam, flashcard and mind map requests. The number seeds the
+    context draw, so a repeated request covers other parts of the chapter.
+    """
+    st.session_state.generation_attempt += 1
+    return st.session_state.generation_attempt
 
 def quiz_on_chapter(subject, chapter):
+    from ai_features import load_vector_store, generate_quiz_from_faiss, create_question
     vector_store = load_vector_store(st.session_state.sha1_of_username, subject, chapter)
 
     if not st.session_state.quiz_ongoing:
         st.radio("How many questions would you like in the quiz?", [5, 10, 20], key="quiz_total_questions", horizontal=True)
+        topic_stats = get_topic_progress(st.session_state.sha1_of_username, subject, chapter)
+        focus_weak = st.toggle("Focus on my weak topics", value=bool(topic_stats), disabled=not topic_stats,
+                               help="Draws more questions from the topics you answered worst so far.")
         if st.button("Start Quiz"):
             with st.spinner("Generating quiz..."):
-                st.session_state.quiz_question_bank = generate_quiz_from_faiss(vector_store, st.session_state.quiz_total_questions)
+                st.session_state.quiz_question_bank = generate_quiz_from_faiss(
+                    vector_store, st.session_state.quiz_total_questions, topic_stats if focus_weak else None,
+                    next_generation_attempt())
             if st.session_state.quiz_question_bank:
                 st.session_state.quiz_ongoing = True
                 st.session_state.quiz_score = 0
@@ -140,6 +219,7 @@ def quiz_on_chapter(subject, chapter):
                 st.session_state.quiz_review_mode = False
                 st.session_state.record_added = False
                 st.session_state.completed = True
+                st.session_state.quiz_start_time = int(time.time())
                 st.rerun()
             else:
                 st.error("Could not generate a quiz. Please check your document or try again.")
@@ -160,6 +240,15 @@ def quiz_on_chapter(subject, chapter):
                 st.rerun()
         else:
             st.session_state.quiz_ended = True
+            if not st.session_state.record_added:
+                bank = st.session_state.quiz_question_bank
+                record_attempt(st.session_state.sha1_of_username, subject, chapter, "quiz", [
+                    {"question": bank[i]["question"], "topic": bank[i].get("topic"), "given_answer": chosen,
+                     "correct_answer": bank[i]["correct_option"], "score": float(chosen == bank[i]["correct_option"]),
+                     "max_score": 1.0}
+                    for i, chosen in enumerate(st.session_state.quiz_options_chosen)
+                ], started_at=st.session_state.get("quiz_start_time"))
+                st.session_state.record_added = True
             if st.session_state.quiz_balloons == False:
                 if st.session_state.quiz_score > 0:
                     st.balloons()
@@ -195,14 +284,35 @@ def quiz_on_chapter(subject, chapter):
                                 st.info(f"Correct answer: {correct_choice}")
             # st.rerun()
 
+def start_flashcard_review(subject, chapter, num_cards):
+    """Returns the cards of a review session: due cards first, topped up with newly generated ones."""
+    sha1 = st.session_state.sha1_of_username
+    cards = get_due_flashcards(sha1, subject, chapter, num_cards)
+    st.session_state.flashcard_top_up_note = None
+    if len(cards) < num_cards:
+        # Only a top-up needs the model; a session of due cards is a single DB read
+        from ai_features import load_vector_store, generate_flashcards_from_faiss
+        vector_store = load_vector_store(sha1, subject, chapter)
+        wanted = num_cards - len(cards)
+        new_cards = generate_flashcards_from_faiss(vector_store, wanted, next_generation_attempt())
+        # Questions the chapter already has a card for are not added again
+        added = add_flashcards(sha1, subject, chapter, [card for card in new_cards if card.get("question") and card.get("answer")])
+        if added < wanted:
+            st.session_state.flashcard_top_up_note = (
+                f"Only {added} of the {wanted} requested new flashcards were added; "
+                "the rest repeated cards you already have or could not be generated."
+            )
+        cards = get_due_flashcards(sha1, subject, chapter, num_cards)
+    return cards
+
 def flashcards_on_chapter(subject, chapter):
-    vector_store = load_vector_store(st.session_state.sha1_of_username, subject, chapter)
-    
     if not st.session_state.flashcard_ongoing:
-        st.radio("How many flashcards would you like to generate?", [5, 10, 20], key="flashcard_total_cards", horizontal=True)
+        counts = get_flashcard_counts(st.session_state.sha1_of_username, subject, chapter)
+        st.caption(f"{counts['due']} of your {counts['total']} saved flashcards are due for review.")
+        st.radio("How many flashcards would you like to review?", [5, 10, 20], key="flashcard_total_cards", horizontal=True)
         if st.button("Start Flashcards"):
-            with st.spinner("Generating flashcards..."):
-                st.session_state.flashcard_flashcards = generate_flashcards_from_faiss(vector_store, st.session_state.flashcard_total_cards)
+            with st.spinner("Preparing flashcards..."):
+                st.session_state.flashcard_flashcards = start_flashcard_review(subject, chapter, st.session_state.flashcard_total_cards)
             if st.session_state.flashcard_flashcards:
                 st.session_state.flashcard_ongoing = True
                 st.session_state.flashcard_current_card = 0
@@ -213,87 +323,96 @@ def flashcards_on_chapter(subject, chapter):
                 st.rerun()
             else:
                 st.error("Could not generate flashcards. Please check your document or try again.")
+                if st.session_state.flashcard_top_up_note:
+                    st.caption(st.session_state.flashcard_top_up_note)
     else:
         idx = st.session_state.flashcard_current_card
         total_cards = len(st.session_state.flashcard_flashcards)
         if idx < total_cards:
             current_card = st.session_state.flashcard_flashcards[idx]
             st.markdown(f"### Flashcard {idx+1} of {total_cards}")
+            if idx == 0 and st.session_state.flashcard_top_up_note:
+                st.caption(st.session_state.flashcard_top_up_note)
             st.markdown(f"<div style='font-size:24px; font-weight:bold;'>Q: {current_card['question']}</div>", unsafe_allow_html=True)
             if not st.session_state.get("flashcard_show_answer", False):
                 if st.button("Show Answer"):
                     st.session_state.flashcard_show_answer = True
                     st.rerun()
             else:
-                if st.button("Hide Answer"):
-                    st.session_state.flashcard_show_answer = False
-                    st.rerun()
                 st.markdown(f"<div style='font-size:24px; font-weight:bold;'>A: {current_card['answer']}</div>", unsafe_allow_html=True)
-            _, col1, _, col2, _, col3, _ = st.columns([1,2,1,2,1,2,1])
-            with col1:
-                if st.button("Previous", use_container_width=True) and idx > 0:
-                    st.session_state.flashcard_current_card -= 1
-                    st.rerun()
-            with col2:
-                if st.button("End Flashcards", use_container_width=True):
-                    st.session_state.flashcard_ongoing = False
-                    st.rerun()
-            with col3:
-                if st.button("Next", use_container_width=True) and idx < total_cards - 1:
-                    st.session_state.flashcard_current_card += 1
-                    st.rerun()
+                st.write("How well did you remember it?")
+                # Grading schedules the card's next review and moves on to the next card
+                for column, (label, grade) in zip(st.columns(len(FLASHCARD_GRADES)), FLASHCARD_GRADES.items()):
+                    with column:
+                        if st.button(label, key=f"flashcard_grade_{label}", use_container_width=True):
+                            review_flashcard(st.session_state.sha1_of_username, current_card["id"], grade)
+                            st.session_state.flashcard_current_card += 1
+                            st.session_state.flashcard_show_answer = False
+                            st.rerun()
+            if st.button("End Flashcards", use_container_width=True):
+                st.session_state.flashcard_ongoing = False
+                st.rerun()
         else:
             st.session_state.flashcard_ongoing = False
-            st.success("You've gone through all the flashcards!")
+            st.success("You've gone through all the flashcards! They will come back when they are due again.")
             if st.button("End Flashcards", use_container_width=True):
                 st.session_state.flashcard_ongoing = False
                 st.rerun()
 
 def mindmap_on_chapter(subject, chapter):
     """
-    Generates and displays a mind map for the selected chapter using its vector store.
+    Displays the mind map of the selected chapter, generating it from the vector store
+    when none is stored for the current index version.
     """
-    vector_store = load_vector_store(st.session_state.sha1_of_username, subject, chapter)
+    sha1 = st.session_state.sha1_of_username
+    mindmap = get_chapter_mindmap(sha1, subject, chapter, get_current_index_version(sha1, subject, chapter))
+    if mindmap is not None and mindmap["mermaid"] is None:
+        # Generation failed part way; "Update" generates the missing branches
+        mindmap = None
     st.write("Visualize the key concepts and their relationships from your study material.")
 
     # Use columns for button layout
     col1, col2 = st.columns([1, 1])
 
     with col1:
-        if st.session_state.mindmap_content is None:
-            if st.button("✨ Generate", use_container_width=True):
+        if mindmap is None:
+            # A map of an older index version means only the changed files need new branches
+            label = "🔄 Update for new materials" if get_chapter_mindmap(sha1, subject, chapter) else "✨ Generate"
+            if st.button(label, use_container_width=True):
                 with st.spinner("AI is creating your mind map..."):
-                    # Call the backend function to get the mind map in Mermaid format
-                    mermaid_syntax = generate_mindmap_from_faiss(vector_store)
-                    if mermaid_syntax:
-                        st.session_state.mindmap_content = mermaid_syntax
+                    if generate_chapter_mindmap(subject, chapter, regenerate=False):
                         st.rerun()
                     else:
                         st.error("Failed to generate mind map. Please try again or check your uploaded materials.")
     
     with col2:
         # Show "Regenerate" button if a mind map already exists
-        if st.session_state.mindmap_content is not None:
+        if mindmap is not None:
             if st.button("🔄 Regenerate", use_container_width=True):
-                st.session_state.mindmap_content = None # Clear existing content
                 with st.spinner("AI is creating a new mind map..."):
-                    mermaid_syntax = generate_mindmap_from_faiss(vector_store)
-                    if mermaid_syntax:
-                        st.session_state.mindmap_content = mermaid_syntax
+                    if generate_chapter_mindmap(subject, chapter, regenerate=True):
                         st.rerun()
                     else:
                         st.error("Failed to generate mind map. Please try again.")
 
-    # Display the generated mind map
-    if st.session_state.mindmap_content:
+    # Display the stored mind map
+    if mindmap is not None:
         st.markdown("---")
         with st.container(border=True):
             st.markdown("#### Your Mind Map:")
-            components.html(get_mermaid_html(st.session_state.mindmap_content), height=500, scrolling=True)
+            components.html(get_mermaid_html(mindmap["mermaid"]), height=500, scrolling=True)
     else:
         st.info("Click '✨ Generate' to create a mind map from your chapter materials.")
 
+def generate_chapter_mindmap(subject, chapter, regenerate):
+    from ai_features import load_vector_store, build_chapter_mindmap
+    sha1 = st.session_state.sha1_of_username
+    vector_store = load_vector_store(sha1, subject, chapter)
+    return build_chapter_mindmap(sha1, subject, chapter, vector_store, regenerate=regenerate,
+                                 attempt=next_generation_attempt())
+
 def exam_on_chapter(subject, chapter):
+    from ai_features import load_vector_store, generate_exam_from_faiss, create_exam_question, evaluate_exam
     vector_store = load_vector_store(st.session_state.sha1_of_username, subject, chapter)
 
     if not st.session_state.exam_ongoing:
@@ -307,7 +426,8 @@ def exam_on_chapter(subject, chapter):
         )
         if st.button("Start Exam"):
             with st.spinner("Generating exam..."):
-                st.session_state.exam_question_bank = generate_exam_from_faiss(vector_store, st.session_state.exam_total_score, st.session_state.exam_total_questions)
+                st.session_state.exam_question_bank = generate_exam_from_faiss(vector_store, st.session_state.exam_total_score,
+                                                                         st.session_state.exam_total_questions, next_generation_attempt())
             if st.session_state.exam_question_bank:
                 st.session_state.exam_ongoing = True
                 st.session_state.exam_score = 0
@@ -320,6 +440,7 @@ def exam_on_chapter(subject, chapter):
                 st.session_state.exam_scores_obtained = []
                 st.session_state.exam_balloons = False
                 st.session_state.exam_ended = False
+                st.session_state.exam_start_time = int(time.time())
                 # st.session_state.exam_total_questions = len(st.session_state.exam_question_bank)
                 st.rerun()
             else:
@@ -343,6 +464,13 @@ def exam_on_chapter(subject, chapter):
                     for i in range(len(st.session_state.exam_answers_given)):
                         st.session_state.exam_scores_obtained.append(evaluate_exam(st.session_state.exam_question_bank[i]['answer'], st.session_state.exam_answers_given[i], st.session_state.exam_question_bank[i]['score']))
                     st.session_state.exam_score = sum(st.session_state.exam_scores_obtained)
+                    bank = st.session_state.exam_question_bank
+                    record_attempt(st.session_state.sha1_of_username, subject, chapter, "exam", [
+                        {"question": bank[i]["question"], "topic": bank[i].get("topic"), "given_answer": given,
+                         "correct_answer": bank[i]["answer"], "score": float(st.session_state.exam_scores_obtained[i]),
+                         "max_score": float(bank[i]["score"])}
+                        for i, given in enumerate(st.session_state.exam_answers_given)
+                    ], started_at=st.session_state.get("exam_start_time"))
                 st.session_state.exam_evaluated = True
             # print(st.session_state.exam_total_score)
             st.markdown(f"## Exam Complete! Your Score: {st.session_state.exam_score} / {st.session_state.exam_total_score}")
@@ -377,6 +505,37 @@ def exam_on_chapter(subject, chapter):
                             st.markdown(f" - Obtained marks {obtained_marks} out of {float(q_data['score'])}")
 
 
+def progress_on_chapter(subject, chapter):
+    """Shows the quiz/exam progress of the chapter from the precomputed aggregates."""
+    sha1 = st.session_state.sha1_of_username
+    progress = get_chapter_progress(sha1, subject, chapter)
+    if not progress:
+        st.info("No quiz or exam attempts yet. Take a quiz or an exam to start tracking your progress.")
+        return
+
+    columns = st.columns(len(progress))
+    for column, (kind, entry) in zip(columns, sorted(progress.items())):
+        with column:
+            st.metric(f"{kind.capitalize()} accuracy (recent)", f"{entry['recent_accuracy']:.0%}",
+                      f"{entry['recent_accuracy'] - entry['accuracy']:+.0%} vs. overall")
+            st.caption(f"{entry['attempts']} attempts · {entry['questions']} questions · best {entry['best_accuracy']:.0%}")
+
+    weak_topics = get_weak_topics(sha1, subject, chapter)
+    if weak_topics:
+        st.markdown("#### Topics to revise")
+        st.dataframe(
+            [{"topic": row["topic"], "recent accuracy": f"{row['recent_accuracy']:.0%}", "answered": row["answered"]}
+             for row in weak_topics],
+            hide_index=True, use_container_width=True,
+        )
+    st.markdown("#### Recent attempts")
+    st.dataframe(
+        [{"kind": row["kind"], "score": f"{row['score']:g} / {row['max_score']:g}", "questions": row["num_questions"],
+          "finished": datetime.datetime.fromtimestamp(row["finished_at"]).strftime("%Y-%m-%d %H:%M")}
+         for row in get_recent_attempts(sha1, subject, chapter)],
+        hide_index=True, use_container_width=True,
+    )
+
 def open_a_chapter():
     if not st.session_state.app_layout == "wide":
         st.session_state.app_layout = "wide"
@@ -390,6 +549,9 @@ def open_a_chapter():
             st.header(f"Subject: {st.session_state.selected_subject}")
         with col2:
             st.subheader(f"📖 {st.session_state.selected_chapter}")
+        st.session_state.vector_store_exists = get_current_index_version(st.session_state.sha1_of_username,
+                                                                         st.session_state.selected_subject,
+                                                                         st.session_state.selected_chapter) is not None
 
         # if st.button("Go to homepage"):
         #     st.session_state.page = "🏠 Home"
@@ -417,10 +579,15 @@ def open_a_chapter():
                 if st.button("Take exam", key="take_exam", use_container_width=True):
                     st.session_state.chapter_mode = "Take exam on this chapter"
                     st.rerun()
+
+                if st.button("View progress", key="view_progress", use_container_width=True):
+                    st.session_state.chapter_mode = "View progress on this chapter"
+                    st.rerun()
         with file_up_col2:
             with st.container(border=True):
                 st.subheader(f"Mode: {st.session_state.chapter_mode}")
                 if st.session_state.vector_store_exists:
+                    show_chapter_overview(st.session_state.selected_subject, st.session_state.selected_chapter)
                     if st.session_state.chapter_mode == "Chat with AI about this chapter":
                         chat_with_ai_about_chapter(st.session_state.selected_subject, st.session_state.selected_chapter)
                     elif st.session_state.chapter_mode == "Take a quiz on this chapter":
@@ -431,6 +598,8 @@ def open_a_chapter():
                         mindmap_on_chapter(st.session_state.selected_subject, st.session_state.selected_chapter)
                     elif st.session_state.chapter_mode == "Take exam on this chapter":
                         exam_on_chapter(st.session_state.selected_subject, st.session_state.selected_chapter)
+                    elif st.session_state.chapter_mode == "View progress on this chapter":
+                        progress_on_chapter(st.session_state.selected_subject, st.session_state.selected_chapter)
                 else:
                     st.warning("No vector store found for this chapter. Please upload materials to enable chapter functionalities.")
         with file_up_col3:
@@ -441,7 +610,31 @@ def open_a_chapter():
                                 st.session_state.selected_chapter, 
                                 uploaded_file)
                 st.success("File uploaded successfully!")
+            embedding = get_chapter_embedding(st.session_state.sha1_of_username,
+                                              st.session_state.selected_subject,
+                                              st.session_state.selected_chapter)
+            chosen_embedding = st.selectbox(
+                "Embeddings:",
+                list(CHAPTER_EMBEDDINGS),
+                index=list(CHAPTER_EMBEDDINGS).index(embedding),
+                format_func=CHAPTER_EMBEDDINGS.get,
+                key=f"embedding_{st.session_state.selected_subject}_{st.session_state.selected_chapter}",
+            )
+            if chosen_embedding != embedding:
+                set_chapter_embedding(st.session_state.sha1_of_username,
+                                      st.session_state.selected_subject,
+                                      st.session_state.selected_chapter,
+                                      chosen_embedding)
+            manifest = read_index_manifest(st.session_state.sha1_of_username,
+                                           st.session_state.selected_subject,
+                                           st.session_state.selected_chapter)
+            if manifest and (manifest.get("embedding") or {"kind": "default"})["kind"] != chosen_embedding:
+                st.info("Process the materials again to index them with these embeddings.")
+            if manifest and manifest.get("duplicate_chunks"):
+                st.caption(f"Index: {manifest['num_chunks']} chunks, {manifest['duplicate_chunks']} near-duplicates "
+                           f"collapsed ({manifest['dedup_ratio']:.0%}).")
             if st.button("Process Uploaded Materials"):
+                from ai_features import create_and_save_vector_store
                 create_and_save_vector_store(st.session_state.sha1_of_username, 
                                              st.session_state.selected_subject, 
                                              st.session_state.selected_chapter)
@@ -471,6 +664,7 @@ def open_a_chapter():
                         st.session_state.delete_selectbox = None  
 
                         # rebuild vector store after deletion
+                        from ai_features import create_and_save_vector_store
                         create_and_save_vector_store(
                             st.session_state.sha1_of_username,
                             st.session_state.selected_subject,
@@ -490,19 +684,23 @@ def open_a_chapter():
 def temporary_chat():
     # st.header("📤 Temporary Chat")
     st.markdown("<h2 style='text-align: center;'>📤 Temporary Chat</h2>", unsafe_allow_html=True)
+    from ai_features import (add_temp_material, get_temp_index, get_temp_source_passage, promote_temp_chat,
+                             get_chat_response, update_chat_memory)
 
     if not st.session_state.app_layout == "wide":
         st.session_state.app_layout = "wide"
         st.rerun()
 
+    temp_chat_id = st.session_state.temp_chat_id
+    temp_index = get_temp_index(temp_chat_id)
     col1, col2, _ = st.columns([1, 3, 1])
     with col1:
         st.info(" ⚠️ This is a temporary chat. All messages will be lost once you logout from current user.")
         st.markdown("---")
-        if st.session_state.vector_store_exists:
-            st.success("Vector store found for temporary chat.")
+        if temp_index:
+            st.success(f"Chatting about: {', '.join(temp_index['files'])}")
         else:
-            st.warning("No vector store found for temporary chat. Please upload and process files to enable chat functionality.")
+            st.warning("No materials in this temporary chat yet. Upload files to chat about them.")
         st.markdown("---")
         fileuploader = st.file_uploader("Upload study material (PDF, DOCX, TXT):", type=["pdf", "docx", "txt"])
         if fileuploader is not None:
@@ -510,9 +708,7 @@ def temporary_chat():
             if st.button("Upload and Process"):
                 info = ""
                 with st.spinner("Uploading and processing file..."):
-                    info = upload_material(st.session_state.sha1_of_username, "Temporary", "Temporary Chat", fileuploader)
-                    create_and_save_vector_store(st.session_state.sha1_of_username, "Temporary", "Temporary Chat")
-                    st.rerun()
+                    info = add_temp_material(temp_chat_id, fileuploader.name, fileuploader.getvalue())
                 if info == "success":
                     alert_placeholder.success("File uploaded successfully!")
                 elif info == "duplicate":
@@ -522,23 +718,38 @@ def temporary_chat():
                 time.sleep(1)
                 alert_placeholder.empty()
                 st.rerun()
+        if temp_index:
+            with st.expander("💾 Save as a chapter"):
+                subjects = get_subjects(st.session_state.sha1_of_username)
+                subject = st.selectbox("Subject", subjects, key="promote_subject") if subjects else \
+                    st.text_input("New subject", key="promote_subject")
+                chapter = st.text_input("Chapter name", key="promote_chapter")
+                if st.button("Save", disabled=not (subject and chapter), key="promote_temp_chat"):
+                    with st.spinner("Saving chapter..."):
+                        info = promote_temp_chat(temp_chat_id, st.session_state.sha1_of_username, subject, chapter)
+                    if info == "success":
+                        st.success(f"Saved as {subject} - {chapter}.")
+                    elif info == "exists":
+                        st.warning(f"{subject} already has a chapter named {chapter}.")
+                    else:
+                        st.error("Could not save the chapter! Error: " + info[1])
     with col2:
         chat_container = st.container(width=900, height=620, border=True)
-        # print(st.session_state.vector_store_exists)
-        if st.session_state.vector_store_exists:
-            vector_store = load_vector_store(st.session_state.sha1_of_username, "Temporary", "Temporary Chat")
-            # print("Vector store loaded")
-        else:
-            vector_store = None
-        # print(vector_store)
+        vector_store = temp_index["vector_store"] if temp_index else None
+
+        def get_passage(citation):
+            return get_temp_source_passage(temp_chat_id, citation)
+
         with chat_container:
             conv_container = st.container(width=900, height=520, border=False)
             with conv_container:
-                for message in st.session_state.temp_chat_messages:
+                for i, message in enumerate(st.session_state.temp_chat_messages):
                     if message["role"] == "user":
                         st.chat_message("user").markdown(message["content"])
                     else:
-                        st.chat_message("assistant").markdown(message["content"])
+                        with st.chat_message("assistant"):
+                            st.markdown(message["content"])
+                            show_citations(message.get("citations"), "Temporary", "Temporary Chat", f"temp_{i}", get_passage)
 
             query = st.chat_input("Ask anything...")
 
@@ -549,13 +760,61 @@ def temporary_chat():
                         st.chat_message("user").markdown(prompt)
 
                         with st.spinner("AI is typing..."):
-                            response = get_chat_response(prompt, vector_store)
-                            st.session_state.temp_chat_messages.append({"role": "assistant", "content": response})
-                            st.chat_message("assistant").markdown(response)
+                            response, citations = get_chat_response(prompt, vector_store, st.session_state.temp_chat_memory)
+                            st.session_state.temp_chat_messages.append({"role": "assistant", "content": response, "citations": citations})
+                            with st.chat_message("assistant"):
+                                st.markdown(response)
+                                show_citations(citations, "Temporary", "Temporary Chat",
+                                               f"temp_{len(st.session_state.temp_chat_messages) - 1}", get_passage)
+                            st.session_state.temp_chat_memory = update_chat_memory(st.session_state.temp_chat_memory, prompt, response)
 
 
 # ================ Chat with AI Functionality =================
+CHAT_HISTORY_PAGE_SIZE = 50
+HISTORY_SEARCH_PAGE_SIZE = 10
+HISTORY_SEARCH_KINDS = {"Chat messages": "chat", "Flashcards": "flashcard", "Quiz & exam answers": "quiz"}
+
+def search_study_history():
+    """Ranked search over past chat messages, flashcards and quiz answers, one page at a time."""
+    with st.expander("🔎 Search your history"):
+        text = st.text_input("Search", key="history_search_text", placeholder="e.g. photosynthesis",
+                             label_visibility="collapsed")
+        labels = st.multiselect("In", list(HISTORY_SEARCH_KINDS), default=list(HISTORY_SEARCH_KINDS),
+                                key="history_search_kinds")
+        if (text, labels) != st.session_state.history_search_last:
+            st.session_state.history_search_last = (text, labels)
+            st.session_state.history_search_page = 0
+        if CHAT_RETENTION_DAYS > 0 and "chat" in (HISTORY_SEARCH_KINDS[label] for label in labels):
+            st.caption(f"Chat messages older than {CHAT_RETENTION_DAYS:g} days are archived and not searched.")
+        if not text.strip():
+            return
+        page = st.session_state.history_search_page
+        results = search_history(st.session_state.sha1_of_username, text, [HISTORY_SEARCH_KINDS[label] for label in labels],
+                                 limit=HISTORY_SEARCH_PAGE_SIZE + 1, offset=page * HISTORY_SEARCH_PAGE_SIZE)
+        if not results:
+            st.caption("No matches.")
+            return
+        for result in results[:HISTORY_SEARCH_PAGE_SIZE]:
+            if result["kind"] == "chat":
+                origin = f"💬 {result['role']} · {result['timestamp']}"
+            elif result["kind"] == "flashcard":
+                origin = f"🃏 flashcard · {result['subject']} / {result['chapter']}"
+            else:
+                origin = f"📝 {result['role']} answer · {result['subject']} / {result['chapter']}"
+            st.caption(origin)
+            st.markdown(f"**Q:** {result['title']}\n\n{result['snippet']}" if result["title"] else result["snippet"])
+        previous_column, next_column = st.columns(2)
+        with previous_column:
+            if page > 0 and st.button("← Previous", key="history_search_previous"):
+                st.session_state.history_search_page -= 1
+                st.rerun()
+        with next_column:
+            if len(results) > HISTORY_SEARCH_PAGE_SIZE and st.button("Next →", key="history_search_next"):
+                st.session_state.history_search_page += 1
+                st.rerun()
+
 def chat_with_AI():
+    from ai_features import get_chat_response_general
     st.header("🧠 Chat with AI")
     
     
@@ -563,9 +822,14 @@ def chat_with_AI():
         st.session_state.app_layout = "centered"
         st.rerun()
     
-    st.session_state.chat_history = get_chat_history(st.session_state.sha1_of_username)
+    search_study_history()
+    transcript = get_chat_transcript(st.session_state.sha1_of_username, st.session_state.chat_history_limit)
+    st.session_state.chat_history = transcript["messages"]
     conv_container = st.container(width=900, height=530, border=True)
     with conv_container:
+        if transcript["has_more"] and st.button("⬆️ Load earlier messages", key="load_earlier_chat"):
+            st.session_state.chat_history_limit += CHAT_HISTORY_PAGE_SIZE
+            st.rerun()
         if st.session_state.chat_history:
             for message in st.session_state.chat_history:
                 with st.chat_message(message["role"]):
@@ -648,6 +912,9 @@ def logout(setting_default_function):
     if st.button("🚪 Logout", use_container_width=True, key="logout"):
         # Reset all session state variables to defaults
         delete_temporary_chat(st.session_state.sha1_of_username)
+        if "ai_features" in sys.modules:
+            # Only loaded once a chapter or the temporary chat was opened; otherwise there is no index to drop
+            sys.modules["ai_features"].drop_temp_index(st.session_state.temp_chat_id)
         for key in list(st.session_state.keys()):
             del st.session_state[key]
             
@@ -656,6 +923,51 @@ def logout(setting_default_function):
 
 
 
+# ================ Telemetry Debug Panel =================
+TELEMETRY_TRACES_KEPT = 5
+
+def start_telemetry_trace():
+    """Starts tracing this run. The trace list is kept in the session, so runs cut short by st.rerun() still show up."""
+    trace = telemetry.start_trace()
+    if trace is not None:
+        traces = st.session_state.setdefault("telemetry_traces", [])
+        traces.append(trace)
+        del traces[:-TELEMETRY_TRACES_KEPT]
+
+def telemetry_debug_panel():
+    """Shows the timed stages of recent runs of this session and the process counters."""
+    if not telemetry.is_enabled():
+        return
+    with st.expander("⏱️ Debug: timings"):
+        for i, trace in enumerate(reversed([t for t in st.session_state.get("telemetry_traces", []) if t])):
+            st.caption("Current run" if i == 0 else f"{i} run(s) ago")
+            st.dataframe(
+                [{"stage": "· " * row["depth"] + row["span"], "ms": row["ms"],
+                  "details": ", ".join(f"{k}={v}" for k, v in row.items() if k not in ("span", "ms", "depth"))}
+                 for row in trace],
+                hide_index=True, use_container_width=True,
+            )
+        llm_stats = get_llm_task_stats()
+        if llm_stats:
+            st.caption("LLM usage by task (feeds the model routing)")
+            st.dataframe(
+                [{"task": row["task"], "profile": row["profile"], "model": f'{row["provider"]}/{row["model"]}',
+                  "calls": row["calls"], "mean s": round(row["mean_seconds"], 2), "recent s": round(row["recent_seconds"], 2),
+                  "error rate": round(row["error_rate"], 3), "USD / call": round(row["cost_per_call"], 6)}
+                 for row in llm_stats],
+                hide_index=True, use_container_width=True,
+            )
+        counters = telemetry.snapshot()["counters"]
+        if counters:
+            st.caption("Process counters")
+            st.dataframe(
+                [{"counter": name, "labels": ", ".join(f"{k}={v}" for k, v in labels), "value": value}
+                 for (name, labels), value in sorted(counters.items())],
+                hide_index=True, use_container_width=True,
+            )
+
+
+
 # ===== Setting defaults =====
 def setting_defaults():
     st.session_state.setdefault('selected_subject', None)
@@ -694,6 +1006,11 @@ def setting_defaults():
 
     # Temporary Chat
     st.session_state.setdefault("temp_chat_messages", [])
+    st.session_state.setdefault("temp_chat_memory", {"summary": "", "turns": [], "pending": []})
+    st.session_state.setdefault("temp_chat_id", uuid.uuid4().hex)
+
+    # Quiz, exam, flashcard and mind map generation requests, see next_generation_attempt()
+    st.session_state.setdefault("generation_attempt", 0)
 
     # Quiz
     def quiz_session_variables():
@@ -716,6 +1033,7 @@ def setting_defaults():
         st.session_state.setdefault("flashcard_flashcards", [])
         st.session_state.setdefault("flashcard_show_answer", False)
         st.session_state.setdefault("flashcard_start_time", None)
+        st.session_state.setdefault("flashcard_top_up_note", None)
     flashcard_session_variables()
 
     # Chapter exam
@@ -734,12 +1052,10 @@ def setting_defaults():
         st.session_state.setdefault("exam_evaluated", False)
     exam_session_variables()
 
-    # Mindmap
-    def mindmap_session_variables():
-        st.session_state.setdefault("mindmap_content", None)
-    mindmap_session_variables()
-
     # general chat
     def general_chat_session_variables():
         st.session_state.setdefault("general_chat_history", [])
+        st.session_state.setdefault("chat_history_limit", CHAT_HISTORY_PAGE_SIZE)
+        st.session_state.setdefault("history_search_page", 0)
+        st.session_state.setdefault("history_search_last", None)
     general_chat_session_variables()
@@ -0,0 +1,462 @@
+"""
+Provider backends for the chat model and the embeddings used by ai_features.
+
+    google  Gemini through langchain_google_genai (the production default)
+    fake    deterministic in-process model and hash embeddings, no network
+    local   HTTP client for the stand-in server below (python providers.py serve)
+
+The fake and local backends exist so indexing, chat and the generators can be
+benchmarked and load tested offline. LocalEmbeddings is a real, CPU-only embedding
+model for chapters that should be indexed without any API calls.
+"""
+import re
+import json
+import math
+import time
+import inspect
+import hashlib
+import argparse
+import functools
+import threading
+import urllib.request
+import numpy as np
+from typing import Any, Iterator, List, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pydantic import SecretStr
+from langchain_core.embeddings import Embeddings
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.language_models.chat_models import BaseChatModel
+
+PROVIDERS = ("google", "fake", "local")
+DEFAULT_LOCAL_PROVIDER_URL = "http://127.0.0.1:8765"
+HASH_EMBEDDING_SIZE = 256
+TOKEN_PATTERN = re.compile(r"\w+")
+LOCAL_EMBEDDING_KINDS = ("hashing", "tfidf")
+LOCAL_HASHING_DIMENSIONS = 512     # vector size of the "hashing" embeddings
+LOCAL_TFIDF_FEATURES = 2**14       # hashed vocabulary size of the "tfidf" model
+LOCAL_TFIDF_DIMENSIONS = 256       # SVD components kept by the "tfidf" model
+LOCAL_BLOCK_NONZEROS = 2**16       # nonzero terms per block of the sparse products, bounds memory
+
+
+# ================= Fake responses =================
+def _stable_int(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+def _key_terms(text: str, limit: int):
+    """Most frequent longer words of text, in first-seen order, for plausible fake content."""
+    counts = {}
+    for word in TOKEN_PATTERN.findall(text.lower()):
+        if len(word) > 4 and not word.isdigit():
+            counts[word] = counts.get(word, 0) + 1
+    ranked = sorted(counts, key=lambda w: -counts[w])[:limit]
+    return ranked or [f"topic{i}" for i in range(limit)]
+
+def fake_completion(prompt: str) -> str:
+    """
+    Returns a deterministic, well-formed answer for each kind of prompt the app sends,
+    so the JSON / Mermaid / float parsing paths behave as they do with a real model.
+    """
+    seed = _stable_int(prompt)
+    context = prompt.rsplit("Context", 1)[-1]
+
+    if "expert exam evaluator" in prompt:
+        marks = float(re.findall(r"Marks:\s*([\d.]+)", prompt)[-1])
+        return str(round(marks * (seed % 5) / 4 * 2) / 2)
+
+    match = re.search(r"generate (\d+) multiple-choice", prompt)
+    if match:
+        terms = _key_terms(context, 4 * int(match.group(1)) + 4)
+        return json.dumps([{
+            "question": f"Which term is most closely related to {terms[i % len(terms)]}?",
+            "options": [terms[(i + j) % len(terms)] for j in range(4)],
+            "correct_option": terms[i % len(terms)],
+            "topic": terms[i % 3].capitalize(),
+        } for i in range(int(match.group(1)))])
+
+    match = re.search(r"generate (\d+) flashcards", prompt)
+    if match:
+        terms = _key_terms(context, int(match.group(1)))
+        return json.dumps([{"question": f"What is {term}?", "answer": f"{term.capitalize()} is a key idea of this chapter."}
+                           for term in (terms * int(match.group(1)))[:int(match.group(1))]])
+
+    match = re.search(r"generate (\d+) subjective questions with total marks of (\d+)", prompt)
+    if match:
+        count, total = int(match.group(1)), int(match.group(2))
+        terms = _key_terms(context, count)
+        return json.dumps([{"question": f"Explain {term}.", "answer": f"{term.capitalize()} is explained in the material.",
+                            "score": round(total / count, 2), "topic": term.capitalize()} for term in (terms * count)[:count]])
+
+    if "mind map" in prompt:
+        terms = _key_terms(context, 12)
+        lines = ["mindmap", f"  root(({terms[0].capitalize()}))"]
+        for i in range(1, len(terms), 3):
+            lines.append(f"    ({terms[i].capitalize()})")
+            lines.extend(f"      ({term})" for term in terms[i + 1:i + 3])
+        return "\n".join(lines)
+
+    terms = _key_terms(prompt, 5)
+    return f"Answer {seed % 10000}: this relates to {', '.join(terms)}."
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic chat model with configurable latency, for benchmarks and load tests."""
+
+    latency: float = 0.0
+    token_latency: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-study-coach"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        self.calls += 1
+        content = fake_completion("\n".join(str(m.content) for m in messages))
+        time.sleep(self.latency + self.token_latency * len(content.split()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        self.calls += 1
+        content = fake_completion("\n".join(str(m.content) for m in messages))
+        time.sleep(self.latency)
+        for token in re.split(r"(\s+)", content):
+            if token:
+                time.sleep(self.token_latency if token.strip() else 0)
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+                if run_manager:
+                    run_manager.on_llm_new_token(token, chunk=chunk)
+                yield chunk
+
+
+class HashEmbeddings(Embeddings):
+    """Feature-hashed bag-of-words embeddings: deterministic and similar for similar texts."""
+
+    def __init__(self, size: int = HASH_EMBEDDING_SIZE, latency: float = 0.0):
+        self.size = size
+        self.latency = latency
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.size
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            h = _stable_int(token)
+            vector[h % self.size] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+
+# ================= Local CPU embeddings =================
+def _row_ids(indptr):
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+def _row_blocks(indptr):
+    """Splits the rows of a CSR matrix into (start, end) blocks of about LOCAL_BLOCK_NONZEROS nonzeros."""
+    start = 0
+    while start < len(indptr) - 1:
+        end = max(start + 1, int(np.searchsorted(indptr, indptr[start] + LOCAL_BLOCK_NONZEROS, side="right")) - 1)
+        end = min(end, len(indptr) - 1)
+        yield start, end
+        start = end
+
+def _sparse_dot(indptr, columns, values, dense):
+    """Product of a CSR matrix (indptr, columns, values) with a dense matrix."""
+    out = np.zeros((len(indptr) - 1, dense.shape[1]), dtype=np.float32)
+    for start, end in _row_blocks(indptr):
+        low, high = indptr[start], indptr[end]
+        if low == high:
+            continue
+        products = values[low:high, None] * dense[columns[low:high]]
+        row_starts = indptr[start:end] - low
+        nonempty = np.diff(indptr[start:end + 1]) > 0
+        out[start:end][nonempty] = np.add.reduceat(products, row_starts[nonempty], axis=0)
+    return out
+
+def _sparse_transpose_dot(indptr, columns, values, dense, num_columns):
+    """Product of the transpose of a CSR matrix with a dense matrix that has one row per CSR row."""
+    out = np.zeros((num_columns, dense.shape[1]), dtype=np.float32)
+    rows = _row_ids(indptr)
+    for start, end in _row_blocks(indptr):
+        low, high = indptr[start], indptr[end]
+        if low == high:
+            continue
+        order = low + np.argsort(columns[low:high], kind="stable")
+        unique, starts = np.unique(columns[order], return_index=True)
+        out[unique] += np.add.reduceat(values[order, None] * dense[rows[order]], starts, axis=0)
+    return out
+
+def _normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    CPU embeddings computed with NumPy, without any network call.
+
+    "hashing" embeds feature-hashed, sublinear term counts directly. It needs no fitting,
+    so every chapter indexed with it shares one vector space. "tfidf" weights hashed terms
+    by their inverse document frequency and projects them onto the top SVD components
+    learned by fit() (latent semantic analysis), so related words end up close together;
+    it is fitted per subject and saved with save(). Vectors are L2-normalized, so the
+    FAISS L2 distance ranks them like cosine similarity.
+    """
+
+    def __init__(self, kind: str = "hashing", features: Optional[int] = None, dimensions: Optional[int] = None):
+        if kind not in LOCAL_EMBEDDING_KINDS:
+            raise ValueError(f"Unknown local embedding kind '{kind}'. Expected one of {LOCAL_EMBEDDING_KINDS}.")
+        self.kind = kind
+        self.features = features or (LOCAL_HASHING_DIMENSIONS if kind == "hashing" else LOCAL_TFIDF_FEATURES)
+        self.dimensions = dimensions or (self.features if kind == "hashing" else LOCAL_TFIDF_DIMENSIONS)
+        self.idf = None
+        self.projection = None
+        # token -> signed column, so each distinct token is hashed once per process
+        self._columns = {}
+
+    def _term_matrix(self, texts: List[str]):
+        """Hashed, sublinear (1 + log) term counts of texts as CSR arrays (indptr, columns, values)."""
+        indptr, columns, values = [0], [], []
+        signed = self.kind == "hashing"
+        for text in texts:
+            counts = {}
+            for token in TOKEN_PATTERN.findall(text.lower()):
+                column = self._columns.get(token)
+                if column is None:
+                    h = _stable_int(token)
+                    # A random sign per token keeps hash collisions from adding up (hashing only,
+                    # since document frequencies need non-negative counts)
+                    column = self._columns[token] = (h % self.features) * (-1 if signed and (h >> 32) & 1 else 1)
+                counts[column] = counts.get(column, 0) + 1
+            columns.extend(counts)
+            values.extend(counts.values())
+            indptr.append(len(columns))
+        columns = np.array(columns, dtype=np.int64)
+        values = 1.0 + np.log(np.array(values, dtype=np.float32))
+        values[columns < 0] *= -1
+        return np.array(indptr, dtype=np.int64), np.abs(columns), values
+
+    def fit(self, texts: List[str], power_iterations: int = 2, seed: int = 0):
+        """Learns the idf weights and the SVD projection of a "tfidf" model from texts. Returns self."""
+        if self.kind != "tfidf":
+            raise ValueError("Only 'tfidf' embeddings are fitted.")
+        if not texts:
+            raise ValueError("There is no text to fit the 'tfidf' embeddings on.")
+        indptr, columns, values = self._term_matrix(texts)
+        num_texts = len(texts)
+        document_frequency = np.bincount(columns, minlength=self.features)
+        self.idf = (np.log((1 + num_texts) / (1 + document_frequency)) + 1).astype(np.float32)
+        values = values * self.idf[columns]
+        # Unit-length rows, so long chunks do not dominate the components
+        row_norms = np.sqrt(np.bincount(_row_ids(indptr), weights=values ** 2, minlength=num_texts))
+        row_norms[row_norms == 0] = 1.0
+        values = (values / row_norms[_row_ids(indptr)]).astype(np.float32)
+
+        # Randomized truncated SVD (Halko et al.): find the range of the matrix with a few
+        # sparse products, then take the exact SVD of its small projection
+        dimensions = max(1, min(self.dimensions, num_texts, self.features))
+        oversampled = min(dimensions + 10, self.features)
+        rng = np.random.default_rng(seed)
+        basis = _sparse_dot(indptr, columns, values, rng.standard_normal((self.features, oversampled)).astype(np.float32))
+        for _ in range(power_iterations):
+            basis, _ = np.linalg.qr(basis)
+            basis = _sparse_dot(indptr, columns, values,
+                                _sparse_transpose_dot(indptr, columns, values, basis, self.features))
+        basis, _ = np.linalg.qr(basis)
+        # The right singular vectors of basis.T @ matrix, from the eigenvectors of its small Gram matrix
+        projected = _sparse_transpose_dot(indptr, columns, values, basis, self.features)
+        eigenvalues, eigenvectors = np.linalg.eigh(projected.T @ projected)
+        order = np.argsort(eigenvalues)[::-1][:dimensions]
+        order = order[eigenvalues[order] > eigenvalues.max() * 1e-10]
+        if not len(order):
+            raise ValueError("The texts have no terms to fit the 'tfidf' embeddings on.")
+        self.projection = np.ascontiguousarray(
+            projected @ (eigenvectors[:, order] / np.sqrt(eigenvalues[order])), dtype=np.float32)
+        dimensions = len(order)
+        self.dimensions = dimensions
+        return self
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embeds texts as a float32 matrix with one unit-length row per text."""
+        indptr, columns, values = self._term_matrix(texts)
+        if self.kind == "hashing":
+            vectors = np.zeros((len(texts), self.features), dtype=np.float32)
+            np.add.at(vectors, (_row_ids(indptr), columns), values)
+        else:
+            if self.projection is None:
+                raise ValueError("The 'tfidf' embeddings must be fitted or loaded before use.")
+            vectors = _sparse_dot(indptr, columns, values * self.idf[columns], self.projection)
+        return _normalize_rows(vectors)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed([text])[0].tolist()
+
+    def save(self, path: str):
+        """Writes the model to a .npz file."""
+        with open(path, "wb") as f:
+            np.savez(f, kind=np.array(self.kind), features=self.features, dimensions=self.dimensions,
+                     idf=self.idf if self.idf is not None else np.zeros(0, dtype=np.float32),
+                     projection=self.projection if self.projection is not None else np.zeros((0, 0), dtype=np.float32))
+
+    @classmethod
+    def load(cls, path: str):
+        """Reads a model written by save()."""
+        with np.load(path, allow_pickle=False) as data:
+            embeddings = cls(str(data["kind"]), int(data["features"]), int(data["dimensions"]))
+            if data["idf"].size:
+                embeddings.idf = data["idf"]
+                embeddings.projection = data["projection"]
+        return embeddings
+
+
+# ================= Local HTTP stand-in =================
+def _post_json(url: str, payload: dict, timeout: float):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+class LocalHTTPChatModel(BaseChatModel):
+    """Chat model served by the local stand-in server over HTTP."""
+
+    base_url: str = DEFAULT_LOCAL_PROVIDER_URL
+    timeout: float = 60.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "local-http"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        prompt = "\n".join(str(m.content) for m in messages)
+        result = _post_json(f"{self.base_url}/v1/chat", {"prompt": prompt}, self.timeout)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=result["content"]))])
+
+
+class LocalHTTPEmbeddings(Embeddings):
+    """Embeddings served by the local stand-in server over HTTP."""
+
+    def __init__(self, base_url: str = DEFAULT_LOCAL_PROVIDER_URL, timeout: float = 60.0):
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return _post_json(f"{self.base_url}/v1/embeddings", {"texts": texts}, self.timeout)["embeddings"]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def start_local_provider_server(host: str = "127.0.0.1", port: int = 8765, latency: float = 0.0,
+                                token_latency: float = 0.0, embedding_latency: float = 0.0):
+    """Starts the stand-in server on a daemon thread and returns it (call .shutdown() to stop)."""
+    chat_model = FakeChatModel(latency=latency, token_latency=token_latency)
+    embeddings = HashEmbeddings(latency=embedding_latency)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if self.path == "/v1/chat":
+                body = {"content": chat_model.invoke(payload["prompt"]).content}
+            elif self.path == "/v1/embeddings":
+                body = {"embeddings": embeddings.embed_documents(payload["texts"])}
+            else:
+                self.send_error(404)
+                return
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ================= Factories =================
+def create_chat_model(provider: str, model: str, temperature: float, google_api_key: Optional[str] = None,
+                      local_url: str = DEFAULT_LOCAL_PROVIDER_URL, fake_latency: float = 0.0,
+                      fake_token_latency: float = 0.0, max_tokens: Optional[int] = None,
+                      timeout: Optional[float] = None):
+    """Creates the chat model of a provider. max_tokens and timeout are left to the provider when None."""
+    if provider == "google":
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        if not google_api_key:
+            raise ValueError("GOOGLE_API_KEY environment variable is missing.")
+        return ChatGoogleGenerativeAI(model=model, temperature=temperature, google_api_key=SecretStr(google_api_key),
+                                      max_output_tokens=max_tokens, timeout=timeout)
+    if provider == "fake":
+        return FakeChatModel(latency=fake_latency, token_latency=fake_token_latency)
+    if provider == "local":
+        return LocalHTTPChatModel(base_url=local_url, timeout=timeout or 60.0)
+    raise ValueError(f"Unknown AI provider '{provider}'. Expected one of {PROVIDERS}.")
+
+def create_embeddings(provider: str, model: str, google_api_key: Optional[str] = None,
+                      local_url: str = DEFAULT_LOCAL_PROVIDER_URL, fake_latency: float = 0.0):
+    """Creates the embeddings of a provider."""
+    if provider == "google":
+        from langchain_google_genai import GoogleGenerativeAIEmbeddings
+        if not google_api_key:
+            raise ValueError("GOOGLE_API_KEY environment variable not set.")
+        return GoogleGenerativeAIEmbeddings(model=model, google_api_key=SecretStr(google_api_key))
+    if provider == "fake":
+        return HashEmbeddings(latency=fake_latency)
+    if provider == "local":
+        return LocalHTTPEmbeddings(base_url=local_url)
+    raise ValueError(f"Unknown AI provider '{provider}'. Expected one of {PROVIDERS}.")
+
+def embed_queries(embeddings: Embeddings, queries: List[str]) -> List[List[float]]:
+    """
+    Embeds several search queries with one call. Gemini embeds queries with a task type of
+    their own, every other backend embeds a query exactly like a document.
+    """
+    if _embeds_with_task_type(type(embeddings)):
+        return embeddings.embed_documents(queries, task_type=getattr(embeddings, "task_type", None) or "RETRIEVAL_QUERY")
+    return embeddings.embed_documents(queries)
+
+@functools.lru_cache(maxsize=None)
+def _embeds_with_task_type(embeddings_class) -> bool:
+    """Whether embed_documents of an embeddings class takes a task_type (Gemini's does)."""
+    return "task_type" in inspect.signature(embeddings_class.embed_documents).parameters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the local HTTP stand-in for the model provider.")
+    parser.add_argument("command", choices=["serve"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every chat call.")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds added per generated word.")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Seconds added to every embedding call.")
+    args = parser.parse_args()
+
+    server = start_local_provider_server(args.host, args.port, args.latency, args.token_latency, args.embedding_latency)
+    print(f"Local provider listening on http://{args.host}:{args.port} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+Retrieval service shared by all Streamlit worker processes.
+
+    python retrieval_service.py serve [--socket .cache/retrieval.sock | --port 8766]
+
+One asyncio process owns the chapter FAISS indexes: it loads each published index
+version once, keeps the most recently used ones in memory and answers similarity
+searches and chunk lookups for every app worker. A search starts at once while
+fewer than RETRIEVAL_WORKERS batches are running; searches arriving meanwhile queue
+up and go together in the next batch, embedded with one embeddings call and scored
+with one FAISS search per index. Run it from the app directory, with the same
+settings (AI_PROVIDER, GOOGLE_API_KEY, ...) as the app.
+
+The app uses it when RETRIEVAL_SERVICE is set to the same address ("unix:<path>" or
+"<host>:<port>"); ai_features loads indexes in-process when it is unset or the
+service cannot be reached. The protocol is one JSON object per line in each direction:
+{"id", "op", ...} answered by {"id", "result"} or {"id", "error"}.
+"""
+import os
+import json
+import time
+import socket
+import asyncio
+import argparse
+import threading
+from types import SimpleNamespace
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_RETRIEVAL_SOCKET = os.path.join(".cache", "retrieval.sock")
+RETRIEVAL_MAX_INDEXES = int(os.getenv("RETRIEVAL_MAX_INDEXES", "64"))
+RETRIEVAL_BATCH_MAX = 64
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "8"))
+RETRIEVAL_MAX_LINE_BYTES = 16 * 2**20
+RETRIEVAL_CLIENT_TIMEOUT = 30.0
+# After a failed call the client goes straight to the in-process fallback for this long
+RETRIEVAL_RETRY_SECONDS = 30.0
+
+
+class RetrievalServiceError(Exception):
+    """The service answered a request with an error."""
+
+
+def parse_address(address: str):
+    """Returns ("unix", path) or ("tcp", (host, port)) for "unix:<path>" or "<host>:<port>"."""
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return "tcp", (host or "127.0.0.1", int(port))
+
+def _document_to_json(doc):
+    return {"page_content": doc.page_content, "metadata": doc.metadata}
+
+def _peak_rss_bytes():
+    """Peak resident memory of this process, or None where the resource module is missing (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# ================= Service =================
+class RetrievalService:
+    """Loads, caches and searches chapter indexes for any number of connected clients."""
+
+    def __init__(self, max_indexes: int = RETRIEVAL_MAX_INDEXES):
+        self.max_indexes = max_indexes
+        self._stores = OrderedDict()   # (user, subject, chapter, version) -> FAISS store, least recently used first
+        self._loading = {}             # key -> asyncio.Future of a load in progress
+        self._pending = []             # searches waiting for the next batch
+        self._running = 0              # batches in flight
+        self.startup_rss_bytes = 0
+        self._executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+        self.stats = {"loads": 0, "evictions": 0, "searches": 0, "batches": 0, "embedding_calls": 0, "lookups": 0}
+
+    async def get_store(self, key):
+        """Returns the store of an index version, loading it once however many requests ask for it."""
+        key = tuple(key)
+        if key in self._stores:
+            self._stores.move_to_end(key)
+            return self._stores[key]
+        if key not in self._loading:
+            self._loading[key] = asyncio.ensure_future(self._load(key))
+        return await asyncio.shield(self._loading[key])
+
+    async def _load(self, key):
+        from ai_features import read_vector_store_version
+        try:
+            store = await asyncio.get_running_loop().run_in_executor(self._executor, read_vector_store_version, *key)
+        finally:
+            del self._loading[key]
+        if store is None:
+            return None
+        self.stats["loads"] += 1
+        self._stores[key] = store
+        while len(self._stores) > self.max_indexes:
+            self._stores.popitem(last=False)
+            self.stats["evictions"] += 1
+        return store
+
+    async def search(self, key, query, k, source=None):
+        """
+        Queues a similarity search for the next batch and returns [(document, distance)].
+        A search runs at once while fewer than RETRIEVAL_WORKERS batches are in flight, so
+        nothing waits on a collection window; searches only batch up above that concurrency.
+        """
+        store = await self.get_store(key)
+        if store is None:
+            raise RetrievalServiceError("index not found")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((store, query, k, source, future))
+        self.stats["searches"] += 1
+        if self._running < RETRIEVAL_WORKERS or len(self._pending) >= RETRIEVAL_BATCH_MAX:
+            self._flush()
+        return await future
+
+    def _flush(self):
+        batch, self._pending = self._pending, []
+        if batch:
+            self.stats["batches"] += 1
+            self._running += 1
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        try:
+            await self._search_groups(batch)
+        finally:
+            # Searches queued while this batch ran go next, together
+            self._running -= 1
+            self._flush()
+
+    async def _search_groups(self, batch):
+        loop = asyncio.get_running_loop()
+        # Stores built with the same embeddings (one cached instance per kind) share one embeddings call
+        by_embeddings = OrderedDict()
+        for item in batch:
+            by_embeddings.setdefault(id(item[0].embedding_function), []).append(item)
+        for items in by_embeddings.values():
+            try:
+                results = await loop.run_in_executor(self._executor, self._search_batch, items)
+                self.stats["embedding_calls"] += 1
+            except Exception as e:
+                for *_, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (*_, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+
+    @staticmethod
+    def _search_batch(items):
+        """Embeds the queries of items at once, then runs one FAISS search per store. Runs on a worker thread."""
+        import numpy as np
+        from providers import embed_queries
+        vectors = np.asarray(embed_queries(items[0][0].embedding_function, [query for _, query, *_ in items]),
+                             dtype=np.float32)
+        results = [None] * len(items)
+        by_store = OrderedDict()
+        for position, (store, _, k, source, _) in enumerate(items):
+            if source is None:
+                by_store.setdefault(id(store), []).append(position)
+            else:
+                # Filtered searches score every vector of the flat index, as in ai_features.scored_search
+                results[position] = store.similarity_search_with_score_by_vector(
+                    vectors[position].tolist(), k=k, filter={"source": source}, fetch_k=store.index.ntotal)
+        for positions in by_store.values():
+            store = items[positions[0]][0]
+            matrix = vectors[positions]
+            if store._normalize_L2:
+                import faiss
+                faiss.normalize_L2(matrix)
+            distances, indices = store.index.search(matrix, max(items[position][2] for position in positions))
+            for row, position in enumerate(positions):
+                k = items[position][2]
+                results[position] = [(store.docstore.search(store.index_to_docstore_id[int(i)]), float(distance))
+                                     for i, distance in zip(indices[row][:k], distances[row][:k]) if i != -1]
+        return results
+
+    async def handle(self, request):
+        """Answers one request dict; the result has to be JSON serializable."""
+        op = request["op"]
+        if op == "open":
+            store = await self.get_store(request["key"])
+            return {"found": store is not None, "ntotal": store.index.ntotal if store is not None else 0}
+        if op == "search":
+            results = await self.search(request["key"], request["query"], request["k"], request.get("source"))
+            return [[_document_to_json(doc), float(distance)] for doc, distance in results]
+        if op == "documents":
+            store = await self.get_store(request["key"])
+            if store is None:
+                raise RetrievalServiceError("index not found")
+            self.stats["lookups"] += len(request["chunk_ids"])
+            return [_document_to_json(store.docstore.search(store.index_to_docstore_id[chunk_id]))
+                    for chunk_id in request["chunk_ids"]]
+        if op == "stats":
+            return {**self.stats, "indexes": len(self._stores), "startup_rss_bytes": self.startup_rss_bytes,
+                    "peak_rss_bytes": _peak_rss_bytes()}
+        raise RetrievalServiceError(f"unknown op {op!r}")
+
+    async def serve_connection(self, reader, writer):
+        """Answers the requests of one client connection; requests are answered as they complete."""
+        write_lock = asyncio.Lock()
+
+        async def answer(request):
+            try:
+                response = json.dumps({"id": request.get("id"), "result": await self.handle(request)})
+            except Exception as e:
+                response = json.dumps({"id": request.get("id"), "error": f"{type(e).__name__}: {e}"})
+            async with write_lock:
+                writer.write(response.encode("utf-8") + b"\n")
+                await writer.drain()
+
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.ensure_future(answer(json.loads(line)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def start(self, address: str):
+        """Starts listening on address ("unix:<path>" or "<host>:<port>") and returns the asyncio server."""
+        import ai_features  # noqa: F401 -- imported up front, so the first request does not pay for it
+        self.startup_rss_bytes = _peak_rss_bytes()
+        kind, target = parse_address(address)
+        if kind == "unix":
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            if os.path.exists(target):
+                os.remove(target)
+            return await asyncio.start_unix_server(self.serve_connection, path=target, limit=RETRIEVAL_MAX_LINE_BYTES)
+        return await asyncio.start_server(self.serve_connection, *target, limit=RETRIEVAL_MAX_LINE_BYTES)
+
+
+# ================= Client =================
+class RetrievalClient:
+    """
+    Blocking client of the retrieval service. Each thread (one per Streamlit session run)
+    keeps its own connection, so concurrent sessions reach the service's batching together.
+    """
+
+    def __init__(self, address: str, timeout: float = RETRIEVAL_CLIENT_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self._local = threading.local()
+        self._down_until = 0.0
+
+    def available(self):
+        """False for a while after a call failed, so the app does not wait on a dead service."""
+        return time.monotonic() >= self._down_until
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            kind, target = parse_address(self.address)
+            sock = socket.socket(socket.AF_UNIX if kind == "unix" else socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(target)
+            connection = self._local.connection = (sock, sock.makefile("rb"))
+        return connection
+
+    def call(self, op: str, **params):
+        """Sends one request and waits for its answer. Raises OSError when the service is unreachable."""
+        try:
+            sock, reader = self._connection()
+            sock.sendall(json.dumps({"id": 0, "op": op, **params}).encode("utf-8") + b"\n")
+            line = reader.readline()
+            if not line:
+                raise ConnectionError("retrieval service closed the connection")
+        except OSError:
+            self._local.connection = None
+            self._down_until = time.monotonic() + RETRIEVAL_RETRY_SECONDS
+            raise
+        response = json.loads(line)
+        if "error" in response:
+            raise RetrievalServiceError(response["error"])
+        return response["result"]
+
+
+class _RemoteDocstore:
+    def __init__(self, store):
+        self._store = store
+
+    def search(self, chunk_id):
+        return self._store.get_documents([chunk_id])[0]
+
+
+class _IdentityMap:
+    """Stands in for index_to_docstore_id: the remote docstore is addressed by chunk id."""
+    def __getitem__(self, chunk_id):
+        return chunk_id
+
+
+class RemoteVectorStore:
+    """
+    The parts of a FAISS store that ai_features uses, answered by the retrieval service.
+    When a call fails or the service answers with an error, it switches to the in-process
+    store returned by fallback().
+    """
+
+    def __init__(self, client: RetrievalClient, key, ntotal: int, fallback):
+        self.client = client
+        self.key = list(key)
+        self.index = SimpleNamespace(ntotal=ntotal)
+        self.docstore = _RemoteDocstore(self)
+        self.index_to_docstore_id = _IdentityMap()
+        self._fallback = fallback
+        self._local_store = None
+
+    def _local(self):
+        if self._local_store is None:
+            self._local_store = self._fallback()
+        return self._local_store
+
+    def similarity_search_with_score(self, query, k=4, filter=None, fetch_k=None):
+        from langchain_core.documents import Document
+        if self._local_store is None and self.client.available():
+            try:
+                results = self.client.call("search", key=self.key, query=query, k=k,
+                                           source=(filter or {}).get("source"))
+                return [(Document(**doc), distance) for doc, distance in results]
+            except (OSError, RetrievalServiceError):
+                pass
+        return self._local().similarity_search_with_score(query, k=k, filter=filter, fetch_k=fetch_k or 20)
+
+    def get_documents(self, chunk_ids):
+        from langchain_core.documents import Document
+        if self._local_store is None and self.client.available():
+            try:
+                return [Document(**doc) for doc in self.client.call("documents", key=self.key, chunk_ids=list(chunk_ids))]
+            except (OSError, RetrievalServiceError):
+                pass
+        store = self._local()
+        return [store.docstore.search(store.index_to_docstore_id[chunk_id]) for chunk_id in chunk_ids]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the retrieval service shared by the app workers.")
+    parser.add_argument("command", choices=["serve"])
+    parser.add_argument("--socket", default=DEFAULT_RETRIEVAL_SOCKET, help="Unix socket path to listen on.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None, help="Listen on host:port instead of the Unix socket.")
+    parser.add_argument("--max-indexes", type=int, default=RETRIEVAL_MAX_INDEXES)
+    args = parser.parse_args()
+
+    address = f"{args.host}:{args.port}" if args.port else f"unix:{args.socket}"
+    service = RetrievalService(args.max_indexes)
+
+    async def run():
+        server = await service.start(address)
+        print(f"Retrieval service listening on {address} (Ctrl+C to stop)", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+// Pan and zoom for the rendered mind map SVG: wheel zooms around the pointer, dragging
+// pans, the +/−/⟲ buttons zoom around the centre and reset. Works on the SVG viewBox, so
+// the diagram stays vector-sharp at every zoom level.
+(function () {
+    var ZOOM_STEP = 1.2, MIN_ZOOM = 0.5, MAX_ZOOM = 12, DRAG_THRESHOLD = 3;
+
+    function mindmapPanZoom(svg) {
+        svg.style.maxWidth = "none";
+        if (!svg.getAttribute("viewBox")) {
+            var bounds = svg.getBBox();
+            svg.setAttribute("viewBox", [bounds.x, bounds.y, bounds.width, bounds.height].join(" "));
+        }
+        var box = svg.viewBox.baseVal;
+        var initial = {x: box.x, y: box.y, width: box.width, height: box.height};
+
+        // Maps a client point into viewBox coordinates (preserveAspectRatio xMidYMid meet)
+        function toDiagram(clientX, clientY) {
+            var rect = svg.getBoundingClientRect();
+            var scale = Math.max(box.width / rect.width, box.height / rect.height);
+            return {
+                x: box.x + box.width / 2 + (clientX - rect.left - rect.width / 2) * scale,
+                y: box.y + box.height / 2 + (clientY - rect.top - rect.height / 2) * scale,
+                scale: scale
+            };
+        }
+
+        function zoom(factor, clientX, clientY) {
+            var level = initial.width / (box.width / factor);
+            if (level < MIN_ZOOM || level > MAX_ZOOM) return;
+            var point = toDiagram(clientX, clientY);
+            box.x = point.x - (point.x - box.x) / factor;
+            box.y = point.y - (point.y - box.y) / factor;
+            box.width /= factor;
+            box.height /= factor;
+        }
+
+        function zoomCentre(factor) {
+            var rect = svg.getBoundingClientRect();
+            zoom(factor, rect.left + rect.width / 2, rect.top + rect.height / 2);
+        }
+
+        function reset() {
+            box.x = initial.x;
+            box.y = initial.y;
+            box.width = initial.width;
+            box.height = initial.height;
+        }
+
+        svg.addEventListener("wheel", function (event) {
+            event.preventDefault();
+            zoom(event.deltaY < 0 ? ZOOM_STEP : 1 / ZOOM_STEP, event.clientX, event.clientY);
+        }, {passive: false});
+
+        // Panning starts only once the pointer has moved, so clicks on node labels still work
+        var drag = null;
+        svg.addEventListener("pointerdown", function (event) {
+            drag = {x: event.clientX, y: event.clientY, id: event.pointerId, moving: false};
+        });
+        svg.addEventListener("pointermove", function (event) {
+            if (!drag) return;
+            var dx = event.clientX - drag.x, dy = event.clientY - drag.y;
+            if (!drag.moving) {
+                if (Math.abs(dx) < DRAG_THRESHOLD && Math.abs(dy) < DRAG_THRESHOLD) return;
+                drag.moving = true;
+                svg.setPointerCapture(drag.id);
+                svg.style.cursor = "grabbing";
+            }
+            var scale = toDiagram(event.clientX, event.clientY).scale;
+            box.x -= dx * scale;
+            box.y -= dy * scale;
+            drag.x = event.clientX;
+            drag.y = event.clientY;
+        });
+        function endDrag() {
+            if (drag && drag.moving) {
+                svg.releasePointerCapture(drag.id);
+                svg.style.cursor = "";
+            }
+            drag = null;
+        }
+        svg.addEventListener("pointerup", endDrag);
+        svg.addEventListener("pointercancel", endDrag);
+        svg.addEventListener("dblclick", reset);
+
+        var controls = document.createElement("div");
+        controls.style.cssText = "position:fixed;top:8px;right:8px;display:flex;gap:4px;z-index:10;";
+        [["+", function () { zoomCentre(ZOOM_STEP); }],
+         ["−", function () { zoomCentre(1 / ZOOM_STEP); }],
+         ["⟲", reset]].forEach(function (control) {
+            var button = document.createElement("button");
+            button.textContent = control[0];
+            button.style.cssText = "width:28px;height:28px;font-size:16px;cursor:pointer;";
+            button.addEventListener("click", control[1]);
+            controls.appendChild(button);
+        });
+        document.body.appendChild(controls);
+    }
+
+    window.mindmapPanZoom = mindmapPanZoom;
+})();
@@ -0,0 +1,237 @@
+"""
+Lightweight tracing and metrics for AI Study Coach.
+
+Spans time one stage (extraction, retrieval, an LLM call, a DB query, ...) and
+feed a latency histogram per span name. Counters track tokens and cache hits.
+Everything is exported as Prometheus text, to a file and/or a small HTTP
+endpoint, and the spans of the current Streamlit run feed the debug panel.
+
+Telemetry is off unless TELEMETRY_ENABLED=1. When off, span() returns a shared
+no-op object and nothing is recorded.
+
+    TELEMETRY_ENABLED=1          turn tracing on
+    TELEMETRY_METRICS_FILE=path  rewrite this Prometheus text file after each run
+    TELEMETRY_METRICS_PORT=9464  serve /metrics on localhost:9464
+"""
+import os
+import time
+import threading
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRIC_PREFIX = "study_coach"
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MAX_TRACE_SPANS = 500
+
+_enabled = False
+_configured = False
+_lock = threading.Lock()
+_histograms = {}   # (span name, labels) -> [bucket counts..., count, sum]
+_counters = {}     # (metric name, labels) -> value
+_local = threading.local()
+_metrics_server = None
+
+
+def is_enabled():
+    return _enabled
+
+def enable(flag=True):
+    """Turns recording on or off for the whole process."""
+    global _enabled
+    _enabled = flag
+
+def configure():
+    """Applies the TELEMETRY_* environment settings once per process."""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    enable(os.getenv("TELEMETRY_ENABLED", "0").lower() in ("1", "true", "yes"))
+    if _enabled and os.getenv("TELEMETRY_METRICS_PORT"):
+        start_metrics_server(int(os.getenv("TELEMETRY_METRICS_PORT")))
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+# ================= Spans =================
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("name", "attrs", "start", "depth")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.depth = getattr(_local, "depth", 0)
+        _local.depth = self.depth + 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _local.depth = self.depth
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        observe(self.name, duration)
+        trace = getattr(_local, "trace", None)
+        if trace is not None and len(trace) < MAX_TRACE_SPANS:
+            trace.append({"span": self.name, "ms": round(duration * 1000, 2), "depth": self.depth, **self.attrs})
+        return False
+
+    def set(self, **attrs):
+        """Adds attributes known only after the work is done (result sizes, cache hits, ...)."""
+        self.attrs.update(attrs)
+
+
+def span(name, **attrs):
+    """Times a block: `with span("similarity_search", k=8): ...`."""
+    if not _enabled:
+        return _NOOP_SPAN
+    return Span(name, attrs)
+
+def traced(name=None):
+    """Decorator form of span(); the span name defaults to the function name."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ================= Metrics =================
+def observe(name, seconds, **labels):
+    """Records one duration in the latency histogram of a span name."""
+    if not _enabled:
+        return
+    key = (name, _labels_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+        histogram[-2] += 1
+        histogram[-1] += seconds
+
+def count(name, value=1, **labels):
+    """Adds value to a counter, e.g. count("llm_prompt_tokens", 812, task="chat")."""
+    if not _enabled:
+        return
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def cache_request(cache, hit, **labels):
+    """Counts one lookup of a named cache, e.g. cache_request("text_chunks", hit=True, backend="redis")."""
+    count("cache_requests", cache=cache, result="hit" if hit else "miss", **labels)
+
+def snapshot():
+    """Returns copies of the counters and span summaries, for the debug panel and stats."""
+    with _lock:
+        counters = {(name, labels): value for (name, labels), value in _counters.items()}
+        spans = {(name, labels): {"count": h[-2], "sum": h[-1], "buckets": list(h[:len(LATENCY_BUCKETS)])}
+                 for (name, labels), h in _histograms.items()}
+    return {"counters": counters, "spans": spans}
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def render_prometheus():
+    """Renders all metrics in the Prometheus text exposition format."""
+    data = snapshot()
+    lines = [f"# TYPE {METRIC_PREFIX}_span_duration_seconds histogram"]
+    for (name, labels), summary in sorted(data["spans"].items()):
+        base = (("span", name),) + labels
+        for bound, bucket_count in zip(LATENCY_BUCKETS, summary["buckets"]):
+            lines.append(f"{METRIC_PREFIX}_span_duration_seconds_bucket{_format_labels(base + (('le', bound),))} {bucket_count}")
+        lines.append(f"{METRIC_PREFIX}_span_duration_seconds_bucket{_format_labels(base + (('le', '+Inf'),))} {summary['count']}")
+        lines.append(f"{METRIC_PREFIX}_span_duration_seconds_sum{_format_labels(base)} {summary['sum']:.6f}")
+        lines.append(f"{METRIC_PREFIX}_span_duration_seconds_count{_format_labels(base)} {summary['count']}")
+    declared = set()
+    for (name, labels), value in sorted(data["counters"].items()):
+        metric = f"{METRIC_PREFIX}_{name}_total"
+        if metric not in declared:
+            lines.append(f"# TYPE {metric} counter")
+            declared.add(metric)
+        lines.append(f"{metric}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def write_prometheus_file(path=None):
+    """Rewrites the metrics file (TELEMETRY_METRICS_FILE by default) atomically."""
+    path = path or os.getenv("TELEMETRY_METRICS_FILE")
+    if not _enabled or not path:
+        return
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Serves /metrics on a daemon thread. Only one server is started per process."""
+    global _metrics_server
+    if _metrics_server is not None:
+        return _metrics_server
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    _metrics_server = ThreadingHTTPServer((host, port), Handler)
+    _metrics_server.daemon_threads = True
+    threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    return _metrics_server
+
+
+# ================= Per-run traces =================
+def start_trace():
+    """
+    Starts collecting the spans of the current thread (one Streamlit script run) and
+    returns the list they are appended to, or None while telemetry is off.
+    """
+    _local.trace = [] if _enabled else None
+    _local.depth = 0
+    return _local.trace
+
+def current_trace():
+    """Returns the spans collected since start_trace() on this thread."""
+    return list(getattr(_local, "trace", None) or [])
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Seconds every call of the fake model takes, long enough for concurrent calls to overlap
+FAKE_LLM_LATENCY = 0.3
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    """The backend module working on a fresh database (and user directories) in tmp_path."""
+    import backend
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(backend, "_db_initialized", False)
+    backend.ensure_db()
+    return backend
+
+
+@pytest.fixture
+def user(backend):
+    """Hash of a signed-up user with the chapter "Biology" / "Chapter 1"."""
+    backend.signup_user("student", "password")
+    user_hash = backend.generate_sha1_hash("student")
+    backend.add_chapter(user_hash, "Biology", "Chapter 1")
+    return user_hash
+
+
+@pytest.fixture
+def ai_features(backend, monkeypatch):
+    """ai_features on the fake provider; skips the test when the AI stack is not installed."""
+    for module in ("streamlit", "dotenv", "numpy", "faiss", "langchain_core", "langchain_community"):
+        pytest.importorskip(module)
+    monkeypatch.setenv("AI_PROVIDER", "fake")
+    monkeypatch.setenv("FAKE_LLM_LATENCY", str(FAKE_LLM_LATENCY))
+    import ai_features
+    return ai_features
+
+
+@pytest.fixture
+def vector_db(ai_features):
+    """The index of "test_user" / "Biology" / "Chapter 1", a synthetic corpus indexed with the fake embeddings."""
+    from benchmarks import write_synthetic_corpus
+    write_synthetic_corpus(os.path.join("test_user", "materials", "Biology", "Chapter 1"), 3, 6)
+    ai_features.build_vector_store("test_user", "Biology", "Chapter 1")
+    return ai_features.load_vector_store("test_user", "Biology", "Chapter 1")
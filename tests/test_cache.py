@@ -0,0 +1,100 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cache import FakeRedisServer, create_cache
+
+
+@pytest.fixture
+def redis_server():
+    """A fake Redis server on a free port."""
+    server = FakeRedisServer(port=0).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["memory", "disk", "redis"])
+def shared_cache(request, tmp_path):
+    url = None
+    if request.param == "redis":
+        url = f"redis://127.0.0.1:{request.getfixturevalue('redis_server').server_address[1]}/0"
+    return create_cache(request.param, url=url, path=str(tmp_path / "cache.db"), max_bytes=256 * 1024)
+
+
+def test_values_round_trip(shared_cache):
+    shared_cache.set("student/Biology/Chapter 1/chunks", "a", [{"text": "x" * 2000}])
+    shared_cache.set("student/Biology/Chapter 1/chunks", "b", {"pages": ["p1", "p2"]})
+    assert shared_cache.get("student/Biology/Chapter 1/chunks", "a") == [{"text": "x" * 2000}]
+    assert shared_cache.get("student/Biology/Chapter 1/chunks", "b") == {"pages": ["p1", "p2"]}
+    assert shared_cache.get("student/Biology/Chapter 1/chunks", "c") is None
+
+
+def test_invalidating_a_namespace_keeps_other_users(shared_cache):
+    shared_cache.set("student/Biology/Chapter 1/chunks", "a", "dropped")
+    shared_cache.set("student/Biology/Chapter 2/chunks", "a", "dropped")
+    shared_cache.set("student_2/Biology/Chapter 1/chunks", "a", "kept")
+    shared_cache.invalidate("student")
+    assert shared_cache.get("student/Biology/Chapter 1/chunks", "a") is None
+    assert shared_cache.get("student/Biology/Chapter 2/chunks", "a") is None
+    assert shared_cache.get("student_2/Biology/Chapter 1/chunks", "a") == "kept"
+
+
+def test_cached_none_is_not_computed_again(shared_cache):
+    shared_cache.set("check/none", "a", None)
+    computed = []
+    assert shared_cache.get_or_compute("check/none", "a", lambda: computed.append(1)) is None
+    assert computed == []
+    assert shared_cache.stats()["caches"]["none"]["hits"] == 1
+
+
+def test_entries_expire_after_their_ttl(shared_cache):
+    shared_cache.set("llm/grading", "short", "5.0", ttl=1)
+    assert shared_cache.get("llm/grading", "short") == "5.0"
+    time.sleep(1.1)
+    assert shared_cache.get("llm/grading", "short") is None
+
+
+@pytest.mark.parametrize("kind", ["memory", "disk"])
+def test_bounded_backends_stay_under_their_size_limit(kind, tmp_path):
+    shared_cache = create_cache(kind, path=str(tmp_path / "cache.db"), max_bytes=64 * 1024)
+    for i in range(300):
+        shared_cache.set("check/fill", str(i), f"{i}:" + "y" * 1000)
+    if hasattr(shared_cache.backend, "evict"):
+        shared_cache.backend.evict()
+    assert shared_cache.backend.stats()["bytes"] <= 64 * 1024
+    assert shared_cache.get("check/fill", "299") == "299:" + "y" * 1000
+
+
+def test_redis_threads_read_back_their_own_values(redis_server):
+    shared_cache = create_cache("redis", url=f"redis://127.0.0.1:{redis_server.server_address[1]}/0")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda i: shared_cache.set("check/threads", str(i), i), range(20)))
+        values = list(executor.map(lambda i: shared_cache.get("check/threads", str(i)), range(20)))
+    assert values == list(range(20))
+
+
+def test_redis_refused_auth_backs_off():
+    server = FakeRedisServer(port=0, password="secret").start()
+    try:
+        port = server.server_address[1]
+        wrong = create_cache("redis", url=f"redis://:wrong@127.0.0.1:{port}/0")
+        wrong.set("check/auth", "a", 1)
+        assert wrong.get("check/auth", "a") is None
+        assert time.monotonic() < wrong.backend._down_until
+
+        right = create_cache("redis", url=f"redis://:secret@127.0.0.1:{port}/0")
+        right.set("check/auth", "a", 1)
+        assert right.get("check/auth", "a") == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_unreachable_redis_is_a_miss():
+    server = FakeRedisServer(port=0)
+    port = server.server_address[1]
+    server.server_close()
+    shared_cache = create_cache("redis", url=f"redis://127.0.0.1:{port}/0")
+    assert shared_cache.get_or_compute("check/down", "a", lambda: "computed") == "computed"
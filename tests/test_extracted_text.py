@@ -0,0 +1,58 @@
+import itertools
+import os
+
+import pytest
+
+
+@pytest.fixture
+def store(backend, monkeypatch):
+    """The extracted text store of backend, with its size total and save counter reset."""
+    monkeypatch.setattr(backend, "_extracted_text_bytes", None)
+    monkeypatch.setattr(backend, "_extracted_text_saves", itertools.count(1))
+    return backend
+
+
+def store_bytes(backend):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(backend.EXTRACTED_TEXT_DIR) for name in names)
+
+
+def test_pages_round_trip(store):
+    pages = ["Première page.", "Second page\nwith two lines."]
+    store.save_extracted_pages("ab" * 32, "pdf-1", pages)
+    assert store.get_extracted_pages("ab" * 32, "pdf-1") == pages
+    assert store.get_extracted_pages("ab" * 32, "pdf-2") is None
+    assert store.get_extracted_pages("cd" * 32, "pdf-1") is None
+
+
+def test_truncated_entry_is_a_miss(store):
+    store.save_extracted_pages("ab" * 32, "pdf-1", ["Page."])
+    with open(store._extracted_text_path("ab" * 32, "pdf-1"), "r+b") as f:
+        f.truncate(10)
+    assert store.get_extracted_pages("ab" * 32, "pdf-1") is None
+
+
+def test_saves_only_walk_the_store_when_over_the_cap(store, monkeypatch):
+    walks = []
+    evict_extracted_text = store.evict_extracted_text
+    monkeypatch.setattr(store, "evict_extracted_text", lambda *a, **kw: walks.append(1) or evict_extracted_text(*a, **kw))
+    for i in range(20):
+        store.save_extracted_pages(f"{i:064x}", "pdf-1", [f"Page {i}."])
+    assert len(walks) == 1
+
+    monkeypatch.setattr(store, "EXTRACTED_TEXT_MAX_BYTES", store_bytes(store))
+    store.save_extracted_pages(f"{20:064x}", "pdf-1", ["Page 20."])
+    assert len(walks) == 2
+    assert store_bytes(store) <= store.EXTRACTED_TEXT_MAX_BYTES
+
+
+def test_eviction_drops_least_recently_used_entries(store):
+    for i in range(10):
+        store.save_extracted_pages(f"{i:064x}", "pdf-1", [f"Page {i} " + "x" * 500])
+        path = store._extracted_text_path(f"{i:064x}", "pdf-1")
+        os.utime(path, (1_700_000_000 + i, 1_700_000_000 + i))
+    cap = store_bytes(store) // 2
+    assert store.evict_extracted_text(cap) > 0
+    assert store_bytes(store) <= cap
+    assert store.get_extracted_pages(f"{0:064x}", "pdf-1") is None
+    assert store.get_extracted_pages(f"{9:064x}", "pdf-1") is not None
@@ -0,0 +1,55 @@
+def test_sm2_intervals_grow_with_consecutive_good_reviews(backend):
+    intervals, state = [], (0, 0.0, 2.5)
+    for _ in range(5):
+        repetitions, interval_days, ease, lapsed = backend.schedule_sm2(*state, backend.FLASHCARD_GRADES["Good"])
+        assert not lapsed
+        state = (repetitions, interval_days, ease)
+        intervals.append(interval_days)
+    assert intervals[:2] == [1.0, 6.0]
+    assert intervals == sorted(intervals) and intervals[-1] > intervals[-2]
+
+
+def test_sm2_lapse_resets_repetitions_and_keeps_minimum_ease(backend):
+    repetitions, interval_days, ease, lapsed = backend.schedule_sm2(4, 30.0, 1.3, backend.FLASHCARD_GRADES["Again"])
+    assert (repetitions, interval_days, lapsed) == (0, 0.0, True)
+    assert ease == backend.FLASHCARD_MIN_EASE
+
+
+def test_add_flashcards_counts_only_new_cards(backend, user):
+    cards = [{"question": f"Question {i}?", "answer": f"Answer {i}."} for i in range(3)]
+    assert backend.add_flashcards(user, "Biology", "Chapter 1", cards) == 3
+    assert backend.add_flashcards(user, "Biology", "Chapter 1", cards + [{"question": "New?", "answer": "Yes."}]) == 1
+    assert backend.add_flashcards(user, "Biology", "Missing chapter", cards) == 0
+
+
+def test_review_schedules_the_next_due_time(backend, user):
+    now = 1_700_000_000
+    backend.add_flashcards(user, "Biology", "Chapter 1", [{"question": "Q?", "answer": "A."}], now=now)
+    card = backend.get_due_flashcards(user, "Biology", "Chapter 1", now=now)[0]
+
+    due_at = backend.review_flashcard(user, card["id"], backend.FLASHCARD_GRADES["Good"], now=now)
+    assert due_at == now + backend.SECONDS_PER_DAY
+    assert backend.get_due_flashcards(user, "Biology", "Chapter 1", now=now) == []
+    assert backend.get_flashcard_counts(user, "Biology", "Chapter 1", now=due_at) == {"due": 1, "total": 1}
+
+    due_at = backend.review_flashcard(user, card["id"], backend.FLASHCARD_GRADES["Again"], now=due_at)
+    reviewed = backend.get_due_flashcards(user, "Biology", "Chapter 1", now=due_at)[0]
+    assert (reviewed["repetitions"], reviewed["lapses"]) == (0, 1)
+    assert reviewed["due_at"] == due_at
+
+
+def test_review_of_another_users_card_is_refused(backend, user):
+    backend.add_flashcards(user, "Biology", "Chapter 1", [{"question": "Q?", "answer": "A."}])
+    card = backend.get_due_flashcards(user, "Biology", "Chapter 1")[0]
+    backend.signup_user("other", "password")
+    assert backend.review_flashcard(backend.generate_sha1_hash("other"), card["id"], 4) is None
+    assert backend.review_flashcard(backend.generate_sha1_hash("nobody"), card["id"], 4) is None
+    assert backend.get_due_flashcards(user, "Biology", "Chapter 1")[0]["repetitions"] == 0
+
+
+def test_due_query_uses_the_chapter_due_index(backend):
+    with backend.get_db_connection() as conn:
+        plan = " ".join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM flashcards WHERE chapter_id = ? AND due_at <= ? ORDER BY due_at LIMIT ?",
+            (1, 0, 20)))
+    assert "idx_flashcards_chapter_due" in plan
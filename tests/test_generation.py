@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import FAKE_LLM_LATENCY
+
+
+def run_concurrently(operation, sessions):
+    """Starts operation(i) on `sessions` threads at the same instant. Returns (results, errors)."""
+    barrier = threading.Barrier(sessions)
+    results, errors = [None] * sessions, [None] * sessions
+
+    def session(i):
+        barrier.wait()
+        try:
+            results[i] = operation(i)
+        except Exception as e:
+            errors[i] = e
+
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        list(pool.map(session, range(sessions)))
+    return results, errors
+
+
+def model_calls(backend, task):
+    return sum(row["calls"] for row in backend.get_llm_task_stats() if row["task"] == task)
+
+
+def chunk_ids(docs):
+    return [doc.metadata["chunk_id"] for doc in docs]
+
+
+def test_identical_prompts_in_flight_share_one_model_call(ai_features, backend):
+    results, errors = run_concurrently(lambda i: ai_features.invoke_llm("chat", "Explain osmosis."), 10)
+    assert not any(errors)
+    assert len(set(results)) == 1
+    assert model_calls(backend, "chat") == 1
+
+    run_concurrently(lambda i: ai_features.invoke_llm("general_chat", f"Question {i}"), 5)
+    assert model_calls(backend, "general_chat") == 5
+
+
+def test_single_flight_error_reaches_every_waiter(ai_features):
+    def fail():
+        time.sleep(FAKE_LLM_LATENCY)
+        raise RuntimeError("provider unavailable")
+
+    start = time.perf_counter()
+    _, errors = run_concurrently(lambda i: ai_features.single_flight(("failing", "same prompt"), fail), 10)
+    assert all(isinstance(e, RuntimeError) for e in errors)
+    assert time.perf_counter() - start < FAKE_LLM_LATENCY * 2.5
+
+
+def test_generation_draws_repeat_per_attempt_and_cover_the_chapter(ai_features, vector_db):
+    queries = ["Generate quiz questions about the key concepts and main ideas in the document."]
+    embedded = Counter()
+    embed_query = vector_db.embedding_function.embed_query
+    vector_db.embedding_function.embed_query = lambda text: embedded.update(queries=1) or embed_query(text)
+
+    first = chunk_ids(ai_features.retrieve_generation_docs(vector_db, queries, attempt=0))
+    assert chunk_ids(ai_features.retrieve_generation_docs(vector_db, queries, attempt=0)) == first
+    seen = {chunk_id for attempt in range(10)
+            for chunk_id in chunk_ids(ai_features.retrieve_generation_docs(vector_db, queries, attempt=attempt))}
+    assert len(seen) > len(set(first))
+    assert not embedded["queries"]
+
+
+def test_adaptive_draws_favour_weak_topics(ai_features, backend, vector_db):
+    topic_chunks = backend.get_topic_chunks(vector_db.chunk_table)
+    topics = sorted(topic_chunks)
+    weak = set(topics[:max(1, len(topics) // 4)])
+    topic_stats = [{"topic": topic, "recent_accuracy": 0.2 if topic in weak else 0.9} for topic in topics]
+    searches = []
+    search = vector_db.similarity_search_with_score
+    vector_db.similarity_search_with_score = lambda *a, **kw: searches.append(1) or search(*a, **kw)
+
+    drawn, contexts = Counter(), set()
+    for attempt in range(50):
+        docs = ai_features.retrieve_adaptive_docs(vector_db, topic_stats, attempt=attempt)
+        contexts.add(tuple(chunk_ids(docs)))
+        drawn.update(backend.get_chunk_topic(vector_db.chunk_table, chunk_id) for chunk_id in chunk_ids(docs))
+    weak_share_of_chunks = sum(len(topic_chunks[t]) for t in weak) / len(vector_db.chunk_table["rows"])
+    assert sum(drawn[t] for t in weak) / sum(drawn.values()) > weak_share_of_chunks
+    assert len(contexts) > 1
+    assert not searches
+
+    repeated = {tuple(chunk_ids(ai_features.retrieve_adaptive_docs(vector_db, topic_stats, attempt=7))) for _ in range(3)}
+    assert len(repeated) == 1
@@ -0,0 +1,107 @@
+import os
+import re
+import time
+import random
+
+
+def write_edition(source_path, target_path, edit_rate=0.02, seed=2):
+    """Copies a corpus file as another "edition", replacing a share of its words."""
+    rng = random.Random(seed)
+    with open(source_path, encoding="utf-8") as f:
+        text = f.read()
+    with open(target_path, "w", encoding="utf-8") as f:
+        f.write(re.sub(r"[a-z]{4,}", lambda m: "revised" if rng.random() < edit_rate else m.group(0), text))
+
+
+def files_on_disk():
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(".") for name in names)
+
+
+def test_unchanged_rebuild_reuses_the_summaries(ai_features, backend, vector_db, monkeypatch):
+    assert vector_db.summary_tree is not None
+    summaries = []
+    invoke_llm = ai_features.invoke_llm
+    monkeypatch.setattr(ai_features, "invoke_llm",
+                        lambda task, prompt, inputs=None: summaries.append(task) or invoke_llm(task, prompt, inputs))
+    ai_features.build_vector_store("test_user", "Biology", "Chapter 1")
+    assert "summary" not in summaries
+
+
+def test_failed_summary_tree_is_filled_in_by_a_retry(ai_features, backend, vector_db, monkeypatch):
+    from benchmarks import write_synthetic_corpus
+    invoke_llm = ai_features.invoke_llm
+
+    def failing_invoke_llm(task, prompt, inputs=None):
+        if task == "summary":
+            raise RuntimeError("summary provider unavailable")
+        return invoke_llm(task, prompt, inputs)
+
+    write_synthetic_corpus(os.path.join("test_user", "materials", "Biology", "Chapter 1"), 1, 6, seed=99)
+    monkeypatch.setattr(ai_features, "invoke_llm", failing_invoke_llm)
+    ai_features.build_vector_store("test_user", "Biology", "Chapter 1")
+    monkeypatch.setattr(ai_features, "invoke_llm", invoke_llm)
+    assert backend.read_index_manifest("test_user", "Biology", "Chapter 1")["summaries"] == "missing"
+
+    assert ai_features.fill_summary_tree("test_user", "Biology", "Chapter 1")
+    assert ai_features.load_vector_store("test_user", "Biology", "Chapter 1").summary_tree is not None
+
+
+def test_editions_collapse_into_their_own_document(ai_features, backend):
+    from benchmarks import write_synthetic_corpus
+    materials_dir = write_synthetic_corpus(os.path.join("test_user", "materials", "Biology", "Editions"), 2, 4)
+    for file_name in sorted(os.listdir(materials_dir)):
+        write_edition(os.path.join(materials_dir, file_name),
+                      os.path.join(materials_dir, file_name.replace(".txt", "_edition_2.txt")))
+    ai_features.build_vector_store("test_user", "Biology", "Editions")
+    manifest = backend.read_index_manifest("test_user", "Biology", "Editions")
+    table = ai_features.load_vector_store("test_user", "Biology", "Editions").chunk_table
+
+    collapsed = [(backend.get_chunk_citation(table, chunk_id)["source"], duplicate["source"])
+                 for chunk_id in map(int, table["duplicates"])
+                 for duplicate in backend.get_chunk_duplicates(table, chunk_id)]
+    assert manifest["duplicate_chunks"] > 0
+    assert len(collapsed) == manifest["duplicate_chunks"]
+    assert all(kept.replace("_edition_2", "") == dropped.replace("_edition_2", "") for kept, dropped in collapsed)
+
+
+def test_distinct_material_is_not_collapsed(ai_features, backend, vector_db):
+    assert backend.read_index_manifest("test_user", "Biology", "Chapter 1")["duplicate_chunks"] == 0
+
+
+def test_temporary_chat_stays_in_memory(ai_features, monkeypatch, tmp_path):
+    from benchmarks import write_synthetic_corpus
+    corpus_dir = write_synthetic_corpus(str(tmp_path / "corpus"), 2, 4)
+    uploads = []
+    for file_name in sorted(os.listdir(corpus_dir)):
+        with open(os.path.join(corpus_dir, file_name), "rb") as f:
+            uploads.append((file_name, f.read()))
+    disk_before = files_on_disk()
+
+    for file_name, data in uploads:
+        assert ai_features.add_temp_material("test_session", file_name, data) == "success"
+    entry = ai_features.get_temp_index("test_session")
+    assert {chunk["metadata"]["source"] for chunk in entry["chunks"]} == {name for name, _ in uploads}
+    assert files_on_disk() == disk_before
+
+    monkeypatch.setattr(ai_features, "TEMP_INDEX_MAX_BYTES", entry["bytes"])
+    assert ai_features.add_temp_material("test_session", "extra.txt", uploads[0][1]) != "success"
+    ai_features.sweep_temp_indexes(time.monotonic() + ai_features.TEMP_INDEX_IDLE_SECONDS + 1)
+    assert ai_features.get_temp_index("test_session") is None
+
+
+def test_saving_a_chat_as_a_chapter_succeeds_after_a_failed_save(ai_features, backend, monkeypatch):
+    backend.signup_user("student", "password")
+    owner = backend.generate_sha1_hash("student")
+    ai_features.add_temp_material("promote_session", "notes.txt", b"Osmosis moves water across a membrane. " * 200)
+
+    def failing_clusters(vector_store, seed=0):
+        raise RuntimeError("clustering failed")
+
+    cluster_chunk_vectors = ai_features.cluster_chunk_vectors
+    monkeypatch.setattr(ai_features, "cluster_chunk_vectors", failing_clusters)
+    assert ai_features.promote_temp_chat("promote_session", owner, "Saved", "Chapter 1") != "success"
+    assert backend.get_chapters(owner, "Saved") == []
+    monkeypatch.setattr(ai_features, "cluster_chunk_vectors", cluster_chunk_vectors)
+    assert ai_features.promote_temp_chat("promote_session", owner, "Saved", "Chapter 1") == "success"
+    assert backend.get_current_index_version(owner, "Saved", "Chapter 1") is not None
+
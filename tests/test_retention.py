@@ -0,0 +1,76 @@
+import sqlite3
+import time
+
+NOW = 1_700_000_000
+DAY = 86400
+
+
+def add_old_messages(backend, user_hash, count, age_days, size=2000):
+    """Inserts count messages sent age_days ago (the app only ever stores the current time)."""
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(NOW - age_days * DAY))
+    with backend.get_db_connection() as conn:
+        user_id = backend._get_user_id(conn.cursor(), user_hash)
+        conn.executemany("INSERT INTO chat_history (user_id, role, message, timestamp) VALUES (?, ?, ?, ?)",
+                         [(user_id, "user" if i % 2 == 0 else "assistant", f"Old message {i} " + "x" * size, timestamp)
+                          for i in range(count)])
+        conn.commit()
+
+
+def test_archived_history_reads_back_unchanged(backend, user):
+    add_old_messages(backend, user, 300, age_days=400)
+    add_old_messages(backend, user, 20, age_days=1)
+    before = [(message["id"], message["role"], message["content"]) for message in backend.get_chat_history(user)]
+
+    stats = backend.archive_chat_history(180, now=NOW)
+    assert stats["archived_messages"] == 300 and stats["segments"] == 1
+    assert not stats["needs_full_vacuum"]
+    assert stats["freed_pages"] > 0 and stats["reclaimed_bytes"] > 0
+    assert len(backend.get_chat_history(user)) == 20
+
+    transcript = backend.get_chat_transcript(user, len(before))
+    assert [(message["id"], message["role"], message["content"]) for message in transcript["messages"]] == before
+    assert not transcript["has_more"]
+    assert all(message.get("archived") for message in transcript["messages"][:300])
+
+    page = backend.get_chat_transcript(user, 50)
+    assert [message["id"] for message in page["messages"]] == [message[0] for message in before[-50:]]
+    assert page["has_more"]
+
+
+def test_archiving_again_is_a_no_op(backend, user):
+    add_old_messages(backend, user, 100, age_days=400)
+    backend.archive_chat_history(180, now=NOW)
+    again = backend.archive_chat_history(180, now=NOW)
+    assert again["archived_messages"] == 0
+    assert backend.get_maintenance_stats()[backend.CHAT_RETENTION_TASK]["archived_messages"] == 0
+
+
+def test_users_with_few_old_messages_are_left_alone(backend, user):
+    add_old_messages(backend, user, backend.CHAT_ARCHIVE_MIN_MESSAGES - 1, age_days=400)
+    assert backend.archive_chat_history(180, now=NOW)["archived_messages"] == 0
+    assert len(backend.get_chat_history(user)) == backend.CHAT_ARCHIVE_MIN_MESSAGES - 1
+
+
+def test_archived_messages_leave_the_search_index(backend, user):
+    add_old_messages(backend, user, 60, age_days=400, size=10)
+    backend.add_chat_message(user, "user", "A recent old message.")
+    backend.archive_chat_history(180, now=NOW)
+    assert len(backend.search_history(user, "old message", limit=100)) == 1
+
+
+def test_older_databases_are_converted_to_incremental_vacuum(backend, tmp_path, monkeypatch):
+    legacy_dir = tmp_path / "legacy"
+    legacy_dir.mkdir()
+    monkeypatch.chdir(legacy_dir)
+    # A database created before retention existed, with auto-vacuum off
+    conn = sqlite3.connect(backend.DB_FILE)
+    conn.execute("CREATE TABLE legacy (id INTEGER)")
+    conn.close()
+    monkeypatch.setattr(backend, "_db_initialized", False)
+    monkeypatch.setattr(backend, "AUTO_VACUUM_MIGRATION_MAX_BYTES", 0)
+    backend.ensure_db()
+    assert backend.archive_chat_history(180, now=NOW)["needs_full_vacuum"]
+
+    assert backend.enable_incremental_vacuum()
+    assert not backend.enable_incremental_vacuum()
+    assert not backend.archive_chat_history(180, now=NOW)["needs_full_vacuum"]
@@ -0,0 +1,57 @@
+def add_messages(backend, user_hash, messages):
+    for i, message in enumerate(messages):
+        backend.add_chat_message(user_hash, "user" if i % 2 == 0 else "assistant", message)
+
+
+def test_build_search_query_quotes_words_and_keeps_long_prefixes(backend):
+    assert backend.build_search_query('cell AND "membrane"') == '"cell" "AND" "membrane"'
+    assert backend.build_search_query("mito* ce*") == '"mito"* "ce"'
+    assert backend.build_search_query(" -- ") is None
+
+
+def test_search_ranks_highlights_and_matches_prefixes(backend, user):
+    add_messages(backend, user, [
+        "Mitochondria are the powerhouse of the cell.",
+        "The cell membrane controls what enters the cell and what leaves the cell.",
+        "Photosynthesis happens in chloroplasts.",
+    ])
+    results = backend.search_history(user, "cell")
+    assert [result["kind"] for result in results] == ["chat", "chat"]
+    assert results[0]["snippet"].count("**cell**") == 3
+    assert {result["role"] for result in results} == {"user", "assistant"}
+
+    assert len(backend.search_history(user, "mitochond*")) == 1
+    assert backend.search_history(user, "mitochond") == []
+    assert backend.search_history(user, "cell chloroplasts") == []
+
+
+def test_search_covers_flashcards_and_answers_and_filters_kinds(backend, user):
+    backend.add_flashcards(user, "Biology", "Chapter 1", [{"question": "What is osmosis?", "answer": "Diffusion of water."}])
+    backend.record_attempt(user, "Biology", "Chapter 1", "quiz", [
+        {"question": "Define osmosis.", "topic": "Transport", "given_answer": "Water moving", "correct_answer": "Diffusion of water",
+         "score": 1.0, "max_score": 1.0},
+    ])
+    backend.add_chat_message(user, "user", "Explain osmosis again.")
+
+    results = backend.search_history(user, "osmosis")
+    assert sorted(result["kind"] for result in results) == ["chat", "flashcard", "quiz"]
+    flashcard = next(result for result in results if result["kind"] == "flashcard")
+    assert flashcard["title"] == "What is **osmosis**?"
+    assert (flashcard["subject"], flashcard["chapter"]) == ("Biology", "Chapter 1")
+    assert [result["kind"] for result in backend.search_history(user, "osmosis", kinds=("quiz",))] == ["quiz"]
+
+
+def test_search_is_limited_to_the_user(backend, user):
+    backend.signup_user("other", "password")
+    other = backend.generate_sha1_hash("other")
+    add_messages(backend, other, ["Ribosomes make proteins."])
+    assert backend.search_history(user, "ribosomes") == []
+    assert len(backend.search_history(other, "ribosomes")) == 1
+    assert backend.search_history(backend.generate_sha1_hash("nobody"), "ribosomes") == []
+
+
+def test_search_pages_do_not_overlap(backend, user):
+    add_messages(backend, user, [f"Enzyme fact number {i}." for i in range(25)])
+    pages = [backend.search_history(user, "enzyme", limit=10, offset=offset) for offset in (0, 10, 20)]
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert len({result["id"] for page in pages for result in page}) == 25
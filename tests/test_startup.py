@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+from benchmarks import STARTUP_FORBIDDEN_MODULES, profile_imports
+
+pytest.importorskip("streamlit")
+
+# Cold import of the login page; STARTUP_BUDGET_MS raises it on slow machines
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "1500"))
+
+
+@pytest.fixture(scope="module")
+def startup_imports():
+    return profile_imports("frontend")
+
+
+@pytest.mark.parametrize("module", STARTUP_FORBIDDEN_MODULES)
+def test_login_page_does_not_import_the_ai_stack(startup_imports, module):
+    assert module not in startup_imports
+
+
+def test_login_page_imports_within_budget(startup_imports):
+    assert sum(startup_imports.values()) / 1000 <= STARTUP_BUDGET_MS